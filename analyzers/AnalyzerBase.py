@@ -21,18 +21,33 @@ Variables and functions that must be defined in inheritor class:
     choose_objects(rtrow)   A function that produces object candidates and a list minimizing variables
                             ex: return ([massdiff, -ptsum], list(leptons))
     preselection(rtrow)     A function to return a CutSequence object with ordered cuts to be applied
+                            (built once per final state, the cuts are evaluated for every row)
 
 Author: Devin N. Taylor, UW-Madison
 '''
 import os
 import sys
+import glob
+import time
+import json
+import shutil
+import cPickle as pickle
+import multiprocessing as mp
 from itertools import permutations, combinations
 import argparse
+import numpy as np
 
 #from scale_factors import LeptonScaleFactors
-#from pu_weights import PileupWeights
+from pu_weights import PileupWeights
 import leptonId as lepId
 from ntuples import *
+from columnar import iterate_chunks
+from eventindex import EventIndex
+from sidecar import ColumnSidecar
+from stagecache import StageCache
+import systematics
+from accessors import AccessorPlan
+from pairings import lep_order, ordered, PairingTable, first_min
 
 sys.argv.append('-b')
 import ROOT as rt
@@ -41,37 +56,124 @@ sys.argv.pop()
 
 ZMASS = 91.1876
 
+# analyzer of the parent process, inherited by the forked workers of AnalyzerBase.analyze_sharded
+_shardAnalyzer = None
+
+def _analyze_shard(args):
+    i, kwargs = args
+    return _shardAnalyzer.analyze_shard(i, **kwargs)
+
+class CutStats(object):
+    '''
+    Call counts, pass counts and cumulative wall time for each cut of a CutSequence.
+    '''
+    def __init__(self, names):
+        self.names = list(names)
+        self.calls = [0] * len(self.names)
+        self.passes = [0] * len(self.names)
+        self.time = [0.] * len(self.names)
+
+    def fill(self, i, calls, passes, time):
+        self.calls[i] += calls
+        self.passes[i] += passes
+        self.time[i] += time
+
+    def add(self, other):
+        for i in range(len(self.names)):
+            self.fill(i, other.calls[i], other.passes[i], other.time[i])
+
+    def to_list(self):
+        return [{'cut': n, 'calls': c, 'passes': p, 'time': t}
+                for n, c, p, t in zip(self.names, self.calls, self.passes, self.time)]
+
 class CutSequence(object):
     '''
     A class for defining cut orders for preselection.
     '''
     def __init__(self):
         self.cut_sequence = []
+        self.stats = None
 
     def add(self, fun):
         self.cut_sequence.append(fun)
 
+    def names(self):
+        return [cut.__name__ for cut in self.cut_sequence]
+
     def evaluate(self, rtrow):
+        if self.stats is not None:
+            num = self.timed_first_failing(rtrow)
+            return num==len(self.cut_sequence), num
         for i,cut in enumerate(self.cut_sequence):
             if not cut(rtrow): 
                 return False, i
         return True, i+1
 
-def lep_order(a, b):
+    def compile(self, stats=None):
+        '''
+        Freeze the cut sequence for repeated evaluation with first_failing.
+        If a CutStats object is given every cut evaluation is recorded in it.
+        '''
+        self.compiled = tuple(self.cut_sequence)
+        self.numCuts = len(self.compiled)
+        self.stats = stats
+        if stats is not None: self.first_failing = self.timed_first_failing
+        return self
+
+    def first_failing(self, rtrow, start=0):
+        '''
+        Return the index of the first failing cut (numCuts if all cuts pass),
+        starting from cut start (the previous cuts are known to pass).
+        Requires compile().
+        '''
+        i = start
+        for cut in (self.compiled[start:] if start else self.compiled):
+            if not cut(rtrow): return i
+            i += 1
+        return i
+
+    def timed_first_failing(self, rtrow, start=0):
+        '''
+        Instrumented version of first_failing.
+        '''
+        for i,cut in enumerate(self.cut_sequence[start:], start):
+            start = time.time()
+            result = cut(rtrow)
+            self.stats.fill(i, 1, 1 if result else 0, time.time()-start)
+            if not result: return i
+        return len(self.cut_sequence)
+
+class RecordedRow(object):
     '''
-    A simple function to guarantee order of leptons in FSA ntuples.
+    Records the branch values read from an FSA row, so that a function of the row
+    can be evaluated again from the values alone (RecordedRow(values=values)).
     '''
-    if len(a)==2 and len(b)==2:
-        a_index = int(a[1])
-        b_index = int(b[1])
-        return a_index > b_index or a[0] > b[0]
-    return a[0] > b[0]
+    def __init__(self, rtrow=None, values=None):
+        self.rtrow = rtrow
+        self.values = {} if values is None else values
 
-def ordered(a,b):
+    def __getattr__(self, name):
+        if name in self.values: return self.values[name]
+        if self.rtrow is None: raise AttributeError(name)
+        val = getattr(self.rtrow, name)
+        self.values[name] = val
+        return val
+
+class BranchRecorder(object):
     '''
-    Return a,b in lep order.
+    Wraps an FSA tree and records the branches that are read without being declared.
     '''
-    return [a,b] if lep_order(b,a) else [b,a]
+    def __init__(self, tree, declared):
+        self.tree = tree
+        self.declared = declared
+        self.checked = set()
+        self.undeclared = set()
+
+    def __getattr__(self, name):
+        if name not in self.declared and name not in self.checked:
+            self.checked.add(name)
+            if self.tree.GetBranch(name): self.undeclared.add(name)
+        return getattr(self.tree, name)
 
 class AnalyzerBase(object):
     '''
@@ -84,6 +186,9 @@ class AnalyzerBase(object):
         self.out_file = out_file
         self.sample_location = sample_location
         self.period = period
+        self.stage = None
+        # set before begin() to keep the output of an interrupted run for analyze(resume=True)
+        self.resume = False
 
     def __enter__(self):
         self.begin()
@@ -93,8 +198,19 @@ class AnalyzerBase(object):
         self.finish()
 
     def begin(self):
+        beginStart = time.time()
         #self.lepscaler = LeptonScaleFactors()
-        #self.pu_weights = PileupWeights()
+        self.lepscaler = None
+        # the pileup profiles are for 8 TeV
+        self.pu_weights = PileupWeights() if self.period == '8' else None
+
+        # keep the output of an interrupted run for analyze(resume=True), a checkpoint not
+        # resumed is stale
+        if os.path.exists(self.checkpoint_name('json')):
+            if not self.resume:
+                self.remove_checkpoint()
+            elif os.path.exists(self.out_file):
+                os.rename(self.out_file, self.checkpoint_name('root'))
 
         self.file = rt.TFile(self.out_file, 'recreate')
         
@@ -104,113 +220,132 @@ class AnalyzerBase(object):
             states = [self.initial_states]
         if not hasattr(self,'alternateIds'): self.alternateIds = []
         if not hasattr(self,'doVBF'): self.doVBF = False
-        self.ntuple, self.branches = buildNtuple(self.object_definitions,states,self.channel,self.final_states,altIds=self.alternateIds,doVBF=self.doVBF)
+        ntupleStart = time.time()
+        self.ntuple, self.branches, schema = buildNtuple(self.object_definitions,states,self.channel,self.final_states,altIds=self.alternateIds,doVBF=self.doVBF,systematics=systematics.names(),varied=systematics.varied_names(self))
+        ntupleTime = time.time() - ntupleStart
+        self.writer = RowWriter(self.branches, schema)
+        self.schema = schema
+        self.weights = [(fun, ['event.%s' % b for b in branches]) for fun, branches in systematics.weights(self)]
+        unvaried = [name for name in systematics.names() if name not in systematics.varied_names(self)]
+        if unvaried:
+            print "%s %s: Warning: no source of variations for %s, storing the nominal weights only" % (self.channel, self.sample_name, ', '.join(unvaried))
+
+        # fake rate flags: select.pass_XYZ is set if the tight object counts per type are X,Y,Z
+        self.promptObjects, combinations = promptCombinations(self.final_states)
+        self.promptKeys = dict((prompts, "select.pass_%s" % promptString) for promptString, prompts in combinations)
 
+        self.build_id_bits()
+        self.cache = {}
+        self.beginTime = time.time() - beginStart
+        print "%s %s: Started in %.2f s (ntuple structs %.2f s)" % (self.channel, self.sample_name, self.beginTime, ntupleTime)
     def analyze(self,**kwargs):
         '''
         The primary analyzer loop.
+        kwargs:
+            columnar    evaluate the vectorizable preselection cuts as array masks over
+                        chunks of the FSA ntuple (default False, row by row)
+            chunkSize   number of entries per chunk in columnar mode
+            pruneBranches   only activate the branches declared in fsa_branches (default True)
+            checkBranches   keep all branches active and report the branches read without
+                            being declared in fsa_branches (default False)
+            cutStats    record calls, passes and wall time per cut, written to a json file
+                        next to the output file (default False)
+            memoryBudget    size in MB of the event index above which it is memory mapped
+                            to disk (default None, kept in memory)
+            numWorkers  number of processes the files of the sample are sharded over
+                        (default 1, serial), the output is identical to the serial loop
+            checkpoint  save a checkpoint after each file (default False)
+            resume      continue from the checkpoint of an interrupted run (default the resume
+                        attribute, which must be set before begin())
+            sidecar     also write the ntuple as memory mappable columns to [output].columns
+                        (default False, see sidecar.py)
+            compression, compressionLevel, basketSize, autoFlush
+                        output file compression and tree basket and flush policy (default
+                        ROOT's, see ntuples.configureOutput)
+            mergeShards merge the results saved by analyze_files for every file instead of
+                        processing the files (default False)
+            stageDir    copy the input files to this local directory before reading them, the
+                        next file is copied while the current one is processed (default None,
+                        read in place, see stagecache.py)
+            stageBudget size in GB of the stage directory (default 50)
+            saveEvents  save the event index to [output]_events.npz, used to merge the outputs
+                        of several jobs with utilities/mergeNtuples.py (default False)
         '''
-        self.eventMap = {}
-        self.bestCandMap = {}
-        self.cutflowMap = {}
-        eventsToWrite = set()
-        eventsWritten = set()
+        options = {
+            'columnar': kwargs.pop('columnar',False),
+            'chunkSize': kwargs.pop('chunkSize',10000),
+            'pruneBranches': kwargs.pop('pruneBranches',True),
+            'checkBranches': kwargs.pop('checkBranches',False),
+        }
+        self.doCutStats = kwargs.pop('cutStats',False)
+        memoryBudget = kwargs.pop('memoryBudget',None)
+        numWorkers = kwargs.pop('numWorkers',1)
+        self.doCheckpoint = kwargs.pop('checkpoint',False)
+        resume = kwargs.pop('resume',self.resume)
+        sidecar = kwargs.pop('sidecar',False)
+        mergeShards = kwargs.pop('mergeShards',False)
+        saveEvents = kwargs.pop('saveEvents',False)
+        self.start_stage(kwargs.pop('stageDir',None), kwargs.pop('stageBudget',50))
+        outputOptions = dict((option, kwargs.pop(option)) for option in ['compression', 'compressionLevel', 'basketSize', 'autoFlush'] if option in kwargs)
+        if numWorkers>1 and mp.current_process().daemon:
+            print "%s %s: Running files serially inside a daemonic process" % (self.channel, self.sample_name)
+            numWorkers = 1
+        self.cutStats = {}
+        self.undeclaredBranches = {}
+
+        if outputOptions: configureOutput(self.file, self.ntuple, **outputOptions)
+        self.events = EventIndex(memoryBudget=memoryBudget)
+        self.eventsToWrite = set()
+        self.storeLog = None
+        self.sidecar = ColumnSidecar(self.sidecar_name(), self.schema) if sidecar else None
         numEvts = 0
+        numDone = 0
         totalWritten = 0
 
-        # iterate over files
-        for i, file_name in enumerate(self.file_names):
-            print "%s %s: Processing %i/%i files" % (self.channel, self.sample_name, i+1, len(self.file_names))
-
-            file_path = os.path.join(self.sample_location, file_name)
-            rtFile = rt.TFile(file_path, "READ")
-
-            # iterate over final states
-            for fs in self.final_states:
-                if len(self.file_names)<10: print "%s %s: %s" % (self.channel, self.sample_name, fs)
-                tree = rtFile.Get("%s/final/Ntuple" % fs)
-                metatree = rtFile.Get("%s/eventCount" % fs)
-                tempEvts = metatree.GetEntries()
-
-                self.objects = self.enumerate_objects(fs)
-
-                # initialize event counter
-                numFSEvents = 0
-                totalFSEvents = tree.GetEntries()
-
-                # iterate over each row of an fsa ntuple
-                rtrow = tree
-                numRows = tree.GetEntries('1')
-                for r in range(numRows):
-                    rtrow.GetEntry(r)
-                    if numFSEvents % 10000 == 0:
-                        if len(self.file_names)==1: print "%s %s: %s %i/%i entries" % (self.channel, self.sample_name, fs, numFSEvents, totalFSEvents)
-                    numFSEvents += 1
-
-                    # cache to prevent excessive reads of fsa ntuple
-                    self.cache = {}
-
-                    # now see if event is viable
-                    passPreselection = self.pass_preselection(rtrow)
-                    eventkey = (rtrow.evt, rtrow.lumi, rtrow.run)
-                    old = self.cutflowMap[eventkey] if eventkey in self.cutflowMap else -1
-                    if self.num>old:
-                        self.cutflowMap[eventkey] = self.num
-                    if not passPreselection:
-                        continue
-
-                    # can we define the object we want?
-                    candidate = self.choose_objects(rtrow)
-                    if not candidate: continue # in case no objects satisfy our requirements
-                    if self.num+1>old:
-                        self.cutflowMap[eventkey] = self.num+1
-
-                    # check combinatorics
-                    if eventkey in self.bestCandMap: 
-                        bestcand = self.bestCandMap[eventkey]
-                    else:
-                        numMin = len(candidate[0])
-                        bestcand = [float('inf')] * numMin
-                    if self.good_to_store(rtrow,candidate[0],bestcand):
-                        self.bestCandMap[eventkey] = candidate[0]
-                        if self.num+2>old:
-                            self.cutflowMap[eventkey] = self.num+2
-                        ntupleRow = self.store_row(rtrow, *candidate[1])
-                        self.eventMap[eventkey] = ntupleRow
-                        eventsToWrite.add(eventkey)
-
-            rtFile.Close("R")
-            numEvts += tempEvts
-
-            # end of file, write the ntuples
-            self.file.cd()
-            for key in eventsToWrite:
-                if key in eventsWritten:
-                    print "%s %s: Error: attempted to write previously written event" % (self.channel, self.sample_name)
-                else:
-                    self.write_row(self.eventMap[key])
-                    self.ntuple.Fill()
-            eventsWritten.update(eventsToWrite)
-            self.eventMap = {}
-            eventsToWrite = set()
+        if resume: numDone, numEvts = self.load_checkpoint()
+        if self.sidecar and not numDone: self.sidecar.truncate(0)
+
+        if mergeShards:
+            numEvts = self.merge_shards(numDone, numEvts)
+        elif numWorkers>1 and len(self.file_names)-numDone>1:
+            numEvts = self.analyze_sharded(numWorkers, numDone, numEvts, **options)
+        else:
+            # iterate over files
+            for i in range(numDone, len(self.file_names)):
+                print "%s %s: Processing %i/%i files" % (self.channel, self.sample_name, i+1, len(self.file_names))
+                if i+1 < len(self.file_names): self.prefetch_file(self.file_names[i+1])
+                numEvts += self.process_file(self.file_names[i], **options)
+
+                # end of file, write the ntuples
+                self.file.cd()
+                for key in self.eventsToWrite:
+                    self.write_event(key, self.writer.rows[key])
+                self.writer.clear()
+                self.eventsToWrite = set()
+                if self.doCheckpoint: self.save_checkpoint(i+1, numEvts)
 
         # now we store all events that are kept
         print "%s %s: Filling Tree" % (self.channel, self.sample_name)
         #self.file.cd()
         #for key in eventsToWrite:
-        #    self.write_row(self.eventMap[key])
+        #    self.write_row(self.writer.rows[key])
         #    self.ntuple.Fill()
-        print "%s %s: Filled Tree (%i events)" % (self.channel, self.sample_name, len(eventsWritten))
+        print "%s %s: Filled Tree (%i events)" % (self.channel, self.sample_name, self.events.num_written())
 
         # now we store the total processed events
         print "%s %s: Processed %i events" % (self.channel, self.sample_name, numEvts)
+
+        for fs in sorted(self.undeclaredBranches):
+            if self.undeclaredBranches[fs]:
+                print "%s %s: %s: Undeclared branches read: %s" % (self.channel, self.sample_name, fs, ' '.join(sorted(self.undeclaredBranches[fs])))
         
-        cutflowVals = []
         # and the cutflow
-        for val in self.cutflowMap.itervalues():
-            for i in range(val+1):
-                if len(cutflowVals)<i+1: cutflowVals.append(1)
-                else: cutflowVals[i] += 1
+        cutflowVals = self.events.cutflow()
+        if saveEvents:
+            self.save_events()
+        elif os.path.exists(self.events_name()):
+            os.remove(self.events_name())
+        self.events.close()
         print "%s %s: Cutflow: " % (self.channel, self.sample_name), cutflowVals
         cutflowHist = rt.TH1F('cutflow','cutflow',len(cutflowVals)+1,0,len(cutflowVals)+1)
         cutflowHist.SetBinContent(1,numEvts)
@@ -226,6 +361,519 @@ class AnalyzerBase(object):
             #pass # TODO
         cutflowHist.Write()
 
+        if self.doCutStats: self.write_cut_stats()
+        if self.sidecar: self.sidecar.close()
+        self.stop_stage()
+        self.remove_checkpoint()
+        if mergeShards: shutil.rmtree(self.shard_directory())
+
+    def process_file(self, file_name, **kwargs):
+        '''
+        Process all final states of an FSA file of the sample, read from the stage
+        directory when staging (see process_path).
+        Returns the number of processed events (from the eventCount tree).
+        '''
+        file_path = os.path.join(self.sample_location, file_name)
+        if not self.stage: return self.process_path(file_path, **kwargs)
+        try:
+            return self.process_path(self.stage.fetch(file_path), **kwargs)
+        finally:
+            self.stage.release(file_path)
+
+    def process_path(self, file_path, **kwargs):
+        '''
+        Process all final states of the FSA file at file_path.
+        Returns the number of processed events (from the eventCount tree).
+        '''
+        columnar = kwargs.pop('columnar',False)
+        chunkSize = kwargs.pop('chunkSize',10000)
+        pruneBranches = kwargs.pop('pruneBranches',True)
+        checkBranches = kwargs.pop('checkBranches',False)
+
+        rtFile = rt.TFile(file_path, "READ")
+
+        # iterate over final states
+        for fs in self.final_states:
+            if len(self.file_names)<10: print "%s %s: %s" % (self.channel, self.sample_name, fs)
+            tree = rtFile.Get("%s/final/Ntuple" % fs)
+            metatree = rtFile.Get("%s/eventCount" % fs)
+            tempEvts = metatree.GetEntries()
+
+            # initialize event counter
+            numFSEvents = 0
+            totalFSEvents = tree.GetEntries()
+
+            # only read the branches we need
+            rtrow = tree
+            if checkBranches:
+                rtrow = BranchRecorder(tree, self.fsa_branches(fs))
+            elif pruneBranches:
+                self.activate_branches(tree, self.fsa_branches(fs))
+
+            self.begin_final_state(fs, rtrow)
+
+            if columnar:
+                # iterate over chunks of the fsa ntuple
+                for chunk in iterate_chunks(tree, chunkSize):
+                    if len(self.file_names)==1: print "%s %s: %s %i/%i entries" % (self.channel, self.sample_name, fs, chunk.start, totalFSEvents)
+                    self.analyze_chunk(rtrow, chunk)
+                if checkBranches: self.undeclaredBranches.setdefault(fs,set()).update(rtrow.undeclared)
+                continue
+
+            # iterate over each row of an fsa ntuple
+            numRows = tree.GetEntries('1')
+            for r in range(numRows):
+                rtrow.GetEntry(r)
+                if numFSEvents % 10000 == 0:
+                    if len(self.file_names)==1: print "%s %s: %s %i/%i entries" % (self.channel, self.sample_name, fs, numFSEvents, totalFSEvents)
+                numFSEvents += 1
+
+                # cache to prevent excessive reads of fsa ntuple
+                self.reset_cache()
+
+                self.analyze_row(rtrow)
+
+            if checkBranches: self.undeclaredBranches.setdefault(fs,set()).update(rtrow.undeclared)
+
+        rtFile.Close("R")
+        return tempEvts
+
+    def start_stage(self, stageDir, stageBudget):
+        '''
+        Stage the input files in stageDir, limited to stageBudget GB (see stagecache.py).
+        '''
+        self.stage = StageCache(stageDir, budget=stageBudget*1e9) if stageDir else None
+
+    def stop_stage(self):
+        if not self.stage: return
+        self.stage.close()
+        if self.stage.stats['hits'] or self.stage.stats['misses']:
+            print "%s %s: Staging: %s" % (self.channel, self.sample_name, self.stage.summary())
+        self.stage = None
+
+    def prefetch_file(self, file_name):
+        '''
+        Start copying an input file to the stage directory.
+        '''
+        if self.stage: self.stage.prefetch(os.path.join(self.sample_location, file_name))
+
+    def write_event(self, key, nrow):
+        '''
+        Fill the ntuple with the row of an event unless the event was already written.
+        '''
+        slot = self.events.slot(key)
+        if self.events.written(slot):
+            print "%s %s: Error: attempted to write previously written event" % (self.channel, self.sample_name)
+        else:
+            self.write_row(nrow)
+            self.ntuple.Fill()
+            if self.sidecar: self.sidecar.fill(nrow.values)
+            self.events.set_written(slot)
+
+    def analyze_sharded(self, numWorkers, numDone, numEvts, **kwargs):
+        '''
+        Process the files of the sample after the first numDone files (already accounting
+        for numEvts processed events) in a pool of worker processes (see analyze_shard)
+        and merge the results in file order. The merge replays the candidates of each file
+        against the best candidates of the previous files, so the cutflow and the written
+        events are those of the serial loop. This requires that a candidate stored in the
+        serial loop is also stored when its file is processed alone (true for minimizing
+        variables and for vetoes on the row).
+        Returns the number of processed events.
+        '''
+        global _shardAnalyzer
+        _shardAnalyzer = self
+        pool = mp.Pool(numWorkers)
+        try:
+            results = pool.imap(_analyze_shard, [(i, kwargs) for i in range(numDone, len(self.file_names))])
+            for i, result in enumerate(results, numDone):
+                print "%s %s: Merging %i/%i files" % (self.channel, self.sample_name, i+1, len(self.file_names))
+                numEvts += self.merge_shard(result)
+                if self.doCheckpoint: self.save_checkpoint(i+1, numEvts)
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+            _shardAnalyzer = None
+        return numEvts
+
+    def analyze_shard(self, i, **kwargs):
+        '''
+        Process a single file of the sample in a worker process. The event bookkeeping
+        starts empty and every candidate is logged rather than raising the cutflow.
+        Returns a dictionary with the number of processed events, the cutflow levels, the
+        store log, the rows to write and the cut statistics and undeclared branches.
+        '''
+        self.events = EventIndex()
+        self.eventsToWrite = set()
+        self.storeLog = []
+        self.cutStats = {}
+        self.undeclaredBranches = {}
+        self.writer.clear()
+        print "%s %s: Processing %i/%i files" % (self.channel, self.sample_name, i+1, len(self.file_names))
+        numEvts = self.process_file(self.file_names[i], **kwargs)
+        result = {
+            'numEvts': numEvts,
+            'levels': self.events.entries(),
+            'storeLog': self.storeLog,
+            'rows': dict((key, self.writer.rows[key].dump()) for key in self.eventsToWrite),
+            'cutStats': self.cutStats,
+            'undeclaredBranches': self.undeclaredBranches,
+        }
+        self.events.close()
+        return result
+
+    def analyze_files(self, fileNames, **kwargs):
+        '''
+        Process some of the files of the sample independently of each other (see
+        analyze_shard) and save each result in the shard directory of the output file
+        of the sample, to be merged with analyze(mergeShards=True). Used to split a
+        sample over several tasks.
+        kwargs:
+            output      output file of the sample the results are merged into (default
+                        the output file of this analyzer)
+            resume      skip the files with a saved result (default False)
+            the processing options of analyze (columnar, chunkSize, pruneBranches,
+            checkBranches, cutStats, stageDir, stageBudget), other options are ignored
+        '''
+        output = kwargs.pop('output',self.out_file)
+        resume = kwargs.pop('resume',False)
+        self.doCutStats = kwargs.pop('cutStats',False)
+        options = {
+            'columnar': kwargs.pop('columnar',False),
+            'chunkSize': kwargs.pop('chunkSize',10000),
+            'pruneBranches': kwargs.pop('pruneBranches',True),
+            'checkBranches': kwargs.pop('checkBranches',False),
+        }
+        self.start_stage(kwargs.pop('stageDir',None), kwargs.pop('stageBudget',50))
+        directory = self.shard_directory(output)
+        if not os.path.isdir(directory): os.makedirs(directory)
+        if resume: fileNames = [fileName for fileName in fileNames if not os.path.exists(self.shard_name(fileName, output))]
+        for f, fileName in enumerate(fileNames):
+            shardName = self.shard_name(fileName, output)
+            if f+1 < len(fileNames): self.prefetch_file(fileNames[f+1])
+            result = self.analyze_shard(self.file_names.index(fileName), **options)
+            with open(shardName+'.tmp', 'wb') as shardFile:
+                pickle.dump(result, shardFile, pickle.HIGHEST_PROTOCOL)
+            os.rename(shardName+'.tmp', shardName)
+        self.stop_stage()
+
+    def merge_shards(self, numDone, numEvts):
+        '''
+        Merge the results saved by analyze_files in file order, after the first numDone
+        files (already accounting for numEvts processed events).
+        Returns the number of processed events.
+        '''
+        for i in range(numDone, len(self.file_names)):
+            shardName = self.shard_name(self.file_names[i])
+            if not os.path.exists(shardName):
+                raise IOError('%s %s: No result for file %s in %s' % (self.channel, self.sample_name, self.file_names[i], self.shard_directory()))
+            print "%s %s: Merging %i/%i files" % (self.channel, self.sample_name, i+1, len(self.file_names))
+            with open(shardName, 'rb') as shardFile:
+                numEvts += self.merge_shard(pickle.load(shardFile))
+            if self.doCheckpoint: self.save_checkpoint(i+1, numEvts)
+        return numEvts
+
+    def shard_directory(self, output=None):
+        return '%s_shards' % os.path.splitext(output or self.out_file)[0]
+
+    def shard_name(self, fileName, output=None):
+        return os.path.join(self.shard_directory(output), '%s.pkl' % fileName)
+
+    def merge_shard(self, result):
+        '''
+        Merge the result of analyze_shard for the next file and write its events.
+        Returns the number of processed events of the file.
+        '''
+        events = self.events
+        evts, lumis, runs, levels = result['levels']
+        for key, level in zip(zip(evts, lumis, runs), levels):
+            events.raise_level(events.slot(key), level)
+
+        # replay the candidates against the best candidates of the previous files
+        for key, vals, level, values in result['storeLog']:
+            slot = events.slot(key)
+            bestcand = events.best(slot)
+            if bestcand is None: bestcand = [float('inf')] * len(vals)
+            if self.good_to_store(RecordedRow(values=values), vals, bestcand):
+                events.set_best(slot, vals)
+                events.raise_level(slot, level)
+                self.eventsToWrite.add(key)
+
+        self.file.cd()
+        rows = result['rows']
+        for key in self.eventsToWrite:
+            nrow = self.writer.new_row()
+            nrow.load(rows[key])
+            self.write_event(key, nrow)
+        self.writer.clear()
+        self.eventsToWrite = set()
+
+        for fs, fsStats in result['cutStats'].iteritems():
+            for sequence, stats in fsStats.iteritems():
+                self.get_cut_stats(fs, sequence, stats.names).add(stats)
+        for fs, branches in result['undeclaredBranches'].iteritems():
+            self.undeclaredBranches.setdefault(fs,set()).update(branches)
+        return result['numEvts']
+
+    def checkpoint_name(self, ext):
+        return '%s_checkpoint.%s' % (os.path.splitext(self.out_file)[0], ext)
+
+    def save_checkpoint(self, numDone, numEvts):
+        '''
+        Save the state of the analyzer after the first numDone files. The ntuple entries
+        are flushed to the output file and the event index is saved to a numpy file. The
+        json file with the remaining state is written last, it marks a valid checkpoint.
+        '''
+        self.file.cd()
+        self.ntuple.AutoSave('SaveSelf')
+        if self.sidecar: self.sidecar.flush()
+        indexName = self.checkpoint_name('%i.npz' % numDone)
+        self.events.save(indexName)
+        state = {
+            'file_names': self.file_names,
+            'numDone': numDone,
+            'numEvts': numEvts,
+            'entries': int(self.ntuple.GetEntries()),
+            'sidecar': self.sidecar.numEntries if self.sidecar else None,
+            'index': os.path.basename(indexName),
+            'cutStats': dict((fs, dict((sequence, stats.__dict__) for sequence, stats in fsStats.iteritems()))
+                             for fs, fsStats in self.cutStats.iteritems()),
+            'undeclaredBranches': dict((fs, sorted(branches)) for fs, branches in self.undeclaredBranches.iteritems()),
+        }
+        jsonName = self.checkpoint_name('json')
+        with open(jsonName+'.tmp', 'w') as checkpointFile:
+            json.dump(state, checkpointFile)
+        os.rename(jsonName+'.tmp', jsonName)
+        previousName = self.checkpoint_name('%i.npz' % (numDone-1))
+        if os.path.exists(previousName): os.remove(previousName)
+
+    def load_checkpoint(self):
+        '''
+        Restore the state saved by save_checkpoint and copy the ntuple entries written
+        before the checkpoint from the output of the interrupted run.
+        Returns the number of processed files and events.
+        '''
+        jsonName = self.checkpoint_name('json')
+        if not os.path.exists(jsonName):
+            print "%s %s: No checkpoint found, starting from the first file" % (self.channel, self.sample_name)
+            return 0, 0
+        with open(jsonName) as checkpointFile:
+            state = json.load(checkpointFile)
+        fileNames = [str(x) for x in state['file_names']]
+        if sorted(fileNames) != sorted(self.file_names):
+            print "%s %s: Input files changed since the checkpoint, starting from the first file" % (self.channel, self.sample_name)
+            return 0, 0
+        self.file_names = fileNames
+        self.events.load(os.path.join(os.path.dirname(jsonName), state['index']))
+        for fs, fsStats in state['cutStats'].iteritems():
+            for sequence, vals in fsStats.iteritems():
+                stats = self.get_cut_stats(str(fs), str(sequence), [str(x) for x in vals['names']])
+                for i in range(len(stats.names)):
+                    stats.fill(i, vals['calls'][i], vals['passes'][i], vals['time'][i])
+        for fs, branches in state['undeclaredBranches'].iteritems():
+            self.undeclaredBranches.setdefault(str(fs),set()).update(str(b) for b in branches)
+
+        # the entries are copied through the ntuple structs, leaving the values of the last
+        # entry in them as in the uninterrupted run
+        rtFile = rt.TFile(self.checkpoint_name('root'), 'READ')
+        tree = rtFile.Get(self.channel)
+        self.file.cd()
+        self.ntuple.CopyEntries(tree, state['entries'])
+        rtFile.Close()
+        if self.sidecar:
+            if state.get('sidecar') == state['entries']:
+                self.sidecar.truncate(state['entries'])
+            else:
+                print "%s %s: Error: no sidecar at the checkpoint, not writing a sidecar" % (self.channel, self.sample_name)
+                self.sidecar = None
+        print "%s %s: Resuming after %i/%i files" % (self.channel, self.sample_name, state['numDone'], len(self.file_names))
+        return state['numDone'], state['numEvts']
+
+    def events_name(self):
+        return '%s_events.npz' % os.path.splitext(self.out_file)[0]
+
+    def save_events(self):
+        '''
+        Save the event index with the rule choosing between candidates of the same event:
+        'min' for the default good_to_store (smallest minimizing variables), 'first' for
+        analyzers that override it (the first candidate written).
+        '''
+        rule = 'min' if type(self).good_to_store is AnalyzerBase.good_to_store else 'first'
+        eventsName = self.events_name()
+        self.events.save(eventsName+'.tmp.npz', rule=np.array(rule))
+        os.rename(eventsName+'.tmp.npz', eventsName)
+
+    def sidecar_name(self):
+        return '%s.columns' % os.path.splitext(self.out_file)[0]
+
+    def remove_checkpoint(self):
+        '''
+        Remove the checkpoint files once the sample is done.
+        '''
+        for fileName in glob.glob(self.checkpoint_name('*')):
+            os.remove(fileName)
+
+    def begin_final_state(self, final_state, rtrow):
+        '''
+        Prepare the per final state objects before iterating over an FSA ntuple.
+        The cut sequences are built once here rather than for every row.
+        '''
+        self.final_state = final_state
+        self.objects = self.enumerate_objects(final_state)
+        self.plan = AccessorPlan(self.objects)
+        self.idMasks = [None] * len(self.objects)
+        self.noIdMasks = tuple(self.idMasks)
+        self.pairingTables = {}
+        self.preselectionCuts = self.preselection(rtrow)
+        self.selectionCuts = self.selection(rtrow)
+        if self.doCutStats:
+            self.preselectionCuts.compile(self.get_cut_stats(final_state,'preselection',self.preselectionCuts.names()))
+            self.selectionCuts.compile(self.get_cut_stats(final_state,'selection',self.selectionCuts.names()))
+        else:
+            self.preselectionCuts.compile()
+            self.selectionCuts.compile()
+
+    def reset_cache(self):
+        '''
+        Clear the per row caches before processing a new row.
+        '''
+        self.cache.clear()
+        self.idMasks[:] = self.noIdMasks
+
+    def pairing_table(self, *pairs):
+        '''
+        The PairingTable of the current final state for the given pair positions
+        (i.e. self.pairing_table((0,1),(2,3))), built once per final state.
+        '''
+        if pairs not in self.pairingTables:
+            self.pairingTables[pairs] = PairingTable(self.objects, pairs)
+        return self.pairingTables[pairs]
+
+    def get_cut_stats(self, final_state, sequence, names):
+        '''
+        The CutStats for a cut sequence in a final state, accumulated over all files.
+        '''
+        fsStats = self.cutStats.setdefault(final_state,{})
+        if sequence not in fsStats: fsStats[sequence] = CutStats(names)
+        return fsStats[sequence]
+
+    def write_cut_stats(self):
+        '''
+        Write the per cut statistics to a json file next to the output file
+        and print the time and rejection of each cut summed over final states.
+        '''
+        output = {
+            'channel': self.channel,
+            'sample': self.sample_name,
+            'beginTime': self.beginTime,
+            'final_states': {},
+        }
+        totals = {}
+        for fs, fsStats in self.cutStats.iteritems():
+            output['final_states'][fs] = {}
+            for sequence, stats in fsStats.iteritems():
+                output['final_states'][fs][sequence] = stats.to_list()
+                if sequence not in totals: totals[sequence] = CutStats(stats.names)
+                for i in range(len(stats.names)):
+                    totals[sequence].fill(i, stats.calls[i], stats.passes[i], stats.time[i])
+        statsName = '%s_cutstats.json' % os.path.splitext(self.out_file)[0]
+        with open(statsName, 'w') as statsFile:
+            json.dump(output, statsFile, indent=4, sort_keys=True)
+        for sequence in sorted(totals):
+            print "%s %s: %s cut statistics" % (self.channel, self.sample_name, sequence)
+            for cut in totals[sequence].to_list():
+                rejection = 1.-float(cut['passes'])/cut['calls'] if cut['calls'] else 0.
+                timePerCall = 1e6*cut['time']/cut['calls'] if cut['calls'] else 0.
+                print "    %-25s calls: %10i rejection: %6.3f time/call: %8.2f us" % (cut['cut'], cut['calls'], rejection, timePerCall)
+
+    def analyze_row(self, rtrow):
+        '''
+        Process the current row of an FSA ntuple: update the cutflow and store
+        the candidate if it is the best one for this event.
+        '''
+        # now see if event is viable
+        passPreselection = self.pass_preselection(rtrow)
+        eventkey = (rtrow.evt, rtrow.lumi, rtrow.run)
+        events = self.events
+        slot = events.slot(eventkey)
+        events.raise_level(slot, self.num)
+        if not passPreselection:
+            return
+
+        # can we define the object we want?
+        candidate = self.choose_objects(rtrow)
+        if not candidate: return # in case no objects satisfy our requirements
+        events.raise_level(slot, self.num+1)
+
+        # check combinatorics
+        bestcand = events.best(slot)
+        if bestcand is None:
+            numMin = len(candidate[0])
+            bestcand = [float('inf')] * numMin
+        if self.storeLog is None:
+            goodToStore = self.good_to_store(rtrow,candidate[0],bestcand)
+        else:
+            # file shard, the candidate is compared to the best candidate of the previous
+            # files in merge_shard with the branches read by good_to_store
+            recorded = RecordedRow(rtrow)
+            goodToStore = self.good_to_store(recorded,candidate[0],bestcand)
+            self.storeLog.append((eventkey, list(candidate[0]), self.num+2, recorded.values))
+        if goodToStore:
+            events.set_best(slot, candidate[0])
+            if self.storeLog is None: events.raise_level(slot, self.num+2)
+            self.store_row(rtrow, *candidate[1], ntupleRow=self.writer.row(eventkey))
+            self.eventsToWrite.add(eventkey)
+
+    def analyze_chunk(self, rtrow, chunk):
+        '''
+        Process a chunk of an FSA ntuple. The leading preselection cuts with a columnar
+        implementation are evaluated as array masks, rows failing one of them only update
+        the cutflow. The surviving rows are read and go through analyze_row, which
+        only evaluates the remaining preselection cuts.
+        '''
+        numCuts, numPassed = self.preselection_mask(chunk)
+        evts = chunk['evt']
+        lumis = chunk['lumi']
+        runs = chunk['run']
+        for i in xrange(len(chunk)):
+            if numPassed[i] < numCuts:
+                eventkey = (int(evts[i]), int(lumis[i]), int(runs[i]))
+                self.events.raise_level(self.events.slot(eventkey), int(numPassed[i]))
+                continue
+            rtrow.GetEntry(chunk.start+i)
+            self.reset_cache()
+            self.cache['preselectionStart'] = numCuts
+            self.analyze_row(rtrow)
+
+    def preselection_mask(self, chunk):
+        '''
+        Evaluate the preselection on a chunk up to the first cut without a columnar
+        implementation. A cut fun has a columnar implementation if the analyzer defines
+        fun_columnar(chunk) returning a boolean array (or None if it can not be
+        vectorized for the current final state).
+        Returns the number of cuts evaluated and the number of leading cuts passed per row.
+        '''
+        cuts = self.preselectionCuts
+        if self.doCutStats: stats = self.get_cut_stats(self.final_state,'preselection_columnar',cuts.names())
+        passing = np.ones(len(chunk), dtype=bool)
+        numPassed = np.zeros(len(chunk), dtype=np.int32)
+        numCuts = 0
+        for cut in cuts.compiled:
+            columnarCut = getattr(self, '%s_columnar' % cut.__name__, None)
+            if columnarCut is None: break
+            start = time.time()
+            mask = columnarCut(chunk)
+            if mask is None: break
+            numCalls = np.count_nonzero(passing)
+            passing &= mask
+            numPassed += passing
+            if self.doCutStats: stats.fill(numCuts, numCalls, np.count_nonzero(passing), time.time()-start)
+            numCuts += 1
+        return numCuts, numPassed
+
     def finish(self):
         self.file.Write()
         self.file.Close()
@@ -242,6 +890,45 @@ class AnalyzerBase(object):
                out += ['%s%i' % (i, n) for n in xrange(1, N+1)]
         return out
 
+    def fsa_branches(self, final_state):
+        '''
+        The set of FSA branches read for a final state. Only these branches are
+        activated in the FSA ntuple. Analyzers must extend this with the branches
+        used in their own cuts and object selection.
+        '''
+        objects = self.enumerate_objects(final_state)
+        branches = set(['evt', 'lumi', 'run', 'nvtx', 'Mass', 'pfMetEt', 'pfMetPhi',
+                        'jetVeto20', 'jetVeto30', 'jetVeto40', 'bjetCISVVeto20', 'bjetCISVVeto30',
+                        'muVetoPt5IsoIdVtx', 'muGlbIsoVetoPt10', 'muVetoPt15IsoIdVtx', 'eVetoMVAIsoVtx'])
+        if self.period == '8': branches.add('nTruePU')
+        if self.doVBF:
+            branches.update(['vbfMass', 'vbfdijetpt', 'vbfj1pt', 'vbfj2pt', 'vbfj1eta', 'vbfj2eta',
+                             'vbfJetVeto20', 'vbfJetVeto30'])
+        for obj in objects:
+            branches.update(['%s%s' % (obj, var) for var in ['Pt', 'Eta', 'Phi', 'Charge', 'MtToPFMET', 'ToMETDPhi']])
+            if obj[0] == 'e': branches.add('%sRelPFIsoRho' % obj)
+            if obj[0] == 'm': branches.add('%sRelPFIsoDBDefault' % obj)
+        # pair variables in both orders, only existing branches are activated
+        for a, b in permutations(objects, 2):
+            branches.update(['%s_%s_%s' % (a, b, var) for var in ['Mass', 'SS', 'DR', 'DPhi']])
+        # lepton IDs
+        idArgs = [self.getIdArgs('Tight'), self.getIdArgs('Loose')]
+        idArgs += [self.alternateIdMap[altId] for altId in self.alternateIds]
+        for args in idArgs:
+            idDef = args.get('idDef',{})
+            for obj in objects:
+                if obj[0] in idDef: branches.update(lepId.lep_id_branches(obj, idDef[obj[0]]))
+        return branches
+
+    @staticmethod
+    def activate_branches(tree, branches):
+        '''
+        Deactivate all branches of a tree except the given ones.
+        '''
+        tree.SetBranchStatus('*',0)
+        for b in branches:
+            if tree.GetBranch(b): tree.SetBranchStatus(b,1)
+
     def choose_alternative_objects(self, rtorw, state):
         '''
         Dummy method for alternative object selection.
@@ -258,49 +945,48 @@ class AnalyzerBase(object):
             if min1 > min2: return False
         return False
 
-    def store_row(self,rtrow,*objects):
+    def store_row(self,rtrow,*objects,**kwargs):
         '''
-        Function to return a dictionary of event values to be written to the ntuple.
+        Function to fill a row of event values to be written to the ntuple.
+        kwargs:
+            ntupleRow   the RowBuffer to fill (default a new row of the writer)
         '''
-        ntupleRow = {}
+        ntupleRow = kwargs.pop('ntupleRow',None)
+        if ntupleRow is None: ntupleRow = self.writer.new_row()
 
         ntupleRow["select.passTight"] = int(self.pass_selection(rtrow))
-        ntupleRow["select.passLoose"] = int(self.pass_preselection(rtrow))
-        numObjs = len(self.final_states[0])
-        finalStateObjects ='emtjgn'
-        allowedObjects = ''
-        for fsObj in finalStateObjects:
-            for fs in self.final_states:
-                if fsObj in fs:
-                    allowedObjects += fsObj
-                    break
-        numObjTypes = len(allowedObjects)
-        for prompts in list(product(range(numObjs+1),repeat=numObjTypes)):
-            if sum(prompts) > numObjs: continue
-            promptString = ''.join([str(x) for x in prompts])
-            promptDict = {}
-            for o in range(len(allowedObjects)):
-                promptDict[allowedObjects[o]] = prompts[o]
-            ntupleRow["select.pass_%s"%promptString] = int(self.npass(rtrow,promptDict,**self.getIdArgs('Tight')))
+        passLoose = self.pass_preselection(rtrow)
+        ntupleRow["select.passLoose"] = int(passLoose)
+        # equivalent to npass for each prompt combination, the counts are computed once
+        for key in self.promptKeys.itervalues():
+            ntupleRow[key] = 0
+        if passLoose:
+            tight = self.idBits['Tight']
+            masks = [self.id_mask(rtrow,obj) for obj in self.objects]
+            counts = tuple(sum(1 for obj, mask in zip(self.objects, masks) if obj[0]==flav and mask & tight)
+                           for flav in self.promptObjects)
+            if counts in self.promptKeys: ntupleRow[self.promptKeys[counts]] = 1
         for altId in self.alternateIds:
-            ntupleRow["select.pass_%s"%altId] = int(self.ID(rtrow,*self.objects,**self.alternateIdMap[altId]))
+            ntupleRow["select.pass_%s"%altId] = int(self.pass_id(rtrow,altId,*self.objects))
 
         
         ntupleRow["event.evt"] = int(rtrow.evt)
         ntupleRow["event.lumi"] = int(rtrow.lumi)
         ntupleRow["event.run"] = int(rtrow.run)
         ntupleRow["event.nvtx"] = int(rtrow.nvtx)
-        #ntupleRow["event.lep_scale"] = float(self.lepscaler.scale_factor(rtrow, *objects, tight=True))
-        #ntupleRow["event.pu_weight"] = float(self.pu_weights.weight(rtrow))
-        ntupleRow["event.lep_scale"] = float(1.)
-        ntupleRow["event.pu_weight"] = float(1.)
+        # event weights with their up and down variations if available (see systematics.py)
+        for fun, keys in self.weights:
+            for key, weight in zip(keys, fun(self, rtrow, objects)):
+                ntupleRow[key] = float(weight)
 
         channelString = ''
         for x in objects: channelString += x[0]
         ntupleRow["channel.channel"] = channelString
 
         ntupleRow["finalstate.mass"] = float(rtrow.Mass)
-        ntupleRow["finalstate.sT"] = float(sum([getattr(rtrow, "%sPt" % x) for x in objects]))
+        plan = self.plan
+        index = plan.index
+        ntupleRow["finalstate.sT"] = float(sum([getattr(rtrow, plan.Pt[index[x]]) for x in objects]))
         ntupleRow["finalstate.met"] = float(rtrow.pfMetEt)
         ntupleRow["finalstate.metPhi"] = float(rtrow.pfMetPhi)
         ntupleRow["finalstate.jetVeto20"] = int(rtrow.jetVeto20)
@@ -319,31 +1005,33 @@ class AnalyzerBase(object):
             ntupleRow["finalstate.vbfPt2"] = float(rtrow.vbfj2pt)
             ntupleRow["finalstate.vbfEta1"] = float(rtrow.vbfj1eta)
             ntupleRow["finalstate.vbfEta2"] = float(rtrow.vbfj2eta)
-            ntupleRow["finalstate.centralJetVeto20"] = float(rtrow.vbfJetVeto20)
-            ntupleRow["finalstate.centralJetVeto30"] = float(rtrow.vbfJetVeto30)
+            ntupleRow["finalstate.centralJetVeto20"] = int(rtrow.vbfJetVeto20)
+            ntupleRow["finalstate.centralJetVeto30"] = int(rtrow.vbfJetVeto30)
 
         def store_state(rtrow,ntupleRow,state,theObjects):
             objStart = 0
             for i in state:
                 numObjects = len([ x for x in self.object_definitions[i] if x != 'n']) if theObjects else 0
                 finalObjects = theObjects[objStart:objStart+numObjects]
-                orderedFinalObjects = sorted(finalObjects, key = lambda x: getattr(rtrow,"%sPt" % x))
+                finalIndices = [index[x] for x in finalObjects]
+                orderedFinalIndices = sorted(finalIndices, key = lambda x: getattr(rtrow,plan.Pt[x]))
                 if len(self.object_definitions[i]) == 1:
                     ntupleRow["%s.mass" %i] = float(-9)
-                    ntupleRow["%s.sT" %i] = float(getattr(rtrow, "%sPt" % finalObjects[0])) if theObjects else float(-9)
+                    ntupleRow["%s.sT" %i] = float(getattr(rtrow, plan.Pt[finalIndices[0]])) if theObjects else float(-9)
                     ntupleRow["%s.dPhi" %i] = float(-9)
                     ntupleRow["%s.dR" %i] = float(-9)
                     ntupleRow["%sFlv.Flv" %i] = finalObjects[0][0] if theObjects else 'a'
                 elif 'n' == self.object_definitions[i][1]:
-                    ntupleRow["%s.mass" %i] = float(getattr(rtrow, "%sMtToPFMET" % finalObjects[0])) if theObjects else float(-9)
-                    ntupleRow["%s.sT" %i] = float(getattr(rtrow, "%sPt" % finalObjects[0]) + rtrow.pfMetEt) if theObjects else float(-9)
-                    ntupleRow["%s.dPhi" %i] = float(getattr(rtrow, "%sToMETDPhi" % finalObjects[0])) if theObjects else float(-9)
+                    ntupleRow["%s.mass" %i] = float(getattr(rtrow, plan.MtToPFMET[finalIndices[0]])) if theObjects else float(-9)
+                    ntupleRow["%s.sT" %i] = float(getattr(rtrow, plan.Pt[finalIndices[0]]) + rtrow.pfMetEt) if theObjects else float(-9)
+                    ntupleRow["%s.dPhi" %i] = float(getattr(rtrow, plan.ToMETDPhi[finalIndices[0]])) if theObjects else float(-9)
                     ntupleRow["%sFlv.Flv" %i] = finalObjects[0][0] if theObjects else 'a'
                 else:
-                    ntupleRow["%s.mass" %i] = float(getattr(rtrow, "%s_%s_Mass" % (finalObjects[0], finalObjects[1]))) if theObjects else float(-9)
-                    ntupleRow["%s.sT" %i]   = float(sum([getattr(rtrow, "%sPt" % x) for x in finalObjects])) if theObjects else float(-9)
-                    ntupleRow["%s.dPhi" %i] = float(getattr(rtrow, "%s_%s_DPhi" % (finalObjects[0], finalObjects[1]))) if theObjects else float(-9)
-                    ntupleRow["%s.dR" %i] = float(getattr(rtrow, "%s_%s_DR" % (finalObjects[0], finalObjects[1]))) if theObjects else float(-9)
+                    if theObjects: a, b = finalIndices
+                    ntupleRow["%s.mass" %i] = float(getattr(rtrow, plan.Mass[a][b])) if theObjects else float(-9)
+                    ntupleRow["%s.sT" %i]   = float(sum([getattr(rtrow, plan.Pt[x]) for x in finalIndices])) if theObjects else float(-9)
+                    ntupleRow["%s.dPhi" %i] = float(getattr(rtrow, plan.DPhi[a][b])) if theObjects else float(-9)
+                    ntupleRow["%s.dR" %i] = float(getattr(rtrow, plan.DR[a][b])) if theObjects else float(-9)
                     ntupleRow["%sFlv.Flv" %i] = finalObjects[0][0] + finalObjects[1][0] if theObjects else 'aa'
                 objCount = 0
                 for obj in self.object_definitions[i]:
@@ -352,24 +1040,25 @@ class AnalyzerBase(object):
                         ntupleRow["%s.metPhi" %i] = float(rtrow.pfMetPhi) if theObjects else float(-9)
                     else:
                         objCount += 1
-                        ntupleRow["%s.Pt%i" % (i,objCount)] = float(getattr(rtrow, "%sPt" % orderedFinalObjects[objCount-1])) if theObjects else float(-9)
-                        ntupleRow["%s.Eta%i" % (i,objCount)] = float(getattr(rtrow, "%sEta" % orderedFinalObjects[objCount-1])) if theObjects else float(-9)
-                        ntupleRow["%s.Phi%i" % (i,objCount)] = float(getattr(rtrow, "%sPhi" % orderedFinalObjects[objCount-1])) if theObjects else float(-9)
-                        if orderedFinalObjects[objCount-1][0]=='e': isoVar = 'RelPFIsoRho'
-                        if orderedFinalObjects[objCount-1][0]=='m': isoVar = 'RelPFIsoDBDefault'
-                        isoVal = float(getattr(rtrow, "%s%s" % (orderedFinalObjects[objCount-1], isoVar))) if orderedFinalObjects[objCount-1][0] in 'em' and theObjects else float(-9.)
+                        if theObjects:
+                            x = orderedFinalIndices[objCount-1]
+                            obj = plan.objects[x]
+                        ntupleRow["%s.Pt%i" % (i,objCount)] = float(getattr(rtrow, plan.Pt[x])) if theObjects else float(-9)
+                        ntupleRow["%s.Eta%i" % (i,objCount)] = float(getattr(rtrow, plan.Eta[x])) if theObjects else float(-9)
+                        ntupleRow["%s.Phi%i" % (i,objCount)] = float(getattr(rtrow, plan.Phi[x])) if theObjects else float(-9)
+                        isoVal = float(getattr(rtrow, plan.Iso[x])) if theObjects and plan.Iso[x] else float(-9.)
                         ntupleRow["%s.Iso%i" % (i,objCount)] = isoVal
-                        ntupleRow["%s.Chg%i" % (i,objCount)] = float(getattr(rtrow, "%sCharge" % orderedFinalObjects[objCount-1])) if theObjects else float(-9)
-                        ntupleRow["%s.PassTight%i" % (i,objCount)] = float(self.ID(rtrow,orderedFinalObjects[objCount-1],**self.getIdArgs('Tight'))) if theObjects else float(-9)
+                        ntupleRow["%s.Chg%i" % (i,objCount)] = int(getattr(rtrow, plan.Charge[x])) if theObjects else -9
+                        ntupleRow["%s.PassTight%i" % (i,objCount)] = int(self.pass_id(rtrow,'Tight',obj)) if theObjects else -9
                         # manually add w z deltaRs
-                        if i=='w1':
+                        if i=='w1' and theObjects:
                             oZ1 = ordered(theObjects[0],theObjects[2])
                             oZ2 = ordered(theObjects[1],theObjects[2])
-                            ntupleRow["w1.dR1_z1_1"] = float(getattr(rtrow,"%s_%s_DR" % (oZ1[0],oZ1[1])))
-                            ntupleRow["w1.dR1_z1_2"] = float(getattr(rtrow,"%s_%s_DR" % (oZ2[0],oZ2[1])))
+                            ntupleRow["w1.dR1_z1_1"] = float(getattr(rtrow,plan.DR[index[oZ1[0]]][index[oZ1[1]]]))
+                            ntupleRow["w1.dR1_z1_2"] = float(getattr(rtrow,plan.DR[index[oZ2[0]]][index[oZ2[1]]]))
                         # do alternate IDs
                         for altId in self.alternateIds:
-                            ntupleRow["%s.pass_%s_%i"%(i,altId,objCount)] = int(self.ID(rtrow,orderedFinalObjects[objCount-1],**self.alternateIdMap[altId]) if theObjects else float(-9))
+                            ntupleRow["%s.pass_%s_%i"%(i,altId,objCount)] = int(self.pass_id(rtrow,altId,obj) if theObjects else float(-9))
                 objStart += numObjects
 
 
@@ -386,8 +1075,9 @@ class AnalyzerBase(object):
         lepCount = 0
         jetCount = 0
         phoCount = 0
-        orderedAllObjects = sorted(objects, key = lambda x: getattr(rtrow,"%sPt" % x))
-        for obj in orderedAllObjects:
+        orderedAllIndices = sorted([index[x] for x in objects], key = lambda x: getattr(rtrow,plan.Pt[x]))
+        for x in orderedAllIndices:
+            obj = plan.objects[x]
             if obj[0] in 'emt':
                 charName = 'l'
                 lepCount += 1
@@ -400,14 +1090,12 @@ class AnalyzerBase(object):
                 charName = 'g'
                 phoCount += 1
                 objCount = phoCount
-            ntupleRow["%s%i.Pt" % (charName,objCount)] = float(getattr(rtrow, "%sPt" % obj))
-            ntupleRow["%s%i.Eta" % (charName,objCount)] = float(getattr(rtrow, "%sEta" % obj))
-            ntupleRow["%s%i.Phi" % (charName,objCount)] = float(getattr(rtrow, "%sPhi" % obj))
-            if obj[0]=='e': isoVar = 'RelPFIsoRho'
-            if obj[0]=='m': isoVar = 'RelPFIsoDBDefault'
-            ntupleRow["%s%i.Iso" % (charName,objCount)] = float(getattr(rtrow, "%s%s" % (obj, isoVar))) if obj[0] in 'em' else float(-1.)
-            ntupleRow["%s%i.Chg" % (charName,objCount)] = float(getattr(rtrow, "%sCharge" % obj))
-            ntupleRow["%s%i.PassTight" % (charName,objCount)] = float(self.ID(rtrow,obj,**self.getIdArgs('Tight')))
+            ntupleRow["%s%i.Pt" % (charName,objCount)] = float(getattr(rtrow, plan.Pt[x]))
+            ntupleRow["%s%i.Eta" % (charName,objCount)] = float(getattr(rtrow, plan.Eta[x]))
+            ntupleRow["%s%i.Phi" % (charName,objCount)] = float(getattr(rtrow, plan.Phi[x]))
+            ntupleRow["%s%i.Iso" % (charName,objCount)] = float(getattr(rtrow, plan.Iso[x])) if plan.Iso[x] else float(-1.)
+            ntupleRow["%s%i.Chg" % (charName,objCount)] = int(getattr(rtrow, plan.Charge[x]))
+            ntupleRow["%s%i.PassTight" % (charName,objCount)] = int(self.pass_id(rtrow,'Tight',obj))
             ntupleRow["%s%iFlv.Flv" % (charName,objCount)] = obj[0]
 
         return ntupleRow
@@ -416,17 +1104,17 @@ class AnalyzerBase(object):
         '''
         Function to write the ntuple row to the tree.
         '''
-        for key,val in nrow.iteritems():
-            branch, var = key.split('.')
-            setattr(self.branches[branch],var,val)
+        self.writer.write(nrow)
 
     def pass_preselection(self, rtrow):
         '''
         Wrapper for preselection defined by user.
         '''
         if 'preselection' in self.cache: return self.cache['preselection']
-        cuts = self.preselection(rtrow)
-        cutResults,self.num = cuts.evaluate(rtrow)
+        cuts = self.preselectionCuts
+        # cuts already passed in the columnar preselection of analyze_chunk
+        self.num = cuts.first_failing(rtrow, self.cache.get('preselectionStart', 0))
+        cutResults = self.num==cuts.numCuts
         self.cache['preselection'] = cutResults
         return cutResults
 
@@ -436,8 +1124,9 @@ class AnalyzerBase(object):
         is the loose selection for fake rate method).
         '''
         if 'selection' in self.cache: return self.cache['selection']
-        cuts = self.selection(rtrow)
-        cutResults,self.num = cuts.evaluate(rtrow)
+        cuts = self.selectionCuts
+        self.num = cuts.first_failing(rtrow)
+        cutResults = self.num==cuts.numCuts
         self.cache['selection'] = cutResults
         return cutResults
 
@@ -471,10 +1160,83 @@ class AnalyzerBase(object):
                 num += self.ID(rtrow,obj,**kwargs)
         return num
 
+    @staticmethod
+    def id_key(idArgs):
+        '''
+        Hashable form of the kwargs of an ID working point.
+        '''
+        return (tuple(sorted(idArgs.get('idDef',{}).items())), tuple(sorted(idArgs.get('isoCut',{}).items())))
+
+    def id_working_points(self):
+        '''
+        The named ID working points encoded in the per object ID bitmask.
+        '''
+        workingPoints = [('Tight', self.getIdArgs('Tight')), ('Loose', self.getIdArgs('Loose'))]
+        workingPoints += [(altId, self.alternateIdMap[altId]) for altId in self.alternateIds]
+        return workingPoints
+
+    def build_id_bits(self):
+        '''
+        Assign a bit to each working point of id_working_points and plan the evaluation
+        per flavor: the distinct ID types to evaluate and, for each bit, the ID type and
+        isolation cut it requires (None if the working point does not cut on the flavor).
+        '''
+        self.idBits = {}
+        self.idKeyBits = {}
+        self.idFlavorPlans = {}
+        workingPoints = self.id_working_points()
+        for i, (name, idArgs) in enumerate(workingPoints):
+            bit = 1 << i
+            self.idBits[name] = bit
+            self.idKeyBits.setdefault(self.id_key(idArgs), bit)
+        for flav in 'emtjg':
+            idTypes = []
+            bits = []
+            for name, idArgs in workingPoints:
+                idType = idArgs.get('idDef',{}).get(flav)
+                if idType is not None and idType not in idTypes: idTypes.append(idType)
+                isoCut = idArgs.get('isoCut',{}).get(flav) if flav not in 'tjgn' else None
+                bits.append((self.idBits[name], idTypes.index(idType) if idType is not None else None, isoCut))
+            self.idFlavorPlans[flav] = (idTypes, bits)
+
+    def id_mask(self, rtrow, obj):
+        '''
+        Bitmask of the working points passed by an object in the current row,
+        computed once per row.
+        '''
+        i = self.plan.index[obj]
+        mask = self.idMasks[i]
+        if mask is None:
+            idTypes, bits = self.idFlavorPlans[obj[0]]
+            passId = [lepId.lep_id(rtrow,self.period,obj,idType=idType) for idType in idTypes]
+            iso = getattr(rtrow, self.plan.Iso[i]) if self.plan.Iso[i] and any(b[2] is not None for b in bits) else None
+            mask = 0
+            for bit, idIndex, isoCut in bits:
+                if idIndex is not None and not passId[idIndex]: continue
+                if isoCut is not None and iso > isoCut: continue
+                mask |= bit
+            self.idMasks[i] = mask
+        return mask
+
+    def pass_id(self,rtrow,name,*objects):
+        '''
+        Check that all objects pass a named working point of id_working_points.
+        '''
+        bit = self.idBits[name]
+        for obj in objects:
+            if not self.id_mask(rtrow,obj) & bit: return False
+        return True
+
     def ID(self,rtrow,*objects,**kwargs):
         '''
-        An ID accessor method.
+        An ID accessor method. Working points of id_working_points are looked up
+        in the per object ID bitmask.
         '''
+        bit = self.idKeyBits.get(self.id_key(kwargs))
+        if bit is not None:
+            for obj in objects:
+                if not self.id_mask(rtrow,obj) & bit: return False
+            return True
         idDef = kwargs.pop('idDef',{})
         isoCut = kwargs.pop('isoCut',{})
         for obj in objects:
@@ -489,10 +1251,26 @@ class AnalyzerBase(object):
         if isoCut:
             for obj in objects:
                 if obj[0] not in isoCut: continue
-                if obj[0] == 'e':
-                    isotype = "RelPFIsoRho"
-                if obj[0] == 'm':
-                    isotype = "RelPFIsoDBDefault"
                 if obj[0] in 'tjgn': continue # no iso cut on tau
-                if getattr(rtrow, '%s%s' %(obj,isotype)) > isoCut[obj[0]]: return False
+                if getattr(rtrow, self.plan.Iso[self.plan.index[obj]]) > isoCut[obj[0]]: return False
         return True
+
+    def ID_columnar(self,chunk,*objects,**kwargs):
+        '''
+        Columnar version of ID, returns a boolean array over the chunk or None if
+        one of the requested IDs has no columnar implementation.
+        '''
+        idDef = kwargs.pop('idDef',{})
+        isoCut = kwargs.pop('isoCut',{})
+        result = np.ones(len(chunk), dtype=bool)
+        for obj in objects:
+            if obj[0] not in idDef: continue
+            passId = lepId.lep_id_columnar(chunk,self.period,obj,idType=idDef[obj[0]])
+            if passId is None: return None
+            result &= passId
+        if isoCut:
+            for obj in objects:
+                if obj[0] not in isoCut: continue
+                if obj[0] in 'tjgn': continue # no iso cut on tau
+                result &= ~(chunk[self.plan.Iso[self.plan.index[obj]]] > isoCut[obj[0]])
+        return result
@@ -26,6 +26,15 @@ class AnalyzerHpp3l(AnalyzerBase):
         QCD suppression: M(ll) > 12
     '''
 
+    # cut thresholds read by the row-wise and the columnar cuts
+    fiducialCuts = { # (pt, |eta|)
+        'e': (20.0, 2.5), # pt CBID: 20, MVA trig: 10, MVA nontrig: 5
+        'm': (20.0, 2.4),
+        't': (20.0, 2.3),
+    }
+    triggerThresholds = (25.0, 15.0) # leading, subleading pt
+    qcdMassCut = 12.0
+
     def __init__(self, sample_location, out_file, period, **kwargs):
         runTau = kwargs.pop('runTau',False)
         runTau=True
@@ -55,20 +64,18 @@ class AnalyzerHpp3l(AnalyzerBase):
         '''
         Select candidate objects
         '''
-        cands = []
-        for l in permutations(self.objects):
-            if lep_order(l[0], l[1]):
-                continue
-
-            SS1 = getattr(rtrow, "%s_%s_SS" % (l[0], l[1])) > 0 # select same sign
-            OS = getattr(rtrow, "%sCharge" % l[0]) != getattr(rtrow, "%sCharge" % l[2]) # select opposite sign
+        plan = self.plan
+        table = self.pairing_table((0,1))
+        SS = table.pair_values(rtrow, plan.SS)
+        charge = table.object_values(rtrow, plan.Charge)
 
-            if SS1 and OS:
-                cands.append([[0],list(l)]) # minimization is by veto, not variable
+        SS1 = table.at_pair(SS,0) > 0 # select same sign
+        OS = table.at(charge,0) != table.at(charge,2) # select opposite sign
 
-        if not len(cands): return 0
+        good = np.flatnonzero(SS1 & OS)
+        if not len(good): return 0
 
-        return (cands[0])
+        return [[0], table.names(good[0])] # minimization is by veto, not variable
 
     # override choose_alternative_objects
     def choose_alternative_objects(self, rtrow, state):
@@ -77,21 +84,18 @@ class AnalyzerHpp3l(AnalyzerBase):
         '''
         # WZ
         if state == ['z1', 'w1']:
-            bestZDiff = float('inf')
-            bestLeptons = []
+            plan = self.plan
+            table = self.pairing_table((0,1))
+            SS = table.pair_values(rtrow, plan.SS)
+            mass = table.pair_values(rtrow, plan.Mass)
 
-            for l in permutations(self.objects):
-                if lep_order(l[0],l[1]):
-                    continue
+            os1 = table.at_pair(SS,0) < 0.5
+            zdiff = np.abs(table.at_pair(mass,0)-ZMASS)
 
-                os1 = getattr(rtrow,'%s_%s_SS' % (l[0], l[1])) < 0.5
-                m1 = getattr(rtrow,'%s_%s_Mass' % (l[0], l[1]))
+            best = first_min(zdiff, table.sameFlavor[0] & os1)
+            if best < 0: return []
 
-                if l[0][0] == l[1][0] and os1 and abs(m1-ZMASS) < bestZDiff:
-                    bestZDiff = abs(m1-ZMASS)
-                    bestLeptons = l
-
-            return bestLeptons
+            return tuple(table.names(best))
 
     # overide good_to_store
     @staticmethod
@@ -122,6 +126,12 @@ class AnalyzerHpp3l(AnalyzerBase):
         cuts.add(self.qcd_rejection)
         return cuts
 
+    def fsa_branches(self, final_state):
+        branches = super(AnalyzerHpp3l, self).fsa_branches(final_state)
+        branches.update(self.get_triggers())
+        branches.update(['%sAbsEta' % l for l in self.enumerate_objects(final_state)])
+        return branches
+
     def getIdArgs(self,type):
         kwargs = {}
         if type=='Tight':
@@ -146,7 +156,7 @@ class AnalyzerHpp3l(AnalyzerBase):
             }
         return kwargs
 
-    def trigger(self, rtrow):
+    def get_triggers(self):
         triggers = ["mu17ele8isoPass", "mu8ele17isoPass",
                     "doubleETightPass", "tripleEPass",
                     "doubleMuPass", "doubleMuTrkPass"]
@@ -155,44 +165,64 @@ class AnalyzerHpp3l(AnalyzerBase):
             triggers = ['muEPass', 'eMuPass', 'doubleMuPass',
                         'doubleEPass', 'tripleEPass']
 
-        for t in triggers:
+        return triggers
+
+    def trigger(self, rtrow):
+        for t in self.get_triggers():
             if getattr(rtrow,t)>0:
                 return True
         return False
 
+    def trigger_columnar(self, chunk):
+        return np.any([chunk[t]>0 for t in self.get_triggers()], axis=0)
+
     def fiducial(self, rtrow):
-        for l in self.objects:
-            if l[0]=='e':
-                ptcut = 20.0 # CBID: 20, MVA trig: 10, MVA nontrig: 5
-                etacut = 2.5
-            if l[0]=='m':
-                ptcut = 20.0 # ???
-                etacut = 2.4
-            if l[0]=='t':
-                ptcut = 20.0 # 20
-                etacut = 2.3
-            if getattr(rtrow, '%sPt' % l) < ptcut:
+        for i, l in enumerate(self.objects):
+            ptcut, etacut = self.fiducialCuts[l[0]]
+            if getattr(rtrow, self.plan.Pt[i]) < ptcut:
                 return False
-            if getattr(rtrow, '%sAbsEta' % l) > etacut:
+            if getattr(rtrow, self.plan.AbsEta[i]) > etacut:
                 return False
         return True
 
+    def fiducial_columnar(self, chunk):
+        result = np.ones(len(chunk), dtype=bool)
+        for i, l in enumerate(self.objects):
+            ptcut, etacut = self.fiducialCuts[l[0]]
+            result &= ~(chunk[self.plan.Pt[i]] < ptcut)
+            result &= ~(chunk[self.plan.AbsEta[i]] > etacut)
+        return result
+
     def ID_loose(self, rtrow):
-        return self.ID(rtrow,*self.objects,**self.getIdArgs('Loose'))
+        return self.pass_id(rtrow,'Loose',*self.objects)
+
+    def ID_loose_columnar(self, chunk):
+        return self.ID_columnar(chunk,*self.objects,**self.getIdArgs('Loose'))
 
     def ID_tight(self, rtrow):
-        return self.ID(rtrow,*self.objects,**self.getIdArgs('Tight'))
+        return self.pass_id(rtrow,'Tight',*self.objects)
 
     def trigger_threshold(self, rtrow):
-        pts = [getattr(rtrow, "%sPt" % l) for l in self.objects]
+        pts = [getattr(rtrow, pt) for pt in self.plan.Pt]
         pts.sort(reverse=True)
-        return pts[0] > 25.0 and pts[1] > 15.0
+        return pts[0] > self.triggerThresholds[0] and pts[1] > self.triggerThresholds[1]
+
+    def trigger_threshold_columnar(self, chunk):
+        pts = np.sort([chunk[pt] for pt in self.plan.Pt], axis=0)
+        return (pts[-1] > self.triggerThresholds[0]) & (pts[-2] > self.triggerThresholds[1])
 
     def qcd_rejection(self, rtrow):
-        qcd_pass = [getattr(rtrow, "%s_%s_Mass" % (l[0], l[1])) > 12.0
-                    for l in combinations(self.objects, 2)]
+        mass = self.plan.Mass
+        qcd_pass = [getattr(rtrow, mass[i][j]) > self.qcdMassCut
+                    for i, j in combinations(range(len(self.objects)), 2)]
         return all(qcd_pass)
 
+    def qcd_rejection_columnar(self, chunk):
+        mass = self.plan.Mass
+        qcd_pass = [chunk[mass[i][j]] > self.qcdMassCut
+                    for i, j in combinations(range(len(self.objects)), 2)]
+        return np.all(qcd_pass, axis=0)
+
 #######################
 ###### Fake rate ######
 #######################
@@ -200,6 +230,8 @@ class AnalyzerFakeRate(AnalyzerHpp3l):
     '''
     A class to produce ntuples to calculate the fakerate for the leptons.
     '''
+    zWindow = 20. # |M(ll)-M(Z)|, read by the row-wise and the columnar z_selection
+
     def __init__(self, sample_location, out_file, period, **kwargs):
         super(AnalyzerFakeRate, self).__init__(sample_location, out_file, period, **kwargs)
         self.channel = 'FakeRate'
@@ -219,26 +251,20 @@ class AnalyzerFakeRate(AnalyzerHpp3l):
         '''
         Select candidate objects
         '''
-        cands = []
-        bestZDiff = float('inf')
-        for l in permutations(self.objects):
-            if lep_order(l[0], l[1]):
-                continue
-
-            # first two must be the Z candidate
-            OS1 = getattr(rtrow, "%s_%s_SS" % (l[0], l[1])) < 0.5 # select opposite sign
-            SF1 = l[0][0]==l[1][0] # select same flavor
-            massdiff = abs(getattr(rtrow,'%s_%s_Mass' % (l[0], l[1]))-ZMASS)
+        plan = self.plan
+        table = self.pairing_table((0,1))
+        SS = table.pair_values(rtrow, plan.SS)
+        mass = table.pair_values(rtrow, plan.Mass)
 
-            if OS1 and SF1:
-                cands.append([massdiff,list(l)])
+        # first two must be the Z candidate
+        OS1 = table.at_pair(SS,0) < 0.5 # select opposite sign
+        SF1 = table.sameFlavor[0] # select same flavor
+        massdiff = np.abs(table.at_pair(mass,0)-ZMASS)
 
-        if not len(cands): return 0
+        best = first_min(massdiff, OS1 & SF1)
+        if best < 0: return 0
 
-        cands.sort(key=lambda x: x[0])
-        massdiff, leps = cands[0]
-
-        return ([massdiff], leps)
+        return ([float(massdiff[best])], table.names(best))
 
     # reoveride
     def choose_alternative_objects(self, rtorw, state):
@@ -276,8 +302,12 @@ class AnalyzerFakeRate(AnalyzerHpp3l):
 
     def z_selection(self,rtrow):
         '''Select Z candidate'''
-        m1 = getattr(rtrow,'%s_%s_Mass' % (self.objects[0], self.objects[1]))
-        return abs(m1-ZMASS)<20.
+        m1 = getattr(rtrow,self.plan.Mass[0][1])
+        return abs(m1-ZMASS)<self.zWindow
+
+    def z_selection_columnar(self,chunk):
+        m1 = chunk[self.plan.Mass[0][1]]
+        return np.abs(m1-ZMASS)<self.zWindow
 
 
 
@@ -26,6 +26,15 @@ class AnalyzerHpp4l(AnalyzerBase):
         QCD suppression: M(ll) > 12
     '''
 
+    # cut thresholds read by the row-wise and the columnar cuts
+    fiducialCuts = { # (pt, |eta|)
+        'e': (20.0, 2.5), # pt CBID: 20, MVA trig: 10, MVA nontrig: 5
+        'm': (20.0, 2.4),
+        't': (20.0, 2.3),
+    }
+    triggerThresholds = (25.0, 15.0) # leading, subleading pt
+    qcdMassCut = 12.0
+
     def __init__(self, sample_location, out_file, period, **kwargs):
         runTau = kwargs.pop('runTau',False)
         runTau = True
@@ -56,27 +65,21 @@ class AnalyzerHpp4l(AnalyzerBase):
         '''
         Select candidate objects
         '''
-        cands = []
-        for l in permutations(self.objects):
-            if lep_order(l[0], l[1]) or lep_order(l[2], l[3]):
-                continue
-
-            SS1 = getattr(rtrow, "%s_%s_SS" % (l[0], l[1])) > 0 # select same sign
-            mass1 = getattr(rtrow, "%s_%s_Mass" % (l[0], l[1])) # select mass
-            SS2 = getattr(rtrow, "%s_%s_SS" % (l[2], l[3])) > 0 # select same sign
-            mass2 = getattr(rtrow, "%s_%s_Mass" % (l[2], l[3])) # select mass
-            OS = getattr(rtrow, "%sCharge" % l[0]) != getattr(rtrow, "%sCharge" % l[2]) # select opposite sign
-            massdiff = abs(mass1-mass2)
+        plan = self.plan
+        table = self.pairing_table((0,1),(2,3))
+        SS = table.pair_values(rtrow, plan.SS)
+        mass = table.pair_values(rtrow, plan.Mass)
+        charge = table.object_values(rtrow, plan.Charge)
 
-            if SS1 and SS2 and OS:
-                cands.append([massdiff,list(l)]) # minimization is by mass diff
+        SS1 = table.at_pair(SS,0) > 0 # select same sign
+        SS2 = table.at_pair(SS,1) > 0 # select same sign
+        OS = table.at(charge,0) != table.at(charge,2) # select opposite sign
+        massdiff = np.abs(table.at_pair(mass,0)-table.at_pair(mass,1))
 
-        if not len(cands): return 0
+        best = first_min(massdiff, SS1 & SS2 & OS) # minimization is by mass diff
+        if best < 0: return 0
 
-        cands.sort(key=lambda x: x[0])
-        massdiff, leps = cands[0]
-
-        return ([massdiff], leps)
+        return ([float(massdiff[best])], table.names(best))
 
     # override choose_alternative_objects
     def choose_alternative_objects(self, rtrow, state):
@@ -85,30 +88,24 @@ class AnalyzerHpp4l(AnalyzerBase):
         '''
         # ZZ
         if state == ['z1', 'z2']:
-            bestZDiff = float('inf')
-            bestSt = 0
-            bestLeptons = []
-
-            for l in permutations(self.objects):
-                if lep_order(l[0],l[1]) or lep_order(l[2],l[3]):
-                    continue
+            plan = self.plan
+            table = self.pairing_table((0,1),(2,3))
+            SS = table.pair_values(rtrow, plan.SS)
+            mass = table.pair_values(rtrow, plan.Mass)
+            pt = table.object_values(rtrow, plan.Pt)
 
-                os1 = getattr(rtrow,'%s_%s_SS' % (l[0], l[1])) < 0.5
-                m1 = getattr(rtrow,'%s_%s_Mass' % (l[0], l[1]))
-                os2 = getattr(rtrow,'%s_%s_SS' % (l[2], l[3])) < 0.5
-                st2 = getattr(rtrow,'%sPt' %l[2]) + getattr(rtrow,'%sPt' %l[3])
+            os1 = table.at_pair(SS,0) < 0.5
+            os2 = table.at_pair(SS,1) < 0.5
+            zdiff = np.abs(table.at_pair(mass,0)-ZMASS)
+            st2 = table.at(pt,2) + table.at(pt,3)
 
-                if l[0][0] == l[1][0] and os1 and l[2][0]==l[3][0] and os2:
-                    if abs(m1-ZMASS) < bestZDiff:
-                        bestZDiff = abs(m1-ZMASS)
-                        bestSt = st2
-                        bestLeptons = l
-                    elif abs(m1-ZMASS)==bestZDiff and st2>bestSt:
-                        bestZDiff = abs(m1-ZMASS)
-                        bestSt = st2
-                        bestLeptons = l
+            # closest to the Z mass, ties broken by the larger pt sum of the second pair
+            good = np.flatnonzero(table.sameFlavor[0] & os1 & table.sameFlavor[1] & os2)
+            if not len(good): return []
+            closest = good[zdiff[good]==zdiff[good].min()]
+            best = closest[np.argmax(st2[closest])]
 
-            return bestLeptons
+            return tuple(table.names(best))
 
 
     ###########################
@@ -132,6 +129,12 @@ class AnalyzerHpp4l(AnalyzerBase):
         cuts.add(self.qcd_rejection)
         return cuts
 
+    def fsa_branches(self, final_state):
+        branches = super(AnalyzerHpp4l, self).fsa_branches(final_state)
+        branches.update(self.get_triggers())
+        branches.update(['%sAbsEta' % l for l in self.enumerate_objects(final_state)])
+        return branches
+
     def getIdArgs(self,type):
         kwargs = {}
         if type=='Tight':
@@ -156,7 +159,7 @@ class AnalyzerHpp4l(AnalyzerBase):
             }
         return kwargs
 
-    def trigger(self, rtrow):
+    def get_triggers(self):
         triggers = ["mu17ele8isoPass", "mu8ele17isoPass",
                     "doubleETightPass", "tripleEPass",
                     "doubleMuPass", "doubleMuTrkPass"]
@@ -165,44 +168,64 @@ class AnalyzerHpp4l(AnalyzerBase):
             triggers = ['muEPass', 'eMuPass', 'doubleMuPass',
                         'doubleEPass', 'tripleEPass']
 
-        for t in triggers:
+        return triggers
+
+    def trigger(self, rtrow):
+        for t in self.get_triggers():
             if getattr(rtrow,t)>0:
                 return True
         return False
 
+    def trigger_columnar(self, chunk):
+        return np.any([chunk[t]>0 for t in self.get_triggers()], axis=0)
+
     def fiducial(self, rtrow):
-        for l in self.objects:
-            if l[0]=='e':
-                ptcut = 20.0 # CBID: 20, MVA trig: 10, MVA nontrig: 5
-                etacut = 2.5
-            if l[0]=='m':
-                ptcut = 20.0 # ???
-                etacut = 2.4
-            if l[0]=='t':
-                ptcut = 20.0 # 20
-                etacut = 2.3
-            if getattr(rtrow, '%sPt' % l) < ptcut:
+        for i, l in enumerate(self.objects):
+            ptcut, etacut = self.fiducialCuts[l[0]]
+            if getattr(rtrow, self.plan.Pt[i]) < ptcut:
                 return False
-            if getattr(rtrow, '%sAbsEta' % l) > etacut:
+            if getattr(rtrow, self.plan.AbsEta[i]) > etacut:
                 return False
         return True
 
+    def fiducial_columnar(self, chunk):
+        result = np.ones(len(chunk), dtype=bool)
+        for i, l in enumerate(self.objects):
+            ptcut, etacut = self.fiducialCuts[l[0]]
+            result &= ~(chunk[self.plan.Pt[i]] < ptcut)
+            result &= ~(chunk[self.plan.AbsEta[i]] > etacut)
+        return result
+
     def ID_loose(self, rtrow):
-        return self.ID(rtrow,*self.objects,**self.getIdArgs('Loose'))
+        return self.pass_id(rtrow,'Loose',*self.objects)
+
+    def ID_loose_columnar(self, chunk):
+        return self.ID_columnar(chunk,*self.objects,**self.getIdArgs('Loose'))
 
     def ID_tight(self, rtrow):
-        return self.ID(rtrow,*self.objects,**self.getIdArgs('Tight'))
+        return self.pass_id(rtrow,'Tight',*self.objects)
 
     def trigger_threshold(self, rtrow):
-        pts = [getattr(rtrow, "%sPt" % l) for l in self.objects]
+        pts = [getattr(rtrow, pt) for pt in self.plan.Pt]
         pts.sort(reverse=True)
-        return pts[0] > 25.0 and pts[1] > 15.0
+        return pts[0] > self.triggerThresholds[0] and pts[1] > self.triggerThresholds[1]
+
+    def trigger_threshold_columnar(self, chunk):
+        pts = np.sort([chunk[pt] for pt in self.plan.Pt], axis=0)
+        return (pts[-1] > self.triggerThresholds[0]) & (pts[-2] > self.triggerThresholds[1])
 
     def qcd_rejection(self, rtrow):
-        qcd_pass = [getattr(rtrow, "%s_%s_Mass" % (l[0], l[1])) > 12.0
-                    for l in combinations(self.objects, 2)]
+        mass = self.plan.Mass
+        qcd_pass = [getattr(rtrow, mass[i][j]) > self.qcdMassCut
+                    for i, j in combinations(range(len(self.objects)), 2)]
         return all(qcd_pass)
 
+    def qcd_rejection_columnar(self, chunk):
+        mass = self.plan.Mass
+        qcd_pass = [chunk[mass[i][j]] > self.qcdMassCut
+                    for i, j in combinations(range(len(self.objects)), 2)]
+        return np.all(qcd_pass, axis=0)
+
 ##########################
 ###### Command line ######
 ##########################
@@ -42,21 +42,19 @@ class AnalyzerLABEL(AnalyzerBase):
         '''
         Select candidate objects
         '''
-        cands = []
-        for l in permutations(self.objects):
-            if lep_order(l[0], l[1]):
-                continue
+        # permutations of the objects with (0,1) forming a pair in FSA order
+        table = self.pairing_table((0,1))
+        mass = table.pair_values(rtrow, self.plan.Mass)
 
-            # TODO: define selection here
+        # TODO: define selection here, one entry per permutation
+        # good = table.sameFlavor[0] & ...
+        # massdiff = np.abs(table.at_pair(mass,0)-ZMASS)
 
-            # cands.append(([minimization variables], list(l)))
-
-        if not len(cands): return 0
-
-        # Sort candidates
-        cands.sort(key=lambda x: x[0])
+        # best = first_min(massdiff, good)
+        # if best < 0: return 0
 
         # return selected candidate in form ([minimizing variables list],list(l))
+        # return ([float(massdiff[best])], table.names(best))
 
     # optional: override choose_alternative_objects
     # def choose_alternative_objects(self, rtrow, state):
@@ -77,6 +75,12 @@ class AnalyzerLABEL(AnalyzerBase):
         #cuts.add(function)
         return cuts
 
+    # optional: extend the FSA branches read by the analyzer
+    # def fsa_branches(self, final_state):
+    #     branches = super(AnalyzerLABEL, self).fsa_branches(final_state)
+    #     branches.update([ branches used in your cuts ])
+    #     return branches
+
     def getIdArgs(self,type):
         kwargs = {}
         if type=='Tight'
@@ -27,6 +27,14 @@ class AnalyzerWZ(AnalyzerBase):
         W selection: met > 30. lepton pt > 20.
     '''
 
+    # cut thresholds read by the row-wise and the columnar cuts
+    fiducialCuts = { # (pt, |eta|)
+        'e': (10.0, 2.5),
+        'm': (10.0, 2.4),
+        't': (20.0, 2.3),
+    }
+    triggerThresholds = (25.0, 15.0) # leading, subleading pt
+
     def __init__(self, sample_location, out_file, period):
         self.channel = 'WZ'
         self.final_states = ['eee','eem','emm','mmm']
@@ -49,25 +57,19 @@ class AnalyzerWZ(AnalyzerBase):
         The first two leptons are the Z and the third is the W.
         We select combinatorics by closest to zmass.
         '''
-        cands = []
-        for l in permutations(self.objects):
-            if lep_order(l[0], l[1]):
-                continue
-
-            OS1 = getattr(rtrow, "%s_%s_SS" % (l[0], l[1])) < 0.5 # select opposite sign
-            mass = getattr(rtrow, "%s_%s_Mass" % (l[0], l[1]))
-            massdiff = abs(ZMASS-mass)
-
-            if OS1 and l[0][0]==l[1][0]:
-                cands.append((massdiff, list(l)))
+        plan = self.plan
+        table = self.pairing_table((0,1))
+        SS = table.pair_values(rtrow, plan.SS)
+        mass = table.pair_values(rtrow, plan.Mass)
 
-        if not len(cands): return 0
+        OS1 = table.at_pair(SS,0) < 0.5 # select opposite sign
+        massdiff = np.abs(ZMASS-table.at_pair(mass,0))
 
-        # Sort by mass difference
-        cands.sort(key=lambda x: x[0])
-        massdiff, leps = cands[0]
+        # first minimum of the mass difference
+        best = first_min(massdiff, OS1 & table.sameFlavor[0])
+        if best < 0: return 0
 
-        return ([massdiff], leps)
+        return ([float(massdiff[best])], table.names(best))
 
     # overide good_to_store
     # will store via veto
@@ -141,6 +143,13 @@ class AnalyzerWZ(AnalyzerBase):
         cuts.add(self.wSelection)
         return cuts
 
+    def fsa_branches(self, final_state):
+        branches = super(AnalyzerWZ, self).fsa_branches(final_state)
+        branches.update(self.get_triggers())
+        branches.update(['%sAbsEta' % l for l in self.enumerate_objects(final_state)])
+        branches.update(['eVetoWZ', 'muVetoWZ'])
+        return branches
+
     def getIdArgs(self,type):
         kwargs = {}
         if type=='Tight':
@@ -177,34 +186,40 @@ class AnalyzerWZ(AnalyzerBase):
             kwargs = self.alternateIdMap[type]
         return kwargs
 
-    def trigger(self, rtrow):
+    def get_triggers(self):
         triggers = ["mu17ele8isoPass", "mu8ele17isoPass",
                     "doubleETightPass", "doubleMuPass", "doubleMuTrkPass"]
 
         if self.period == '13':
             triggers = ['muEPass', 'doubleMuPass', 'doubleEPass']
 
-        for t in triggers:
+        return triggers
+
+    def trigger(self, rtrow):
+        for t in self.get_triggers():
             if getattr(rtrow,t)>0:
                 return True
         return False
 
+    def trigger_columnar(self, chunk):
+        return np.any([chunk[t]>0 for t in self.get_triggers()], axis=0)
+
     def fiducial(self, rtrow):
-        for l in self.objects:
-            if l[0]=='e':
-                ptcut = 10.0
-                etacut = 2.5
-            if l[0]=='m':
-                ptcut = 10.0
-                etacut = 2.4
-            if l[0]=='t':
-                ptcut = 20.0
-                etacut = 2.3
-            if getattr(rtrow, '%sPt' % l) < ptcut:
+        for i, l in enumerate(self.objects):
+            ptcut, etacut = self.fiducialCuts[l[0]]
+            if getattr(rtrow, self.plan.Pt[i]) < ptcut:
                 return False
-            if getattr(rtrow, '%sAbsEta' % l) > etacut:
+            if getattr(rtrow, self.plan.AbsEta[i]) > etacut:
                 return False
         return True
+
+    def fiducial_columnar(self, chunk):
+        result = np.ones(len(chunk), dtype=bool)
+        for i, l in enumerate(self.objects):
+            ptcut, etacut = self.fiducialCuts[l[0]]
+            result &= ~(chunk[self.plan.Pt[i]] < ptcut)
+            result &= ~(chunk[self.plan.AbsEta[i]] > etacut)
+        return result
     
     def genfiducial(self, rtrow):
         for l in self.objects:
@@ -254,30 +269,39 @@ class AnalyzerWZ(AnalyzerBase):
         return self.ID(rtrow,*self.objects,**self.getIdArgs('Veto'))
 
     def ID_loose(self, rtrow):
-        return self.ID(rtrow,*self.objects,**self.getIdArgs('Loose'))
+        return self.pass_id(rtrow,'Loose',*self.objects)
 
     def ID_tight(self, rtrow):
-        return self.ID(rtrow,*self.objects,**self.getIdArgs('Tight'))
+        return self.pass_id(rtrow,'Tight',*self.objects)
+
+    def ID_loose_columnar(self, chunk):
+        return self.ID_columnar(chunk,*self.objects,**self.getIdArgs('Loose'))
 
     def trigger_threshold(self, rtrow):
-        pts = [getattr(rtrow, "%sPt" % l) for l in self.objects]
+        pts = [getattr(rtrow, pt) for pt in self.plan.Pt]
         pts.sort(reverse=True)
-        return pts[0] > 25.0 and pts[1] > 15.0
+        return pts[0] > self.triggerThresholds[0] and pts[1] > self.triggerThresholds[1]
+
+    def trigger_threshold_columnar(self, chunk):
+        pts = np.sort([chunk[pt] for pt in self.plan.Pt], axis=0)
+        return (pts[-1] > self.triggerThresholds[0]) & (pts[-2] > self.triggerThresholds[1])
 
     def zSelection(self,rtrow):
+        plan = self.plan
         leps = self.objects
         o = ordered(leps[0], leps[1])
-        m1 = getattr(rtrow,'%s_%s_Mass' % (o[0],o[1]))
-        l0Pt = getattr(rtrow,'%sPt' %leps[0])
+        m1 = getattr(rtrow,plan.Mass[plan.index[o[0]]][plan.index[o[1]]])
+        l0Pt = getattr(rtrow,plan.Pt[0])
         return abs(m1-ZMASS)<20. and l0Pt>20.
 
     def wSelection(self,rtrow):
+        plan = self.plan
         leps = self.objects
-        if getattr(rtrow, '%sPt' %leps[2])<20.: return False
+        if getattr(rtrow, plan.Pt[2])<20.: return False
         if rtrow.pfMetEt < 30.: return False
         for l in leps[:2]:
             o = ordered(l,leps[2])
-            dr = getattr(rtrow, '%s_%s_DR' % (o[0],o[1]))
+            dr = getattr(rtrow, plan.DR[plan.index[o[0]]][plan.index[o[1]]])
             if dr < 0.1: return False
         return True
 
@@ -0,0 +1,34 @@
+'''
+Accessor plans for the branches of FSA ntuples.
+
+The FSA branch names of every object of a final state (i.e. e1Pt) and of every
+ordered pair of objects (i.e. e1_m1_Mass) are built once per final state so that
+the event loop can fetch values by object index without string formatting.
+
+Author: Devin N. Taylor, UW-Madison
+'''
+
+OBJECT_VARIABLES = ['Pt', 'Eta', 'Phi', 'AbsEta', 'Charge', 'MtToPFMET', 'ToMETDPhi']
+PAIR_VARIABLES = ['Mass', 'SS', 'DR', 'DPhi']
+ISOLATION = {
+    'e': 'RelPFIsoRho',
+    'm': 'RelPFIsoDBDefault',
+}
+
+class AccessorPlan(object):
+    '''
+    Resolved FSA branch names for the objects of a final state.
+        plan.Pt[i]          branch name of the pt of object i
+        plan.Iso[i]         branch name of the isolation of object i (None for t, j, g)
+        plan.Mass[i][j]     branch name of the mass of the pair (i, j), both orders available
+        plan.index[obj]     index of an object name (i.e. 'e1') in plan.objects
+    '''
+    def __init__(self, objects):
+        self.objects = list(objects)
+        self.index = dict((obj, i) for i, obj in enumerate(self.objects))
+        for var in OBJECT_VARIABLES:
+            setattr(self, var, ['%s%s' % (obj, var) for obj in self.objects])
+        self.Iso = ['%s%s' % (obj, ISOLATION[obj[0]]) if obj[0] in ISOLATION else None
+                    for obj in self.objects]
+        for var in PAIR_VARIABLES:
+            setattr(self, var, [['%s_%s_%s' % (a, b, var) for b in self.objects] for a in self.objects])
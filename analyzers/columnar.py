@@ -0,0 +1,56 @@
+'''
+Columnar access to FSA ntuples for the chunked event loop in AnalyzerBase.
+
+An FSA tree is split into chunks of consecutive entries. Branches of a chunk
+are read on first access into numpy arrays so that cuts can be evaluated as
+array masks over the whole chunk.
+
+Author: Devin N. Taylor, UW-Madison
+'''
+
+import sys
+import numpy as np
+
+sys.argv.append('-b')
+import ROOT as rt
+sys.argv.pop()
+
+
+def read_branch(tree, branch, start, num):
+    '''
+    Read num entries of a branch starting at entry start into a numpy array.
+    '''
+    if num <= 0: return np.zeros(0)
+    nread = tree.Draw(branch, '', 'goff', num, start)
+    if nread <= 0: return np.zeros(0)
+    buf = tree.GetV1()
+    buf.SetSize(nread)
+    return np.array(np.frombuffer(buf, dtype=np.float64, count=nread))
+
+class Chunk(object):
+    '''
+    A block of consecutive entries [start, stop) of an FSA ntuple.
+    Branches are read lazily and cached, chunk['e1Pt'] returns a numpy array.
+    '''
+    def __init__(self, tree, start, stop):
+        self.tree = tree
+        self.start = start
+        self.stop = stop
+        self.columns = {}
+
+    def __len__(self):
+        return self.stop - self.start
+
+    def __getitem__(self, branch):
+        if branch not in self.columns:
+            self.columns[branch] = read_branch(self.tree, branch, self.start, len(self))
+        return self.columns[branch]
+
+def iterate_chunks(tree, chunkSize):
+    '''
+    Generator over the chunks of an FSA ntuple.
+    '''
+    numRows = tree.GetEntries()
+    tree.SetEstimate(chunkSize+1)
+    for start in xrange(0, numRows, chunkSize):
+        yield Chunk(tree, start, min(start+chunkSize, numRows))
@@ -0,0 +1,255 @@
+'''
+Compact bookkeeping of the events seen by AnalyzerBase.
+
+Events are identified by (evt, lumi, run). The keys are packed into two 64 bit
+integers (evt and run<<32|lumi) and stored in an open addressing table of numpy
+arrays together with the cutflow level (int8), the minimizing variables of the
+best candidate, a written flag and the minimizing variables of the written
+candidate (a better candidate found after an event was written is not written). Above a memory budget the arrays are memory
+mapped to files in a temporary directory.
+
+Author: Devin N. Taylor, UW-Madison
+'''
+
+import os
+import shutil
+import tempfile
+import numpy as np
+
+MASK64 = (1<<64)-1
+MASK32 = (1<<32)-1
+HASH1 = 0x9E3779B97F4A7C15
+HASH2 = 0xC2B2AE3D27D4EB4F
+MAX_LOAD = 0.7
+
+USED = 1
+BEST = 2
+WRITTEN = 4
+
+def pack_key(key):
+    '''
+    Pack an (evt, lumi, run) key into two signed 64 bit integers.
+    '''
+    evt, lumi, run = key
+    k0 = int(evt) & MASK64
+    k1 = ((int(run) & MASK32) << 32) | (int(lumi) & MASK32)
+    return (k0 - (1<<64) if k0 >> 63 else k0), (k1 - (1<<64) if k1 >> 63 else k1)
+
+def hash_key(k0, k1):
+    '''
+    Hash of a packed key, hash_keys for numpy arrays of packed keys.
+    '''
+    h = ((k0 & MASK64) * HASH1 ^ (k1 & MASK64) * HASH2) & MASK64
+    return h ^ (h >> 31)
+
+def hash_keys(k0, k1):
+    with np.errstate(over='ignore'):
+        h = k0.view(np.uint64) * np.uint64(HASH1) ^ k1.view(np.uint64) * np.uint64(HASH2)
+    return h ^ (h >> np.uint64(31))
+
+class EventIndex(object):
+    '''
+    Open addressing table of events.
+        slot = index.slot(key)      slot of an event, added if not yet seen
+        index.level[slot]           cutflow level (-1 if none)
+        index.best(slot)            minimizing variables of the best candidate (None if none)
+        index.set_written(slot)     mark an event written, with the best candidate
+    A slot is only valid until the next event is added.
+    kwargs:
+        capacity        initial number of slots (rounded up to a power of 2)
+        memoryBudget    size in MB above which the arrays are memory mapped (default None, never)
+        spillDir        directory for the memory mapped arrays (default the system temp directory)
+    '''
+    def __init__(self, **kwargs):
+        capacity = kwargs.pop('capacity', 1<<16)
+        memoryBudget = kwargs.pop('memoryBudget', None)
+        self.spillDir = kwargs.pop('spillDir', None)
+        self.budget = memoryBudget*1024*1024 if memoryBudget is not None else None
+        self.tempDir = None
+        self.size = 0
+        self.width = 0
+        self.capacity = 1
+        while self.capacity < capacity: self.capacity *= 2
+        self.allocate(self.capacity)
+
+    def entry_bytes(self):
+        return 8 + 8 + 1 + 1 + 2*8*self.width
+
+    def array(self, name, shape, dtype, fill=0):
+        '''
+        Allocate an array, memory mapped if the table exceeds the memory budget.
+        '''
+        if self.budget is None or self.capacity*self.entry_bytes() <= self.budget:
+            return np.full(shape, fill, dtype=dtype)
+        if self.tempDir is None:
+            self.tempDir = tempfile.mkdtemp(prefix='eventindex_', dir=self.spillDir)
+        fileName = os.path.join(self.tempDir, '%s_%i.dat' % (name, shape[0]))
+        arr = np.memmap(fileName, dtype=dtype, mode='w+', shape=shape)
+        arr[...] = fill
+        return arr
+
+    def allocate(self, capacity):
+        self.capacity = capacity
+        self.key0 = self.array('key0', (capacity,), np.int64)
+        self.key1 = self.array('key1', (capacity,), np.int64)
+        self.flags = self.array('flags', (capacity,), np.uint8)
+        self.level = self.array('level', (capacity,), np.int8, -1)
+        self.bestVals = self.array('best', (capacity, self.width), np.float64) if self.width else None
+        self.writtenVals = self.array('writtenBest', (capacity, self.width), np.float64) if self.width else None
+
+    def slot(self, key, insert=True):
+        '''
+        Return the slot of an event, -1 if not found and insert is False.
+        '''
+        k0, k1 = pack_key(key)
+        mask = self.capacity-1
+        i = hash_key(k0, k1) & mask
+        flags = self.flags
+        key0 = self.key0
+        key1 = self.key1
+        while flags[i]:
+            if key0[i]==k0 and key1[i]==k1: return i
+            i = (i+1) & mask
+        if not insert: return -1
+        if self.size+1 > MAX_LOAD*self.capacity:
+            self.grow()
+            return self.slot(key)
+        flags[i] = USED
+        key0[i] = k0
+        key1[i] = k1
+        self.size += 1
+        return i
+
+    def __contains__(self, key):
+        return self.slot(key, insert=False) >= 0
+
+    def __len__(self):
+        return self.size
+
+    def raise_level(self, slot, level):
+        '''
+        Keep the highest cutflow level reached by an event.
+        '''
+        if level > self.level[slot]: self.level[slot] = level
+
+    def best(self, slot):
+        if not self.flags[slot] & BEST: return None
+        return [float(x) for x in self.bestVals[slot]]
+
+    def set_best(self, slot, vals):
+        if not self.width:
+            self.width = len(vals)
+            self.bestVals = self.array('best', (self.capacity, self.width), np.float64)
+            self.writtenVals = self.array('writtenBest', (self.capacity, self.width), np.float64)
+        if len(vals) != self.width:
+            raise ValueError('EventIndex: expected %i minimizing variables, got %i' % (self.width, len(vals)))
+        self.bestVals[slot] = vals
+        self.flags[slot] |= BEST
+
+    def written(self, slot):
+        return bool(self.flags[slot] & WRITTEN)
+
+    def set_written(self, slot):
+        self.flags[slot] |= WRITTEN
+        if self.flags[slot] & BEST: self.writtenVals[slot] = self.bestVals[slot]
+
+    def num_written(self):
+        return int(np.count_nonzero(self.flags & WRITTEN))
+
+    def entries(self):
+        '''
+        Return the evt, lumi, run and cutflow level arrays of all events.
+        '''
+        used = np.flatnonzero(self.flags)
+        key1 = np.array(self.key1[used]).view(np.uint64)
+        lumi = (key1 & np.uint64(MASK32)).astype(np.int64)
+        run = (key1 >> np.uint64(32)).astype(np.int64)
+        return np.array(self.key0[used]), lumi, run, np.array(self.level[used])
+
+    def save(self, fileName, **extra):
+        '''
+        Save the table to a numpy .npz file, with any extra arrays given.
+        '''
+        best = self.bestVals if self.width else np.zeros((self.capacity, 0))
+        writtenBest = self.writtenVals if self.width else np.zeros((self.capacity, 0))
+        np.savez(fileName, key0=self.key0, key1=self.key1, flags=self.flags, level=self.level, best=best,
+                 writtenBest=writtenBest, **extra)
+
+    def load(self, fileName):
+        '''
+        Replace the table by one saved with save.
+        '''
+        data = np.load(fileName)
+        self.release()
+        self.width = data['best'].shape[1]
+        self.allocate(len(data['key0']))
+        self.key0[:] = data['key0']
+        self.key1[:] = data['key1']
+        self.flags[:] = data['flags']
+        self.level[:] = data['level']
+        if self.width: self.bestVals[:] = data['best']
+        if self.width and 'writtenBest' in data.files: self.writtenVals[:] = data['writtenBest']
+        self.size = int(np.count_nonzero(self.flags))
+
+    def cutflow(self):
+        '''
+        Number of events reaching each cutflow level.
+        '''
+        levels = self.level[self.level >= 0].astype(np.int64)
+        if not len(levels): return []
+        counts = np.bincount(levels)
+        return [int(x) for x in np.cumsum(counts[::-1])[::-1]]
+
+    def grow(self):
+        '''
+        Double the capacity and reinsert the events.
+        '''
+        used = np.flatnonzero(self.flags)
+        key0 = np.array(self.key0[used])
+        key1 = np.array(self.key1[used])
+        flags = np.array(self.flags[used])
+        level = np.array(self.level[used])
+        bestVals = np.array(self.bestVals[used]) if self.width else None
+        writtenVals = np.array(self.writtenVals[used]) if self.width else None
+        self.release()
+        self.allocate(self.capacity*2)
+        mask = np.uint64(self.capacity-1)
+        slots = (hash_keys(key0, key1) & mask).astype(np.int64)
+        pending = np.arange(len(used))
+        while len(pending):
+            # the first pending event for each free slot takes it, the others probe the next slot
+            free = self.flags[slots[pending]] == 0
+            cand = pending[free]
+            _, first = np.unique(slots[cand], return_index=True)
+            placed = cand[first]
+            s = slots[placed]
+            self.flags[s] = flags[placed]
+            self.key0[s] = key0[placed]
+            self.key1[s] = key1[placed]
+            self.level[s] = level[placed]
+            if self.width:
+                self.bestVals[s] = bestVals[placed]
+                self.writtenVals[s] = writtenVals[placed]
+            done = np.zeros(len(used), dtype=bool)
+            done[placed] = True
+            pending = pending[~done[pending]]
+            blocked = pending[self.flags[slots[pending]] != 0]
+            slots[blocked] = (slots[blocked]+1) & (self.capacity-1)
+
+    def release(self):
+        '''
+        Remove the memory mapped files of the current arrays.
+        '''
+        if self.tempDir is None: return
+        for arr in [self.key0, self.key1, self.flags, self.level, self.bestVals, self.writtenVals]:
+            if isinstance(arr, np.memmap): os.remove(arr.filename)
+        self.key0 = self.key1 = self.flags = self.level = self.bestVals = self.writtenVals = None
+
+    def close(self):
+        '''
+        Remove the temporary directory of the memory mapped arrays.
+        '''
+        self.release()
+        if self.tempDir is not None:
+            shutil.rmtree(self.tempDir, ignore_errors=True)
+            self.tempDir = None
@@ -1,10 +1,16 @@
 '''
 Lepton ID's available in ISA
 
+Each ID is a list of requirements on FSA branches, looked up by flavor and
+idType in the tables below. The requirements of a lepton are resolved to
+branch names once and evaluated either row by row (lep_id) or over numpy
+arrays of many leptons at once (lep_id_columnar, lep_id_array).
+
 Author: Devin N. Taylor, UW-Madison
 '''
 
 import sys
+import numpy as np
 
 sys.argv.append('b')
 import ROOT as rt
@@ -16,119 +22,213 @@ def lep_id(rtrow, period, *lep, **kwargs):
 
     if idType:
         for l in lep:
-            if l[0]=='e': lep_method = 'elec_id'
-            if l[0]=='m': lep_method = 'muon_id'
-            if l[0]=='t': lep_method = 'tau_id'
-            if not eval('%s(rtrow,l,period,idType)'%lep_method): return False
-        
-    return True
-
-def elec_id(rtrow, l, period, idType):
-    if idType=='NonTrig':
-        if not _elec_mva_nontriggering(rtrow, l, period): return False
-    if idType=='Trig':
-        if not _elec_mva_triggering(rtrow, l, period): return False
-    if idType=='Veto':
-        if not getattr(rtrow, '%sCBIDVeto' % l): return False
-    if idType=='Loose':
-        if not getattr(rtrow, '%sCBIDLoose' % l): return False
-    if idType=='Medium':
-        if not getattr(rtrow, '%sCBIDMedium' % l): return False
-    if idType=='Tight':
-        if not getattr(rtrow, '%sCBIDTight' % l): return False
-    if idType=='ZZLoose':
-        if not _elec_zz_loose(rtrow,l,period): return False
-    if idType=='ZZTight':
-        if not _elec_zz_tight(rtrow,l,period): return False
-    return True
+            for check, arrayCheck, names, arg in compiled_id(l, l[0], idType):
+                if not check(rtrow, names, arg): return False
 
-def muon_id(rtrow, l, period, idType):
-    if idType=='Tight':
-        if not getattr(rtrow,'%sPFIDTight'%l): return False
-    if idType=='Loose':
-        if not getattr(rtrow,'%sPFIDLoose'%l): return False
-    if idType=='ZZLoose':
-        if not _muon_zz_loose(rtrow,l,period): return False
-    if idType=='ZZTight':
-        if not _muon_zz_tight(rtrow,l,period): return False
     return True
 
-def tau_id(rtrow, l, period, idType):
-    if not getattr(rtrow, "%sDecayModeFinding" %l): return False  # really should be old DM, but not available in PHYS14 right now, all miniAOD pass
-    if not getattr(rtrow, "%sAgainstElectronMediumMVA5" % l): return False
-    if not getattr(rtrow, "%sAgainstMuonTight3" % l): return False
-    if idType=='Loose':
-        if not getattr(rtrow, "%sByLooseCombinedIsolationDeltaBetaCorr3Hits" %l): return False
-    if idType=='Medium':
-        if not getattr(rtrow, "%sByMediumCombinedIsolationDeltaBetaCorr3Hits" %l): return False
-    if idType=='Tight':
-        if not getattr(rtrow, "%sByTightCombinedIsolationDeltaBetaCorr3Hits" %l):return False
-    return True
-
-
-
-def _muon_zz_loose(rtrow, l, period):
-    if getattr(rtrow, "%sPt" % l) < 5: return False
-    if abs(getattr(rtrow, "%sEta" % l)) > 2.4: return False
-    if abs(getattr(rtrow, '%sPVDZ' % l)) > 1.: return False
-    if abs(getattr(rtrow, '%sPVDXY' % l)) > 0.5:return False
-    isGlobal = getattr(rtrow, '%sIsGlobal' % l)
-    isTracker = getattr(rtrow, '%sIsTracker' % l)
-    matchedStations = getattr(rtrow, '%sMatchedStations' % l)
-    return isGlobal or isTracker or matchedStations>0
-
-def _muon_zz_tight(rtrow, l, period):
-    if not _muon_zz_loose(rtrow,l,period): return False
-    return getattr(rtrow,'%sIsPFMuon' %l)
-
-def _elec_zz_loose(rtrow, l, period):
-    if getattr(rtrow, "%sPt" % l) < 7: return False
-    if abs(getattr(rtrow, "%sEta" % l)) > 2.5: return False
-    if abs(getattr(rtrow, '%sPVDZ' % l)) > 1.: return False
-    if abs(getattr(rtrow, '%sPVDXY' % l)) > 0.5:return False
-    if getattr(rtrow,'%sMissingHits'%l) > 1: return False
-    return True
-
-def _elec_zz_tight(rtrow, l, period):
-    if not _elec_zz_loose(rtrow,l,period): return False
-    return _elec_mva_nontriggering_zz(rtrow,l,period)
-
-def _elec_mva_nontriggering_zz(rtrow, l, period):
-    pt = getattr(rtrow, "%sPt" % l)
-    eta = abs(getattr(rtrow, "%sSCEta" % l))
-    mva = getattr(rtrow, "%sMVANonTrigID" % l)
-
-    if 5.0 < pt < 10.0:
-        return (eta < 0.8 and mva > -0.202) or (0.8 < eta < 1.479 and mva > -0.444) or (1.479 < eta and mva > 0.264)
-    elif 10.0 < pt:
-        return (eta < 0.8 and mva > -0.110) or (0.8 < eta < 1.479 and mva > -0.284) or (1.479 < eta and mva > -0.212)
-    else:
-        return False
-
-def _elec_mva_nontriggering(rtrow, l, period):
-    pt = getattr(rtrow, "%sPt" % l)
-    eta = abs(getattr(rtrow, "%sSCEta" % l))
-    mva = getattr(rtrow, "%sMVANonTrigID" % l)
-
-    if 5.0 < pt < 10.0:
-        return (eta < 0.8 and mva > 0.47) or (0.8 < eta < 1.479 and mva > 0.004) or (1.479 < eta and mva > 0.295)
-
-    elif 10.0 < pt:
-        return (eta < 0.8 and mva > -0.34) or (0.8 < eta < 1.479 and mva > -0.65) or (1.479 < eta and mva > 0.6)
+def lep_id_columnar(chunk, period, *lep, **kwargs):
+    '''
+    Columnar version of lep_id over a chunk of rows (see columnar.py).
+    Returns a boolean array.
+    '''
+    idType = kwargs.get('idType','')
+    result = np.ones(len(chunk), dtype=bool)
 
-    else:
+    if idType:
+        for l in lep:
+            result &= _passes_array(chunk.__getitem__, compiled_id(l, l[0], idType), len(chunk))
+
+    return result
+
+def lep_id_array(columns, flavor, idType, period=None):
+    '''
+    Evaluate an ID over arrays of leptons of one flavor.
+    columns maps the FSA branch suffix (i.e. 'Pt', 'SCEta') to an array with one
+    entry per lepton, lep_id_branches(flavor, idType, prefix='') are the suffixes needed.
+    '''
+    length = len(columns.values()[0]) if columns else 0
+    return _passes_array(columns.__getitem__, compiled_id('', flavor, idType), length)
+
+def lep_id_branches(l, idType, prefix=None):
+    '''
+    The FSA branches read by lep_id for lepton l and a given idType.
+    '''
+    return _names(compiled_id(l if prefix is None else prefix, l[0], idType))
+
+######################
+### MVA thresholds ###
+######################
+def _in_bin(x, lo, hi):
+    return (lo is None or lo < x) and (hi is None or x < hi)
+
+def _in_bin_array(x, lo, hi):
+    result = np.ones(len(x), dtype=bool)
+    if lo is not None: result &= lo < x
+    if hi is not None: result &= x < hi
+    return result
+
+class MVATable(object):
+    '''
+    MVA thresholds binned in pt and |SCEta|.
+        MVATable(mvaBranch, ptBins, etaBins, cuts)
+    The bins are open intervals (lo, hi), None for no bound. A lepton passes
+    if its mva is above cuts[ptBin][etaBin]. Leptons outside of the bins,
+    including those exactly on a bin edge, fail.
+    '''
+    def __init__(self, mva, ptBins, etaBins, cuts):
+        self.mva = mva
+        self.ptBins = ptBins
+        self.etaBins = etaBins
+        self.cuts = cuts
+
+    def passes(self, pt, eta, mva):
+        for (ptLo, ptHi), cuts in zip(self.ptBins, self.cuts):
+            if not _in_bin(pt, ptLo, ptHi): continue
+            for (etaLo, etaHi), cut in zip(self.etaBins, cuts):
+                if _in_bin(eta, etaLo, etaHi): return mva > cut
+            return False
         return False
 
-def _elec_mva_triggering(rtrow, l, period):
-    pt = getattr(rtrow, "%sPt" % l)
-    eta = abs(getattr(rtrow, "%sSCEta" % l))
-    mva = getattr(rtrow, "%sMVATrigID" % l)
-
-    if 10.0 < pt < 20.0:
-        return (eta < 0.8 and mva > 0.00) or (0.8 < eta < 1.479 and mva > 0.10) or (1.479 < eta and mva > 0.62)
-
-    elif 20.0 < pt:
-        return (eta < 0.8 and mva > 0.94) or (0.8 < eta < 1.479 and mva > 0.85) or (1.479 < eta and mva > 0.92)
-
-    else:
-        return False
+    def passes_array(self, pt, eta, mva):
+        result = np.zeros(len(pt), dtype=bool)
+        for (ptLo, ptHi), cuts in zip(self.ptBins, self.cuts):
+            inPt = _in_bin_array(pt, ptLo, ptHi)
+            for (etaLo, etaHi), cut in zip(self.etaBins, cuts):
+                result |= inPt & _in_bin_array(eta, etaLo, etaHi) & (mva > cut)
+        return result
+
+_sceta_bins = [(None, 0.8), (0.8, 1.479), (1.479, None)]
+
+_mva_tables = {
+    'NonTrig'  : MVATable('MVANonTrigID', [(5.0, 10.0), (10.0, None)], _sceta_bins,
+                          [[0.47, 0.004, 0.295], [-0.34, -0.65, 0.6]]),
+    'NonTrigZZ': MVATable('MVANonTrigID', [(5.0, 10.0), (10.0, None)], _sceta_bins,
+                          [[-0.202, -0.444, 0.264], [-0.110, -0.284, -0.212]]),
+    'Trig'     : MVATable('MVATrigID', [(10.0, 20.0), (20.0, None)], _sceta_bins,
+                          [[0.00, 0.10, 0.62], [0.94, 0.85, 0.92]]),
+}
+
+#################
+### ID tables ###
+#################
+# requirements are (kind, branch suffix, argument), see _checks for the kinds
+_elec_zz_loose = [
+    ('min', 'Pt', 7),
+    ('absmax', 'Eta', 2.5),
+    ('absmax', 'PVDZ', 1.),
+    ('absmax', 'PVDXY', 0.5),
+    ('max', 'MissingHits', 1),
+]
+_muon_zz_loose = [
+    ('min', 'Pt', 5),
+    ('absmax', 'Eta', 2.4),
+    ('absmax', 'PVDZ', 1.),
+    ('absmax', 'PVDXY', 0.5),
+    ('any', None, [('flag', 'IsGlobal', None), ('flag', 'IsTracker', None), ('above', 'MatchedStations', 0)]),
+]
+# really should be old DM, but not available in PHYS14 right now, all miniAOD pass
+_tau_base = [
+    ('flag', 'DecayModeFinding', None),
+    ('flag', 'AgainstElectronMediumMVA5', None),
+    ('flag', 'AgainstMuonTight3', None),
+]
+
+_elec_ids = {
+    'NonTrig': [('mva', None, 'NonTrig')],
+    'Trig'   : [('mva', None, 'Trig')],
+    'Veto'   : [('flag', 'CBIDVeto', None)],
+    'Loose'  : [('flag', 'CBIDLoose', None)],
+    'Medium' : [('flag', 'CBIDMedium', None)],
+    'Tight'  : [('flag', 'CBIDTight', None)],
+    'ZZLoose': _elec_zz_loose,
+    'ZZTight': _elec_zz_loose + [('mva', None, 'NonTrigZZ')],
+}
+_muon_ids = {
+    'Tight'  : [('flag', 'PFIDTight', None)],
+    'Loose'  : [('flag', 'PFIDLoose', None)],
+    'ZZLoose': _muon_zz_loose,
+    'ZZTight': _muon_zz_loose + [('flag', 'IsPFMuon', None)],
+}
+_tau_ids = {
+    'Loose' : _tau_base + [('flag', 'ByLooseCombinedIsolationDeltaBetaCorr3Hits', None)],
+    'Medium': _tau_base + [('flag', 'ByMediumCombinedIsolationDeltaBetaCorr3Hits', None)],
+    'Tight' : _tau_base + [('flag', 'ByTightCombinedIsolationDeltaBetaCorr3Hits', None)],
+}
+
+# flavor: (ID table, requirements of an idType not in the table)
+_id_tables = {
+    'e': (_elec_ids, []),
+    'm': (_muon_ids, []),
+    't': (_tau_ids, _tau_base),
+}
+
+def id_requirements(flavor, idType):
+    '''
+    The requirements of an idType for a flavor.
+    '''
+    ids, default = _id_tables.get(flavor, ({}, []))
+    return ids.get(idType, default)
+
+##################
+### Evaluation ###
+##################
+# kind: (check on a row, check on arrays from a column getter)
+_checks = {
+    'flag'  : (lambda rtrow, names, arg: getattr(rtrow, names[0]),
+               lambda get, names, arg, n: get(names[0]) != 0),
+    'min'   : (lambda rtrow, names, arg: not getattr(rtrow, names[0]) < arg,
+               lambda get, names, arg, n: ~(get(names[0]) < arg)),
+    'max'   : (lambda rtrow, names, arg: not getattr(rtrow, names[0]) > arg,
+               lambda get, names, arg, n: ~(get(names[0]) > arg)),
+    'absmax': (lambda rtrow, names, arg: not abs(getattr(rtrow, names[0])) > arg,
+               lambda get, names, arg, n: ~(np.abs(get(names[0])) > arg)),
+    'above' : (lambda rtrow, names, arg: getattr(rtrow, names[0]) > arg,
+               lambda get, names, arg, n: get(names[0]) > arg),
+    'any'   : (lambda rtrow, names, arg: any(check(rtrow, subNames, subArg) for check, _, subNames, subArg in arg),
+               lambda get, names, arg, n: _passes_array(get, arg, n, anyOf=True)),
+    'mva'   : (lambda rtrow, names, arg: arg.passes(getattr(rtrow, names[0]), abs(getattr(rtrow, names[1])), getattr(rtrow, names[2])),
+               lambda get, names, arg, n: arg.passes_array(get(names[0]), np.abs(get(names[1])), get(names[2]))),
+}
+
+_compiled = {}
+
+def compiled_id(prefix, flavor, idType):
+    '''
+    The requirements of an ID resolved for the branches of a lepton (i.e. prefix 'e1'),
+    a list of (check, arrayCheck, branch names, argument), built once per lepton.
+    '''
+    key = (prefix, flavor, idType)
+    if key not in _compiled:
+        _compiled[key] = _compile(prefix, id_requirements(flavor, idType))
+    return _compiled[key]
+
+def _compile(prefix, requirements):
+    compiled = []
+    for kind, suffix, arg in requirements:
+        check, arrayCheck = _checks[kind]
+        if kind=='any':
+            arg = _compile(prefix, arg)
+            names = tuple(_names(arg))
+        elif kind=='mva':
+            arg = _mva_tables[arg]
+            names = tuple('%s%s' % (prefix, b) for b in ['Pt', 'SCEta', arg.mva])
+        else:
+            names = ('%s%s' % (prefix, suffix),)
+        compiled.append((check, arrayCheck, names, arg))
+    return compiled
+
+def _names(compiled):
+    names = []
+    for check, arrayCheck, checkNames, arg in compiled:
+        names += [name for name in checkNames if name not in names]
+    return names
+
+def _passes_array(get, compiled, n, anyOf=False):
+    result = np.zeros(n, dtype=bool) if anyOf else np.ones(n, dtype=bool)
+    for check, arrayCheck, names, arg in compiled:
+        if anyOf:
+            result |= arrayCheck(get, names, arg, n)
+        else:
+            result &= arrayCheck(get, names, arg, n)
+    return result
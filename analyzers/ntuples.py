@@ -3,23 +3,97 @@ Utilities for building ntuples used in ISA.
 
 Author: Devin N. Taylor, UW-Madison
 '''
+import os
+import re
+import fcntl
+import ctypes
+import getpass
+import hashlib
+import tempfile
 from itertools import product
 
 import ROOT as rt
 from array import array
 
-def buildNtuple(object_definitions,states,channelName,final_states,**kwargs):
+# compiled ntuple structs, shared by all processes of a user
+STRUCT_CACHE = os.environ.get('ISA_STRUCT_CACHE', os.path.join(tempfile.gettempdir(), 'isa_structs_%s' % getpass.getuser()))
+_declaredStructs = {}
+# ctypes mirrors of the declared structs, by struct class
+_structLayouts = {}
+CTYPES = {
+    'Int_t'  : ctypes.c_int32,
+    'Float_t': ctypes.c_float,
+    'Char_t' : ctypes.c_char,
+}
+
+def declareStructs(declarations):
     '''
-    A function to build an initial state ntuple for AnalyzerBase.py
+    Declare the C structs of an ntuple and return {struct name: class}, the
+    names without the trailing _t. The structs are keyed by a hash of their
+    declarations (and the ROOT version) which is appended to the C names. They
+    are compiled once with ACLiC into a library in STRUCT_CACHE that later runs
+    load, with the interpreter as fallback. Within a process they are declared
+    only once.
     '''
-    alternateIds = kwargs.pop('altIds',[])
-    doVBF = kwargs.pop('doVBF',False)
+    code = '\n'.join(declarations)
+    key = hashlib.md5(rt.gROOT.GetVersion() + code).hexdigest()[:12]
+    if key not in _declaredStructs:
+        pattern = r'struct\s+(\w+)_t\s*\{'
+        names = re.findall(pattern, code)
+        code = re.sub(pattern, r'struct \1_%s_t {' % key, code)
+        if not compileStructs(code, key):
+            rt.gROOT.ProcessLine(code)
+        _declaredStructs[key] = dict((name, getattr(rt, '%s_%s_t' % (name, key))) for name in names)
+        for name, body in re.findall(r'struct\s+(\w+)_%s_t\s*\{(.*?)\}' % key, code, re.S):
+            _structLayouts[_declaredStructs[key][name]] = structLayout(name, body)
+    return _declaredStructs[key]
 
-    finalStateObjects = 'emtjgn'
-    structureDict = {}
-    structOrder = []
+def structLayout(name, body):
+    '''
+    Return a ctypes structure with the memory layout of a C struct given the body of
+    its declaration (Int_t, Float_t and Char_t arrays only).
+    '''
+    fields = []
+    for fieldType, field, length in re.findall(r'(\w+)\s+(\w+)\s*(?:\[(\d+)\])?\s*;', body):
+        fields += [(field, CTYPES[fieldType] * int(length) if length else CTYPES[fieldType])]
+    return type(name, (ctypes.Structure,), {'_fields_': fields})
 
-    # define selection bools and fake rate things
+def structAddress(struct):
+    '''
+    Return the address of a ROOT object.
+    '''
+    if hasattr(rt, 'addressof'): return rt.addressof(struct)
+    return rt.AddressOf(struct)[0]
+
+def compileStructs(code, key):
+    '''
+    Compile the struct declarations with ACLiC (or load the library of a previous
+    compilation). Returns False if the library could not be built.
+    '''
+    header = os.path.join(STRUCT_CACHE, 'isaStructs_%s.h' % key)
+    try:
+        if not os.path.isdir(STRUCT_CACHE): os.makedirs(STRUCT_CACHE)
+    except OSError:
+        if not os.path.isdir(STRUCT_CACHE): return False
+    # other processes wait for the first one to build the library
+    with open(header+'.lock', 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            if not os.path.exists(header):
+                with open(header+'.tmp', 'w') as headerFile:
+                    headerFile.write('#include "Rtypes.h"\n%s\n' % code)
+                os.rename(header+'.tmp', header)
+            return rt.gSystem.CompileMacro(header, 'k') == 1
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+def promptCombinations(final_states):
+    '''
+    Return the object types present in the final states (in 'emtjgn' order) and the
+    list of (promptString, prompts) for the fake rate selection flags, where prompts
+    gives the number of objects of each type and promptString joins them (i.e. '210').
+    '''
+    finalStateObjects = 'emtjgn'
     numObjs = len(final_states[0])
     allowedObjects = ''
     for fsObj in finalStateObjects:
@@ -28,15 +102,36 @@ def buildNtuple(object_definitions,states,channelName,final_states,**kwargs):
                 allowedObjects += fsObj
                 break
     numObjTypes = len(allowedObjects)
+    combinations = []
+    for prompts in list(product(range(numObjs+1),repeat=numObjTypes)):
+        if sum(prompts) > numObjs: continue
+        promptString = ''.join([str(x) for x in prompts])
+        combinations += [(promptString, prompts)]
+    return allowedObjects, combinations
+
+def buildNtuple(object_definitions,states,channelName,final_states,**kwargs):
+    '''
+    A function to build an initial state ntuple for AnalyzerBase.py
+    '''
+    alternateIds = kwargs.pop('altIds',[])
+    doVBF = kwargs.pop('doVBF',False)
+    systematics = kwargs.pop('systematics',[])
+    varied = kwargs.pop('varied',systematics)
+
+    # key: [struct name, Char_t field or None, leaflist], the structs are declared together
+    structureDict = {}
+    structOrder = []
+    declarations = []
+
+    # define selection bools and fake rate things
+    allowedObjects, combinations = promptCombinations(final_states)
     strToProcess = "struct structSelect_t {"
     strForBranch = ""
     strToProcess += "Int_t passTight;"
     strForBranch += "passTight/I:"
     strToProcess += "Int_t passLoose;"
     strForBranch += "passLoose:"
-    for prompts in list(product(range(numObjs+1),repeat=numObjTypes)):
-        if sum(prompts) > numObjs: continue
-        promptString = ''.join([str(x) for x in prompts])
+    for promptString, prompts in combinations:
         strToProcess += "Int_t pass_%s;" % promptString
         strForBranch += "pass_%s:" % promptString
     for altId in alternateIds:
@@ -44,31 +139,34 @@ def buildNtuple(object_definitions,states,channelName,final_states,**kwargs):
         strForBranch += "pass_%s:" % altId
     strToProcess += "};"
     strForBranch = strForBranch[:-1] # remove trailing :
-    rt.gROOT.ProcessLine(strToProcess)
-    selectStruct = rt.structSelect_t()
-    structureDict['select'] = [selectStruct, selectStruct, strForBranch]
+    declarations += [strToProcess]
+    structureDict['select'] = ['structSelect', None, strForBranch]
     structOrder += ['select']    
 
     # define common root classes
-    rt.gROOT.ProcessLine(
-    "struct structEvent_t {\
+    # event weights and their variations, see systematics.py
+    weights = ['lep_scale', 'pu_weight']
+    weights += [w for w in systematics if w not in weights]
+    variations = ['%s_%s' % (w, shift) for w in systematics if w in varied for shift in ['up', 'down']]
+    strToProcess = "struct structEvent_t {\
        Int_t   evt;\
        Int_t   run;\
        Int_t   lumi;\
-       Int_t   nvtx;\
-       Float_t lep_scale;\
-       Float_t pu_weight;\
-    };");
-    eventStruct = rt.structEvent_t()
-    structureDict['event'] = [eventStruct, eventStruct,'evt/I:run:lumi:nvtx:lep_scale/F:pu_weight']
+       Int_t   nvtx;"
+    strForBranch = 'evt/I:run:lumi:nvtx:'
+    for w in weights + variations:
+        strToProcess += "Float_t %s;" % w
+    strToProcess += "};"
+    strForBranch += 'lep_scale/F:' + ':'.join(weights[1:] + variations)
+    declarations += [strToProcess]
+    structureDict['event'] = ['structEvent', None, strForBranch]
     structOrder += ['event']
 
-    rt.gROOT.ProcessLine(
+    declarations += [
     "struct structChannel_t {\
        Char_t  channel[9];\
-    };");
-    channelStruct = rt.structChannel_t()
-    structureDict['channel'] = [channelStruct, rt.AddressOf(channelStruct,'channel'),'channel/C']
+    };"]
+    structureDict['channel'] = ['structChannel', 'channel', 'channel[9]/C']
     structOrder += ['channel']
 
     fsStrToProcess = "struct structFinalState_t {\
@@ -105,12 +203,11 @@ def buildNtuple(object_definitions,states,channelName,final_states,**kwargs):
 
     fsStrToProcess += "};"
     fsStrForBranch = fsStrForBranch[:-1]
-    rt.gROOT.ProcessLine(fsStrToProcess);
-    finalStateStruct = rt.structFinalState_t()
-    structureDict['finalstate'] = [finalStateStruct, finalStateStruct, fsStrForBranch]
+    declarations += [fsStrToProcess]
+    structureDict['finalstate'] = ['structFinalState', None, fsStrForBranch]
     structOrder += ['finalstate']
 
-    rt.gROOT.ProcessLine(
+    declarations += [
     "struct structObject_t {\
        Float_t Pt;\
        Float_t Eta;\
@@ -118,11 +215,11 @@ def buildNtuple(object_definitions,states,channelName,final_states,**kwargs):
        Float_t Iso;\
        Int_t   Chg;\
        Int_t   PassTight;\
-    };");
-    rt.gROOT.ProcessLine(
+    };"]
+    declarations += [
     "struct structObjChar_t {\
        Char_t  Flv[2];\
-    };");
+    };"]
     lepCount = 0
     jetCount = 0
     phoCount = 0
@@ -131,8 +228,6 @@ def buildNtuple(object_definitions,states,channelName,final_states,**kwargs):
         for obj in val:
             if obj=='n': continue
             else:
-                objStruct = rt.structObject_t()
-                flvStruct = rt.structObjChar_t()
                 if obj in 'emt': 
                     charName = 'l'
                     lepCount += 1
@@ -145,8 +240,8 @@ def buildNtuple(object_definitions,states,channelName,final_states,**kwargs):
                     charName = 'g'
                     phoCount += 1
                     objCount = phoCount
-                structureDict['%s%i' % (charName, objCount)] = [objStruct, objStruct, 'Pt/F:Eta:Phi:Iso:Chg/I:PassTight']
-                structureDict['%s%iFlv' % (charName, objCount)] = [flvStruct, rt.AddressOf(flvStruct,'Flv'),'Flv/C']
+                structureDict['%s%i' % (charName, objCount)] = ['structObject', None, 'Pt/F:Eta:Phi:Iso:Chg/I:PassTight']
+                structureDict['%s%iFlv' % (charName, objCount)] = ['structObjChar', 'Flv', 'Flv[2]/C']
                 structOrder += ['%s%i' % (charName, objCount)]
                 structOrder += ['%s%iFlv' % (charName, objCount)]
 
@@ -212,29 +307,177 @@ def buildNtuple(object_definitions,states,channelName,final_states,**kwargs):
             strForBranch = strForBranch[:-1] # remove trailing :
             strToProcess += "\
                 };"
-            rt.gROOT.ProcessLine(strToProcess)
-            initialStruct = getattr(rt,"struct%s_t" % key.upper())()
-            structureDict[key] = [initialStruct, initialStruct, strForBranch]
+            declarations += [strToProcess]
+            structureDict[key] = ['struct%s' % key.upper(), None, strForBranch]
             structOrder += [key]
 
-    rt.gROOT.ProcessLine(
+    declarations += [
     "struct structInitialChar_t {\
        Char_t  Flv[3];\
-    };");
+    };"]
     for key in object_definitions:
-        initialFlvStruct = rt.structInitialChar_t()
-        structureDict['%sFlv' % key] = [initialFlvStruct,rt.AddressOf(initialFlvStruct,'Flv'),'Flv/C']
+        structureDict['%sFlv' % key] = ['structInitialChar', 'Flv', 'Flv[3]/C']
         structOrder += ['%sFlv' % key]
 
     # now create the tree
+    structs = declareStructs(declarations)
     tree = rt.TTree(channelName,channelName)
     allBranches = {}
+    schema = []
     for key in structOrder:
-        val = structureDict[key]
-        tree.Branch(key,val[1],val[2])
-        allBranches[key] = val[0]
+        structName, charField, leaflist = structureDict[key]
+        struct = structs[structName]()
+        # the length of a Char_t array is only kept in the schema, the branch holds a string
+        tree.Branch(key,rt.AddressOf(struct,charField) if charField else struct,re.sub(r'\[\d+\]', '', leaflist))
+        allBranches[key] = struct
+        schema += [(key, leaflist)]
+
+    return (tree, allBranches, schema)
+
+# ROOT::RCompressionSetting::EAlgorithm
+COMPRESSION_ALGORITHMS = {
+    'zlib': 1,
+    'lzma': 2,
+    'lz4' : 4,
+}
+
+def configureOutput(rtFile, tree, **kwargs):
+    '''
+    Set the compression of an output file and of the branches of its tree, and the
+    basket and flush policy of the tree. Must be called before the tree is filled.
+    kwargs:
+        compression         algorithm, one of COMPRESSION_ALGORITHMS (default the file's)
+        compressionLevel    1 (fast) to 9 (small) (default the file's)
+        basketSize          basket size in bytes of all branches (default ROOT's)
+        autoFlush           write the baskets every N entries (N>0) or every -N bytes (N<0)
+                            (default ROOT's)
+    '''
+    algorithm = kwargs.pop('compression',None)
+    level = kwargs.pop('compressionLevel',None)
+    basketSize = kwargs.pop('basketSize',None)
+    autoFlush = kwargs.pop('autoFlush',None)
+
+    if algorithm is not None or level is not None:
+        if algorithm is not None and algorithm not in COMPRESSION_ALGORITHMS:
+            raise ValueError('Unknown compression algorithm %s, use one of %s' % (algorithm, ', '.join(sorted(COMPRESSION_ALGORITHMS))))
+        settings = (COMPRESSION_ALGORITHMS[algorithm] if algorithm is not None else rtFile.GetCompressionAlgorithm())*100
+        settings += level if level is not None else rtFile.GetCompressionLevel()
+        rtFile.SetCompressionSettings(settings)
+        # the branches keep the settings of the file at the time they were created
+        for branch in tree.GetListOfBranches():
+            branch.SetCompressionSettings(settings)
+    if basketSize is not None: tree.SetBasketSize('*', basketSize)
+    if autoFlush is not None: tree.SetAutoFlush(autoFlush)
+
+def parseLeafList(leaflist):
+    '''
+    Return the variable names, types and array lengths (1 for a single value) of a
+    leaflist (i.e. 'Pt/F:Eta:Chg/I' or 'channel[9]/C'). The type of a variable without
+    one is carried over from the previous variable.
+    '''
+    leaves = []
+    leafType = 'F'
+    for leaf in leaflist.split(':'):
+        if '/' in leaf: leaf, leafType = leaf.split('/')
+        length = 1
+        if '[' in leaf:
+            leaf, length = leaf.rstrip(']').split('[')
+            length = int(length)
+        leaves += [(leaf, leafType, length)]
+    return leaves
+
+class RowWriter(object):
+    '''
+    Writes rows to an ntuple built by buildNtuple.
+
+    Each row is a preallocated RowBuffer holding one slot per "branch.var" of the schema.
+    The write plan binds, once per slot, the ctypes field setter of the variable to a
+    ctypes view of the memory of its ntuple struct. Writing a row converts each set value
+    to the type of its variable directly into the struct, without a setattr on the ROOT
+    object. Unset slots are not written, leaving the struct value of the previous row as
+    before. Rows are kept per event key until written, a new row for an existing key
+    overwrites it in place, and released rows are reused.
+    '''
+    def __init__(self, branches, schema):
+        self.targets = []
+        self.index = {}
+        self.views = []
+        for branch, leaflist in schema:
+            struct = branches[branch]
+            layout = _structLayouts[type(struct)]
+            variables = [(var, length) for var, leafType, length in parseLeafList(leaflist)]
+            if variables != [(field, getattr(fieldType, '_length_', 1)) for field, fieldType in layout._fields_]:
+                raise ValueError('Leaflist %s does not match the struct of branch %s' % (leaflist, branch))
+            # the view shares the memory of the struct, it is kept alive with the writer
+            view = layout.from_address(structAddress(struct))
+            self.views += [view]
+            for var, fieldType in layout._fields_:
+                self.index['%s.%s' % (branch,var)] = len(self.targets)
+                self.targets += [(getattr(layout, var).__set__, view)]
+        self.empty = (None,) * len(self.targets)
+        self.rows = {}
+        self.free = []
+
+    def new_row(self):
+        '''
+        Return a cleared row not attached to an event key.
+        '''
+        row = self.free.pop() if self.free else RowBuffer(self.index, len(self.targets))
+        row.values[:] = self.empty
+        return row
+
+    def row(self, key):
+        '''
+        Return a cleared row for an event key, the row of a previous candidate is reused.
+        '''
+        if key in self.rows:
+            row = self.rows[key]
+            row.values[:] = self.empty
+        else:
+            row = self.new_row()
+            self.rows[key] = row
+        return row
+
+    def write(self, row):
+        '''
+        Copy the set values of a row to the ntuple structs.
+        '''
+        for (setter, view), val in zip(self.targets, row.values):
+            if val is None: continue
+            try:
+                setter(view, val)
+            except TypeError:
+                # a float stored in an Int_t variable
+                setter(view, int(val))
+
+    def clear(self):
+        '''
+        Release all rows for reuse.
+        '''
+        self.free += self.rows.values()
+        self.rows = {}
+
+class RowBuffer(object):
+    '''
+    Preallocated values of a row, set with row["branch.var"] = val.
+        row.values          list of the values, None for the unset variables
+        row.dump()          the row as a picklable list
+        row.load(data)      set the row from the result of dump
+    '''
+    __slots__ = ['index', 'values']
+
+    def __init__(self, index, size):
+        self.index = index
+        self.values = [None] * size
+
+    def __setitem__(self, key, val):
+        self.values[self.index[key]] = val
 
-    return (tree, allBranches)
+    def __getitem__(self, key):
+        return self.values[self.index[key]]
 
-    
+    def dump(self):
+        return list(self.values)
 
+    def load(self, data):
+        self.values[:] = data
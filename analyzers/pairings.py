@@ -0,0 +1,88 @@
+'''
+Pairing tables for the combinatoric candidate selection of the analyzers.
+
+A candidate is a permutation of the objects of a final state in which some
+positions form pairs (i.e. (0,1) for a Z candidate). Only permutations where
+every pair is in FSA order (see lep_order) are valid. The valid permutations
+and the pairs they use are enumerated once per final state, so that for each
+event the pair variables (i.e. e1_m1_Mass) are read once and the candidates
+are ranked with numpy.
+
+Author: Devin N. Taylor, UW-Madison
+'''
+
+from itertools import permutations
+import numpy as np
+
+def lep_order(a, b):
+    '''
+    A simple function to guarantee order of leptons in FSA ntuples.
+    '''
+    if len(a)==2 and len(b)==2:
+        a_index = int(a[1])
+        b_index = int(b[1])
+        return a_index > b_index or a[0] > b[0]
+    return a[0] > b[0]
+
+def ordered(a,b):
+    '''
+    Return a,b in lep order.
+    '''
+    return [a,b] if lep_order(b,a) else [b,a]
+
+class PairingTable(object):
+    '''
+    The valid permutations of the objects of a final state for the given pair positions,
+    in the order of itertools.permutations.
+        table.pair_values(rtrow, plan.Mass)     values of the distinct pairs
+        table.object_values(rtrow, plan.Pt)     values of the objects
+        table.at_pair(vals, k)                  value of pair k for each permutation
+        table.at(vals, pos)                     value of the object at position pos for each permutation
+        table.sameFlavor[k]                     pair k is same flavor for each permutation
+        table.names(i)                          object names of permutation i
+    '''
+    def __init__(self, objects, pairs):
+        self.objects = list(objects)
+        self.pairs = tuple(pairs)
+        perms = [l for l in permutations(range(len(self.objects)))
+                 if not any(lep_order(self.objects[l[a]], self.objects[l[b]]) for a, b in self.pairs)]
+        self.size = len(perms)
+        self.perms = np.array(perms, dtype=np.int64).reshape(self.size, len(self.objects))
+        self.pairList = []
+        pairIndex = {}
+        self.pairIndex = []
+        self.sameFlavor = []
+        for a, b in self.pairs:
+            indices = []
+            for l in perms:
+                pair = (l[a], l[b])
+                if pair not in pairIndex:
+                    pairIndex[pair] = len(self.pairList)
+                    self.pairList.append(pair)
+                indices.append(pairIndex[pair])
+            self.pairIndex.append(np.array(indices, dtype=np.int64))
+            self.sameFlavor.append(np.array([self.objects[l[a]][0]==self.objects[l[b]][0] for l in perms], dtype=bool))
+        self.objectNames = [[self.objects[x] for x in l] for l in perms]
+
+    def pair_values(self, rtrow, branches):
+        return np.array([getattr(rtrow, branches[a][b]) for a, b in self.pairList], dtype=np.float64)
+
+    def object_values(self, rtrow, branches):
+        return np.array([getattr(rtrow, b) for b in branches], dtype=np.float64)
+
+    def at_pair(self, vals, k):
+        return vals[self.pairIndex[k]]
+
+    def at(self, vals, pos):
+        return vals[self.perms[:,pos]]
+
+    def names(self, i):
+        return list(self.objectNames[i])
+
+def first_min(vals, mask):
+    '''
+    Index of the first minimum of vals where mask is true (-1 if none).
+    '''
+    indices = np.flatnonzero(mask)
+    if not len(indices): return -1
+    return indices[np.argmin(vals[indices])]
@@ -1,6 +1,7 @@
 import sys
 import os
 import json
+import numpy as np
 
 from math import floor
 
@@ -9,15 +10,90 @@ import ROOT as rt
 sys.argv.pop()
 
 
+def load_profile(path):
+    '''
+    Read a json {"nTruePU bin": weight} into a dense array indexed by the bin.
+    The bins must run from 0 without gaps.
+    '''
+    with open(path, 'r') as pu_file:
+        pu_weights = json.load(pu_file)
+    bins = dict((int(b), w) for b, w in pu_weights.iteritems())
+    missing = sorted(set(range(max(bins)+1)) - set(bins))
+    if missing:
+        raise ValueError('Pileup profile %s is missing nTruePU bins %s' % (path, ', '.join(str(b) for b in missing)))
+    return np.array([bins[b] for b in range(len(bins))], dtype=np.float64)
+
 class PileupWeights(object):
+    '''
+    Pileup weights indexed by the integer bin of nTruePU, weight 1 for nTruePU < 0.
+    An nTruePU beyond the profiles raises IndexError.
+        pu.weight(rtrow)                nominal weight of a row
+        pu.row_weights(rtrow)           weights of all profiles for a row
+        pu.variations(rtrow)            nominal, up and down weights for a row
+        pu.weights(nTruePU)             array (profile, event) of weights for an array of nTruePU
+    kwargs:
+        profiles    {name: json file}, default the nominal pu_weights.json and pu_weights_up.json,
+                    pu_weights_down.json if present
+    '''
 
-    def __init__(self):
-        path = os.path.join(os.path.dirname(__file__), 'pu_weights.json')
-        with open(path, 'r') as pu_file:
-            self.pu_weights = json.load(pu_file)
+    def __init__(self, **kwargs):
+        profiles = kwargs.pop('profiles', None)
+        if profiles is None:
+            profiles = {}
+            for name, fileName in [('nominal', 'pu_weights.json'), ('up', 'pu_weights_up.json'), ('down', 'pu_weights_down.json')]:
+                path = os.path.join(os.path.dirname(__file__), fileName)
+                if name=='nominal' or os.path.isfile(path): profiles[name] = path
+        order = ['nominal', 'up', 'down']
+        self.profiles = sorted(profiles, key=lambda p: (order.index(p) if p in order else len(order), p))
+        tables = [load_profile(profiles[p]) for p in self.profiles]
+        numBins = len(tables[0])
+        for p, t in zip(self.profiles, tables):
+            if len(t) != numBins:
+                raise ValueError('Pileup profile %s has %i nTruePU bins, %s has %i' % (p, len(t), self.profiles[0], numBins))
+        self.table = np.array(tables)
+        self.rows = [tuple(float(w) for w in self.table[:,b]) for b in range(numBins)]
+        self.nominal = list(self.table[self.profiles.index('nominal') if 'nominal' in self.profiles else 0])
+        self.ones = tuple(1. for p in self.profiles)
+        nominal = self.profiles.index('nominal') if 'nominal' in self.profiles else 0
+        self.variationIndex = [self.profiles.index(p) if p in self.profiles else nominal for p in ['nominal', 'up', 'down']]
 
     def weight(self, rtrow):
         if rtrow.nTruePU < 0:
             return 1
         else:
-            return self.pu_weights[str(int(floor(rtrow.nTruePU)))]
+            return self.nominal[int(floor(rtrow.nTruePU))]
+
+    def row_weights(self, rtrow):
+        '''
+        Weights of all profiles (in the order of self.profiles) for a row.
+        '''
+        if rtrow.nTruePU < 0: return self.ones
+        return self.rows[int(floor(rtrow.nTruePU))]
+
+    def has_variations(self):
+        '''
+        True if both the up and down profiles are loaded.
+        '''
+        return 'up' in self.profiles and 'down' in self.profiles
+
+    def variations(self, rtrow):
+        '''
+        Nominal, up and down weights of a row, the nominal weight for a missing profile
+        (see has_variations).
+        '''
+        weights = self.row_weights(rtrow)
+        return [weights[i] for i in self.variationIndex]
+
+    def weights(self, nTruePU):
+        '''
+        Weights of all profiles for an array of nTruePU, an array of shape
+        (len(self.profiles), len(nTruePU)).
+        '''
+        nTruePU = np.asarray(nTruePU, dtype=np.float64)
+        out = np.ones((len(self.profiles), len(nTruePU)))
+        mc = ~(nTruePU < 0)
+        bins = np.floor(nTruePU[mc]).astype(np.int64)
+        if len(bins) and bins.max() >= self.table.shape[1]:
+            raise IndexError('PileupWeights: nTruePU %i outside of the pileup profiles' % bins.max())
+        out[:,mc] = self.table[:,bins]
+        return out
@@ -1,29 +1,73 @@
 import sys
 import os
 import glob
-import FinalStateAnalysis.TagAndProbe.MuonPOGCorrections as MuonPOGCorrections
-import FinalStateAnalysis.TagAndProbe.H2TauCorrections as H2TauCorrections
+import numpy as np
+try:
+    import FinalStateAnalysis.TagAndProbe.MuonPOGCorrections as MuonPOGCorrections
+    import FinalStateAnalysis.TagAndProbe.H2TauCorrections as H2TauCorrections
+except ImportError:
+    MuonPOGCorrections = None
+    H2TauCorrections = None
 
 sys.argv.append('-b')
 import ROOT as rt
 sys.argv.pop()
 
+from grids import LookupGrid, BinnedCorrection
 
-class LeptonScaleFactors(object):
-
-    def __init__(self):
-        path = os.path.join(os.path.dirname(__file__),
-                            'CombinedMethod_ScaleFactors_RecoIdIsoSip.root')
-        self.e_rtfile = rt.TFile(path, 'READ')
-        self.e_hist = self.e_rtfile.Get("h_electronScaleFactor_RecoIdIsoSip")
-
-        path = os.path.join(os.path.dirname(__file__),
-                            'MuonScaleFactors_2011_2012.root')
-        self.m_rtfile = rt.TFile(path, 'READ')
-        self.m_hist = self.m_rtfile.Get("TH2D_ALL_2012")
+TABLES = os.path.join(os.path.dirname(__file__), 'scale_factors.npz')
 
-        self.muPOGId = MuonPOGCorrections.make_muon_pog_PFTight_2012()
-        self.muPOGIso = MuonPOGCorrections.make_muon_pog_PFRelIsoDB012_2012()
+class LeptonScaleFactors(object):
+    '''
+    Lepton scale factors from numpy lookup grids.
+    kwargs:
+        tables          exported tables to load instead of the ROOT files (default scale_factors.npz if present)
+        correctionBins  {'e': (ptEdges, etaEdges), 'm': ...} memoize the tight corrections on these bins,
+                        the tight corrections must be constant in each bin
+    Without FinalStateAnalysis the tight scale factors are read from the exported tables,
+    which include them if correctionBins were given at export.
+    '''
+
+    def __init__(self, **kwargs):
+        tables = kwargs.pop('tables', TABLES if os.path.isfile(TABLES) else None)
+        correctionBins = kwargs.pop('correctionBins', {})
+
+        tightGrids = {}
+        if tables:
+            arrays = np.load(tables)
+            self.e_grid = LookupGrid.from_arrays(arrays, 'e')
+            self.m_grid = LookupGrid.from_arrays(arrays, 'm')
+            for l in 'em':
+                if '%s_tight_contents' % l in arrays.files:
+                    tightGrids[l] = LookupGrid.from_arrays(arrays, '%s_tight' % l)
+        else:
+            path = os.path.join(os.path.dirname(__file__),
+                                'CombinedMethod_ScaleFactors_RecoIdIsoSip.root')
+            e_rtfile = rt.TFile(path, 'READ')
+            self.e_grid = LookupGrid.from_hist(e_rtfile.Get("h_electronScaleFactor_RecoIdIsoSip"))
+            e_rtfile.Close()
+
+            path = os.path.join(os.path.dirname(__file__),
+                                'MuonScaleFactors_2011_2012.root')
+            m_rtfile = rt.TFile(path, 'READ')
+            self.m_grid = LookupGrid.from_hist(m_rtfile.Get("TH2D_ALL_2012"))
+            m_rtfile.Close()
+
+        self.corrections = {}
+        if H2TauCorrections is not None:
+            self.muPOGId = MuonPOGCorrections.make_muon_pog_PFTight_2012()
+            self.muPOGIso = MuonPOGCorrections.make_muon_pog_PFRelIsoDB012_2012()
+            corrections = {
+                'e': H2TauCorrections.correct_e_idiso_2012,
+                'm': H2TauCorrections.correct_mu_idiso_2012,
+            }
+            for l, fun in corrections.iteritems():
+                if l in correctionBins:
+                    self.corrections[l] = BinnedCorrection(fun, *correctionBins[l])
+                else:
+                    self.corrections[l] = fun
+        else:
+            self.corrections.update(tightGrids)
 
     def scale_factor(self, row, *lep_list, **kwargs):
         tight = kwargs.pop('tight',False)
@@ -44,11 +88,76 @@ class LeptonScaleFactors(object):
 
         return out
 
+    def has_variations(self, **kwargs):
+        '''
+        True if the scale factors have an uncertainty, the tight corrections have none.
+        '''
+        tight = kwargs.pop('tight',False)
+        return not tight
+
+    def scale_factor_variations(self, row, *lep_list, **kwargs):
+        '''
+        Nominal, up and down scale factors, shifting all leptons together by the
+        errors of the scale factor histograms. The tight corrections have no
+        uncertainty and are the same for all three.
+        '''
+        tight = kwargs.pop('tight',False)
+        out = [1.0, 1.0, 1.0]
+        for l in lep_list:
+            lep_type = l[0]
+            if lep_type not in 'emt':
+                raise TypeError("Lepton type %s not recognized" % lep_type)
+            if lep_type == 't': continue # TODO
+            if tight:
+                scl = self.m_tight_scale(row, l) if lep_type == 'm' else self.e_tight_scale(row, l)
+                shifts = [scl, scl, scl]
+            else:
+                shifts = self.grid_variations(self.e_grid if lep_type == 'e' else self.m_grid, row, l)
+            out = [x*y for x, y in zip(out, shifts)]
+        return out
+
+    def grid_variations(self, grid, row, l):
+        pt = getattr(row, "%sPt" % l)
+        eta = getattr(row, "%sEta" % l)
+        scl = grid.value(pt, eta)
+        if scl < 0.1: return [1.0, 1.0, 1.0]
+        err = grid.error(pt, eta)
+        return [scl, scl+err, scl-err]
+
+    def scale_factor_columnar(self, chunk, *lep_list, **kwargs):
+        '''
+        Columnar version of scale_factor over a chunk of rows (see columnar.py).
+        '''
+        tight = kwargs.pop('tight',False)
+        out = np.ones(len(chunk))
+        for l in lep_list:
+            lep_type = l[0]
+            if lep_type not in 'emt':
+                raise TypeError("Lepton type %s not recognized" % lep_type)
+            if lep_type == 't': continue # TODO
+            pt = chunk['%sPt' % l]
+            eta = chunk['%sEta' % l]
+            if tight:
+                out *= self.tight_values(lep_type, pt, np.abs(eta) if lep_type == 'e' else eta)
+            else:
+                scl = (self.e_grid if lep_type == 'e' else self.m_grid).values(pt, eta)
+                out *= np.where(scl < 0.1, 1.0, scl)
+        return out
+
+    def correction(self, lep_type):
+        if lep_type not in self.corrections:
+            raise ImportError("Tight %s scale factors need FinalStateAnalysis or tables exported with correctionBins" % lep_type)
+        return self.corrections[lep_type]
+
+    def tight_values(self, lep_type, pt, eta):
+        fun = self.correction(lep_type)
+        if hasattr(fun, 'values'): return fun.values(pt, eta)
+        return np.array([fun(x, y) for x, y in zip(pt, eta)], dtype=np.float64)
+
     def e_scale(self, row, l):
         pt = getattr(row, "%sPt" % l)
         eta = getattr(row, "%sEta" % l)
-        global_bin = self.e_hist.FindBin(pt, eta)
-        scl = self.e_hist.GetBinContent(global_bin)
+        scl = self.e_grid.value(pt, eta)
 
         if scl < 0.1:
             scl = 1.0
@@ -58,14 +167,13 @@ class LeptonScaleFactors(object):
     def e_tight_scale(self, row, l):
         pt = getattr(row, "%sPt" % l)
         eta = getattr(row, "%sEta" % l)
-        return H2TauCorrections.correct_e_idiso_2012(pt,abs(eta))
+        return self.correction('e')(pt,abs(eta))
         #return 1.
 
     def m_scale(self, row, l):
         pt = getattr(row, "%sPt" % l)
         eta = getattr(row, "%sEta" % l)
-        global_bin = self.m_hist.FindBin(pt, eta)
-        scl = self.m_hist.GetBinContent(global_bin)
+        scl = self.m_grid.value(pt, eta)
 
         if scl < 0.1:
             scl = 1.0
@@ -76,9 +184,21 @@ class LeptonScaleFactors(object):
         pt = getattr(row, "%sPt" % l)
         eta = getattr(row, "%sEta" % l)
         #return self.muPOGId(pt,eta) * self.muPOGIso(pt,eta)
-        return H2TauCorrections.correct_mu_idiso_2012(pt,eta)
+        return self.correction('m')(pt,eta)
         #return 1.0
 
+    def export(self, fileName=TABLES):
+        '''
+        Save the lookup grids to a numpy .npz file, including the tight corrections
+        memoized with correctionBins.
+        '''
+        arrays = {}
+        arrays.update(self.e_grid.arrays('e'))
+        arrays.update(self.m_grid.arrays('m'))
+        for l, fun in self.corrections.iteritems():
+            if isinstance(fun, BinnedCorrection): arrays.update(fun.grid().arrays('%s_tight' % l))
+            if isinstance(fun, LookupGrid): arrays.update(fun.arrays('%s_tight' % l))
+        np.savez(fileName, **arrays)
+
     def close(self):
-        self.e_rtfile.Close()
-        self.m_rtfile.Close()
+        pass
@@ -0,0 +1,129 @@
+'''
+NumPy lookup grids for binned scale factors.
+
+A LookupGrid holds the bin edges and contents (including the under and
+overflow bins) of a TH2, so lookups follow TH2::FindBin without going
+through PyROOT. BinnedCorrection memoizes a correction callable on the bins
+of a grid.
+
+Author: Devin N. Taylor, UW-Madison
+'''
+
+from bisect import bisect_right
+import numpy as np
+
+class LookupGrid(object):
+    '''
+    Bin edges and contents of a 2D histogram.
+        grid.value(x, y)            content of the bin of (x, y), also grid(x, y)
+        grid.values(xs, ys)         contents for arrays of x and y
+        grid.bins(xs, ys)           (ix, iy) bin indices for arrays of x and y
+        grid.error(x, y)            error of the bin of (x, y) (0 if no errors given)
+    Bin indices follow ROOT: 0 is the underflow, len(edges) the overflow, and
+    bins include their lower edge.
+    '''
+    def __init__(self, xEdges, yEdges, contents, errors=None):
+        self.xEdges = np.asarray(xEdges, dtype=np.float64)
+        self.yEdges = np.asarray(yEdges, dtype=np.float64)
+        self.contents = np.asarray(contents, dtype=np.float64)
+        if self.contents.shape != (len(self.xEdges)+1, len(self.yEdges)+1):
+            raise ValueError('LookupGrid: expected contents of shape (%i, %i), got %s'
+                             % (len(self.xEdges)+1, len(self.yEdges)+1, self.contents.shape))
+        self.errors = np.zeros(self.contents.shape) if errors is None else np.asarray(errors, dtype=np.float64)
+        self.xList = list(self.xEdges)
+        self.yList = list(self.yEdges)
+
+    @classmethod
+    def from_hist(cls, hist):
+        '''
+        Export a TH2 to a grid.
+        '''
+        xAxis = hist.GetXaxis()
+        yAxis = hist.GetYaxis()
+        nx = hist.GetNbinsX()
+        ny = hist.GetNbinsY()
+        xEdges = [xAxis.GetBinLowEdge(i) for i in range(1, nx+2)]
+        yEdges = [yAxis.GetBinLowEdge(j) for j in range(1, ny+2)]
+        contents = [[hist.GetBinContent(i, j) for j in range(ny+2)] for i in range(nx+2)]
+        errors = [[hist.GetBinError(i, j) for j in range(ny+2)] for i in range(nx+2)]
+        return cls(xEdges, yEdges, contents, errors)
+
+    def bin(self, x, y):
+        return bisect_right(self.xList, x), bisect_right(self.yList, y)
+
+    def value(self, x, y):
+        ix, iy = self.bin(x, y)
+        return float(self.contents[ix, iy])
+
+    __call__ = value
+
+    def error(self, x, y):
+        ix, iy = self.bin(x, y)
+        return float(self.errors[ix, iy])
+
+    def bins(self, xs, ys):
+        return np.searchsorted(self.xEdges, xs, side='right'), np.searchsorted(self.yEdges, ys, side='right')
+
+    def values(self, xs, ys):
+        ix, iy = self.bins(xs, ys)
+        return self.contents[ix, iy]
+
+    def arrays(self, prefix):
+        '''
+        The grid as arrays for numpy.savez, see from_arrays.
+        '''
+        return {
+            '%s_xedges' % prefix: self.xEdges,
+            '%s_yedges' % prefix: self.yEdges,
+            '%s_contents' % prefix: self.contents,
+            '%s_errors' % prefix: self.errors,
+        }
+
+    @classmethod
+    def from_arrays(cls, arrays, prefix):
+        errors = arrays['%s_errors' % prefix] if '%s_errors' % prefix in arrays else None
+        return cls(arrays['%s_xedges' % prefix], arrays['%s_yedges' % prefix], arrays['%s_contents' % prefix], errors)
+
+class BinnedCorrection(object):
+    '''
+    Memoize a correction fun(x, y) that is constant in the bins of the given
+    edges (including the under and overflow bins). The first (x, y) seen in a
+    bin sets the value of the bin.
+        correction = BinnedCorrection(fun, xEdges, yEdges)
+        correction(x, y)
+        correction.values(xs, ys)
+        correction.grid()           tabulate fun at the bin centers
+    '''
+    def __init__(self, fun, xEdges, yEdges):
+        self.fun = fun
+        self.xEdges = np.asarray(xEdges, dtype=np.float64)
+        self.yEdges = np.asarray(yEdges, dtype=np.float64)
+        self.xList = list(self.xEdges)
+        self.yList = list(self.yEdges)
+        self.cache = {}
+
+    def __call__(self, x, y):
+        key = (bisect_right(self.xList, x), bisect_right(self.yList, y))
+        if key not in self.cache:
+            self.cache[key] = self.fun(x, y)
+        return self.cache[key]
+
+    def values(self, xs, ys):
+        xs = np.asarray(xs, dtype=np.float64)
+        ys = np.asarray(ys, dtype=np.float64)
+        ix = np.searchsorted(self.xEdges, xs, side='right')
+        iy = np.searchsorted(self.yEdges, ys, side='right')
+        flat = ix*(len(self.yEdges)+1) + iy
+        _, first, inverse = np.unique(flat, return_index=True, return_inverse=True)
+        vals = np.array([self(xs[i], ys[i]) for i in first], dtype=np.float64)
+        return vals[inverse]
+
+    def grid(self):
+        '''
+        Tabulate the correction at the bin centers, the under and overflow bins
+        at the first and last edge.
+        '''
+        def centers(edges):
+            return [edges[0]-1.] + list(0.5*(edges[:-1]+edges[1:])) + [edges[-1]]
+        contents = [[self.fun(x, y) for y in centers(self.yEdges)] for x in centers(self.xEdges)]
+        return LookupGrid(self.xEdges, self.yEdges, contents)
@@ -0,0 +1,125 @@
+'''
+Columnar sidecar of the ISA ntuple.
+
+Next to the output ntuple (i.e. ntuples/sample.root) the analyzer can write a
+directory ntuples/sample.columns with one raw little endian array per
+"branch.var" of the ntuple and a schema.json describing them. A column holds
+the value the ntuple stores for every entry, so it can be memory mapped and
+used without ROOT:
+
+    columns = load_columns('ntuples/sample.columns', ['event.pu_weight', 'z1.mass'])
+    columns['z1.mass'][columns['select.passTight']==1]
+
+Author: Devin N. Taylor, UW-Madison
+'''
+
+import os
+import json
+import numpy as np
+
+from ntuples import parseLeafList
+
+SCHEMA = 'schema.json'
+
+DTYPES = {
+    'I': '<i4',
+    'F': '<f4',
+    'C': 'S%i', # the length of the Char_t array
+}
+
+def column_name(branch, var):
+    return '%s.%s' % (branch, var)
+
+class ColumnSidecar(object):
+    '''
+    Writes the entries of an ntuple built by buildNtuple to column files.
+        sidecar.fill(row.values)    add an entry from the values of a RowBuffer
+        sidecar.flush()             append the buffered entries to the column files
+        sidecar.truncate(n)         keep the first n entries of the column files, 0 to start
+                                    a new sidecar, must be called before filling
+        sidecar.close()             flush and write the schema
+    Values left unset in a row keep the value of the previous entry, as the ntuple
+    structs do.
+    kwargs:
+        bufferSize  number of entries buffered before they are appended (default 10000)
+    '''
+    def __init__(self, directory, schema, **kwargs):
+        self.bufferSize = kwargs.pop('bufferSize',10000)
+        self.directory = directory
+        self.schema = schema
+        self.columns = []
+        for branch, leaflist in schema:
+            for var, leafType, length in parseLeafList(leaflist):
+                self.columns += [(column_name(branch, var), DTYPES[leafType] % length if leafType == 'C' else DTYPES[leafType])]
+        if not os.path.isdir(directory): os.makedirs(directory)
+        self.fileNames = [os.path.join(directory, '%s.bin' % name) for name, dtype in self.columns]
+        self.initial = [np.zeros(1, dtype=dtype)[0] for name, dtype in self.columns]
+        self.buffer = []
+        self.current = list(self.initial)
+        self.numEntries = None
+        # the schema marks a complete sidecar, it is written by close
+        if os.path.exists(os.path.join(directory, SCHEMA)): os.remove(os.path.join(directory, SCHEMA))
+
+    def truncate(self, numEntries):
+        '''
+        Keep the first numEntries entries of the column files, the next entry starts
+        from the values of the last one kept.
+        '''
+        self.buffer = []
+        self.current = list(self.initial)
+        for fileName, (name, dtype) in zip(self.fileNames, self.columns):
+            with open(fileName, 'ab') as columnFile:
+                columnFile.truncate(numEntries*np.dtype(dtype).itemsize)
+        self.numEntries = numEntries
+        if numEntries:
+            for i, (fileName, (name, dtype)) in enumerate(zip(self.fileNames, self.columns)):
+                self.current[i] = np.memmap(fileName, dtype=dtype, mode='r', shape=(numEntries,))[-1]
+
+    def fill(self, values):
+        current = self.current
+        for i, val in enumerate(values):
+            if val is not None: current[i] = val
+        self.buffer.append(tuple(current))
+        if len(self.buffer) >= self.bufferSize: self.flush()
+
+    def flush(self):
+        if not self.buffer: return
+        for fileName, (name, dtype), column in zip(self.fileNames, self.columns, zip(*self.buffer)):
+            with open(fileName, 'ab') as columnFile:
+                np.array(column, dtype=dtype).tofile(columnFile)
+        self.numEntries += len(self.buffer)
+        self.buffer = []
+
+    def close(self):
+        self.flush()
+        schema = {
+            'numEntries': self.numEntries,
+            'branches': [[branch, leaflist] for branch, leaflist in self.schema],
+            'columns': [{'name': name, 'dtype': dtype, 'file': os.path.basename(fileName)}
+                        for fileName, (name, dtype) in zip(self.fileNames, self.columns)],
+        }
+        schemaName = os.path.join(self.directory, SCHEMA)
+        with open(schemaName+'.tmp', 'w') as schemaFile:
+            json.dump(schema, schemaFile, indent=1)
+        os.rename(schemaName+'.tmp', schemaName)
+
+def load_schema(directory):
+    with open(os.path.join(directory, SCHEMA)) as schemaFile:
+        return json.load(schemaFile)
+
+def load_columns(directory, columns=None):
+    '''
+    Memory map the columns of a sidecar (default all), returns {"branch.var": array}.
+    '''
+    schema = load_schema(directory)
+    numEntries = schema['numEntries']
+    available = dict((c['name'], c) for c in schema['columns'])
+    out = {}
+    for name in (columns if columns is not None else [c['name'] for c in schema['columns']]):
+        if name not in available: raise KeyError('Column %s not in sidecar %s' % (name, directory))
+        column = available[name]
+        if numEntries:
+            out[name] = np.memmap(os.path.join(directory, column['file']), dtype=column['dtype'], mode='r', shape=(numEntries,))
+        else:
+            out[name] = np.zeros(0, dtype=column['dtype'])
+    return out
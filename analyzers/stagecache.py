@@ -0,0 +1,253 @@
+'''
+stagecache.py
+
+A local staging cache for the FSA input files. Reading the same files from
+/hdfs on every pass is slow, so the files are copied to a local directory
+(i.e. an SSD scratch area) and read from there:
+
+    cache = StageCache('/scratch/isa_stage', budget=50e9)
+    cache.prefetch('/hdfs/.../sample/file2.root')       # copied in the background
+    local = cache.fetch('/hdfs/.../sample/file1.root')  # the local copy
+    ...
+    cache.release('/hdfs/.../sample/file1.root')
+
+A cached file is keyed by the path, size and mtime of the source, so a
+changed input is staged again. The mtime of a cached file is the time of its
+last use and the least recently used files are removed when staging a file
+would exceed the size budget. Any directory works as a source, the cache
+only copies files.
+
+The cache directory may be shared by the processes of a machine. The
+eviction and the reservation of space for a copy are done under an flock of
+[directory]/.lock. A copy in progress is written to
+.[name].[pid].[thread].[size].part, counted with its full size against the
+budget, and renamed into place. A file fetched or prefetched and not yet
+released is pinned by .[name].[pid].pin and is not removed by any process.
+Temporary and pin files of dead processes are removed.
+
+Author: Devin N. Taylor, UW-Madison
+'''
+import os
+import time
+import errno
+import fcntl
+import shutil
+import hashlib
+import threading
+from contextlib import contextmanager
+
+LOCK = '.lock'
+
+def pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno == errno.EPERM
+    return True
+
+class StageCache(object):
+    '''
+    Copy input files to a local directory of bounded size (see module docstring).
+    kwargs:
+        budget  size of the cache directory in bytes (default 50 GB)
+    '''
+    def __init__(self, directory, **kwargs):
+        self.directory = directory
+        self.budget = kwargs.pop('budget',50e9)
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                if not os.path.isdir(directory): raise
+        self.lock = threading.RLock()
+        self.pending = {}
+        self.inUse = {}
+        self.fetched = {}
+        self.stats = {'hits': 0, 'misses': 0, 'bytes': 0, 'copyTime': 0., 'evicted': 0}
+
+    @contextmanager
+    def locked(self):
+        '''
+        Hold the lock of the cache directory (not reentrant).
+        '''
+        with self.lock:
+            with open(os.path.join(self.directory, LOCK), 'a') as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def cache_name(self, path):
+        '''
+        Name of the cached copy of a file, from the path, size and mtime of the source.
+        '''
+        stat = os.stat(path)
+        key = hashlib.sha1('%s:%i:%i' % (os.path.abspath(path), stat.st_size, int(stat.st_mtime))).hexdigest()
+        return os.path.join(self.directory, '%s_%s' % (key[:16], os.path.basename(path)))
+
+    def pin_name(self, cacheName):
+        return os.path.join(self.directory, '.%s.%i.pin' % (os.path.basename(cacheName), os.getpid()))
+
+    def directory_state(self):
+        '''
+        The cached files as (last use, size, name), the bytes reserved by the copies in
+        progress and the pinned cached files. The temporary and pin files of dead processes
+        are removed. Called with the directory locked.
+        '''
+        files = []
+        reserved = 0
+        pinned = set()
+        for fileName in os.listdir(self.directory):
+            path = os.path.join(self.directory, fileName)
+            if not fileName.startswith('.'):
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                files += [(stat.st_mtime, stat.st_size, path)]
+                continue
+            if fileName.endswith('.pin'):
+                name, pid, _ = fileName[1:].rsplit('.', 2)
+                if pid_alive(int(pid)): pinned.add(os.path.join(self.directory, name))
+                else: os.remove(path)
+            elif fileName.endswith('.part'):
+                name, pid, thread, size, _ = fileName[1:].rsplit('.', 4)
+                if pid_alive(int(pid)): reserved += int(size)
+                else: os.remove(path)
+        return sorted(files), reserved, pinned
+
+    def evict(self, size):
+        '''
+        Remove the least recently used files not pinned until size bytes fit in the budget.
+        Returns False if they do not fit. Called with the directory locked.
+        '''
+        files, reserved, pinned = self.directory_state()
+        used = reserved + sum(fileSize for lastUse, fileSize, path in files)
+        for lastUse, fileSize, path in files:
+            if used + size <= self.budget: break
+            if path in pinned: continue
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            used -= fileSize
+            self.stats['evicted'] += 1
+        return used + size <= self.budget
+
+    def pin(self, cacheName):
+        if not self.inUse.get(cacheName): open(self.pin_name(cacheName), 'a').close()
+        self.inUse[cacheName] = self.inUse.get(cacheName, 0) + 1
+
+    def unpin(self, cacheName):
+        if cacheName not in self.inUse: return
+        self.inUse[cacheName] -= 1
+        if self.inUse[cacheName]: return
+        del self.inUse[cacheName]
+        if os.path.exists(self.pin_name(cacheName)): os.remove(self.pin_name(cacheName))
+
+    def stage(self, path):
+        '''
+        Copy a file to the cache unless already there and pin it. Returns the cached name
+        or the source if it does not fit in the budget.
+        '''
+        cacheName = self.cache_name(path)
+        with self.locked():
+            if os.path.exists(cacheName):
+                self.stats['hits'] += 1
+                os.utime(cacheName, None)
+                self.pin(cacheName)
+                return cacheName
+            size = os.path.getsize(path)
+            if not self.evict(size): return path
+            self.pin(cacheName)
+            # reserve the space of the copy
+            tmpName = os.path.join(self.directory, '.%s.%i.%i.%i.part' % (os.path.basename(cacheName), os.getpid(), threading.current_thread().ident, size))
+            open(tmpName, 'w').close()
+        start = time.time()
+        try:
+            shutil.copyfile(path, tmpName)
+            os.rename(tmpName, cacheName)
+        except:
+            if os.path.exists(tmpName): os.remove(tmpName)
+            with self.locked():
+                self.unpin(cacheName)
+            raise
+        with self.lock:
+            self.stats['misses'] += 1
+            self.stats['bytes'] += size
+            self.stats['copyTime'] += time.time() - start
+        return cacheName
+
+    def prefetch(self, path):
+        '''
+        Stage a file in a background thread.
+        '''
+        with self.lock:
+            if path in self.pending: return
+            pending = [None, path]
+            pending[0] = threading.Thread(target=self._prefetch, args=(path, pending))
+            pending[0].daemon = True
+            self.pending[path] = pending
+        pending[0].start()
+
+    def _prefetch(self, path, pending):
+        '''
+        Stage a file, the cached name (or the source if staging failed) goes to pending[1].
+        '''
+        try:
+            pending[1] = self.stage(path)
+        except Exception as e:
+            print "Staging %s failed: %s" % (path, e)
+
+    def fetch(self, path):
+        '''
+        The local copy of a file, waiting for its prefetch or staging it now. The copy
+        stays pinned until release(path).
+        '''
+        with self.lock:
+            pending = self.pending.pop(path, None)
+        if pending:
+            pending[0].join()
+            local = pending[1]
+            if local != path and not os.path.exists(local):
+                # removed by hand or by a process ignoring the pins
+                with self.locked():
+                    self.unpin(local)
+                local = self.stage(path)
+        else:
+            local = self.stage(path)
+        if local != path:
+            with self.lock:
+                self.fetched[path] = local
+        return local
+
+    def release(self, path):
+        '''
+        Unpin the copy of a fetched file (it may be evicted).
+        '''
+        with self.lock:
+            cacheName = self.fetched.pop(path, None)
+        if cacheName:
+            with self.locked():
+                self.unpin(cacheName)
+
+    def close(self):
+        '''
+        Wait for the prefetches and unpin all files.
+        '''
+        with self.lock:
+            pending = self.pending.values()
+            self.pending = {}
+        for thread, result in pending:
+            thread.join()
+        with self.locked():
+            for cacheName in self.inUse.keys():
+                self.inUse[cacheName] = 1
+                self.unpin(cacheName)
+            self.fetched = {}
+
+    def summary(self):
+        rate = self.stats['bytes']/1.e6/self.stats['copyTime'] if self.stats['copyTime'] else 0.
+        return '%i hits, %i staged (%.1f MB, %.1f MB/s), %i evicted' % (self.stats['hits'], self.stats['misses'],
+                                                                       self.stats['bytes']/1.e6, rate, self.stats['evicted'])
@@ -0,0 +1,72 @@
+'''
+Registry of the systematic variations of the event weights.
+
+Every registered weight is stored as event.<name>, with its variations
+event.<name>_up and event.<name>_down if the analyzer has a source for them
+(varied(analyzer), default always), all computed in the same pass over the
+FSA ntuples. A weight without a source of variations stores no variation
+branches rather than copies of the nominal, which would read as a zero
+systematic. A weight is a function fun(analyzer, rtrow, objects) returning
+(nominal, up, down):
+
+    @register('my_weight', varied=lambda analyzer: analyzer.my_errors is not None)
+    def my_weight(analyzer, rtrow, objects):
+        return 1., 1., 1.
+
+Author: Devin N. Taylor, UW-Madison
+'''
+
+_systematics = []
+
+def register(name, **kwargs):
+    '''
+    Decorator to register a weight as event.<name>, event.<name>_up and event.<name>_down.
+    kwargs:
+        varied      function(analyzer) returning True if the up and down variations have a
+                    source (default always True)
+    '''
+    varied = kwargs.pop('varied',lambda analyzer: True)
+    def wrap(fun):
+        if name in names(): raise ValueError('Systematic %s already registered' % name)
+        _systematics.append((name, fun, varied))
+        return fun
+    return wrap
+
+def names():
+    '''
+    The registered weights, in the order of the event branches.
+    '''
+    return [name for name, fun, varied in _systematics]
+
+def varied_names(analyzer):
+    '''
+    The registered weights whose variations have a source for this analyzer.
+    '''
+    return [name for name, fun, varied in _systematics if varied(analyzer)]
+
+def variations(name):
+    return [name, '%s_up' % name, '%s_down' % name]
+
+def weights(analyzer):
+    '''
+    List of (fun, branch names) of the registered weights, [nominal, up, down] for the
+    weights varied for this analyzer, [nominal] for the others.
+    '''
+    return [(fun, variations(name) if varied(analyzer) else [name]) for name, fun, varied in _systematics]
+
+@register('lep_scale', varied=lambda analyzer: analyzer.lepscaler is not None and analyzer.lepscaler.has_variations(tight=True))
+def lep_scale(analyzer, rtrow, objects):
+    '''
+    Tight lepton scale factors. The tight corrections have no uncertainty, so no
+    variations are stored.
+    '''
+    if analyzer.lepscaler is None: return 1., 1., 1.
+    return analyzer.lepscaler.scale_factor_variations(rtrow, *objects, tight=True)
+
+@register('pu_weight', varied=lambda analyzer: analyzer.pu_weights is not None and analyzer.pu_weights.has_variations())
+def pu_weight(analyzer, rtrow, objects):
+    '''
+    Pileup weight, up and down from the pileup profiles of the same names.
+    '''
+    if analyzer.pu_weights is None: return 1., 1., 1.
+    return analyzer.pu_weights.variations(rtrow)
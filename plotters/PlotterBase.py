@@ -168,15 +168,20 @@ class PlotterBase(object):
         doError = kwargs.pop('doError',False)
         scaleup = kwargs.pop('scaleup',False)
         unweighted = kwargs.pop('doUnweighted',False)
+        # lepton scale factor variations are stored as event.lep_scale_up/down
+        lepScale = 'event.lep_scale_up' if scaleup else 'event.lep_scale'
+        if scaleup and not unweighted:
+            for s in (self.sampleMergeDict[sample] if sample in self.sampleMergeDict else [sample]):
+                if 'data' in s: continue
+                if not self.samples[s]['file'].Get(self.analysis).GetLeaf('event', 'lep_scale_up'):
+                    raise ValueError('%s: no event.lep_scale_up, the ntuples were made without lepton scale factor variations' % s)
         totalVal = 0
         totalErr2 = 0
         if sample in self.sampleMergeDict:
             for s in self.sampleMergeDict[sample]:
                 tree = self.samples[s]['file'].Get(self.analysis)
                 if 'data' not in s and not unweighted:
-                    #if scaleup: tree.Draw('event.pu_weight>>h%s()'%s,'event.lep_scale_up*event.trig_scale*(%s)' %selection,'goff')
-                    #if not scaleup: tree.Draw('event.pu_weight>>h%s()'%s,'event.lep_scale*event.trig_scale*(%s)' %selection,'goff')
-                    tree.Draw('event.pu_weight>>h%s()'%s,'event.lep_scale*(%s)' %selection,'goff')
+                    tree.Draw('event.pu_weight>>h%s()'%s,'%s*(%s)' %(lepScale,selection),'goff')
                     if not ROOT.gDirectory.Get("h%s" %s):
                         val = 0
                     else:
@@ -195,9 +200,7 @@ class PlotterBase(object):
         else:
             tree = self.samples[sample]['file'].Get(self.analysis)
             if 'data' not in sample and not unweighted:
-                #if scaleup: tree.Draw('event.pu_weight>>h%s()'%sample,'event.lep_scale_up*event.trig_scale*(%s)' %selection,'goff')
-                #if not scaleup: tree.Draw('event.pu_weight>>h%s()'%sample,'event.lep_scale*event.trig_scale*(%s)' %selection,'goff')
-                tree.Draw('event.pu_weight>>h%s()'%sample,'event.lep_scale*(%s)' %selection,'goff')
+                tree.Draw('event.pu_weight>>h%s()'%sample,'%s*(%s)' %(lepScale,selection),'goff')
                 if not ROOT.gDirectory.Get("h%s" %sample):
                     val = 0
                 else:
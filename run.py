@@ -15,22 +15,40 @@ import errno
 from multiprocessing import Pool
 
 from utilities.utilities import *
+from utilities.executors import get_executor, prepare_job, user_submit_dir, EXECUTORS
+from utilities.manifest import Manifest, build_entry, code_hash
+from utilities.scheduler import Scheduler, Task, estimate_costs, split_files, COST_METHODS
 from analyzers.AnalyzerWZ import AnalyzerWZ
 from analyzers.AnalyzerHpp3l import AnalyzerHpp3l, AnalyzerFakeRate
 from analyzers.AnalyzerHpp4l import AnalyzerHpp4l
 
+analyzerMap = {
+    'WZ'      : AnalyzerWZ,
+    'Hpp3l'   : AnalyzerHpp3l,
+    'Hpp4l'   : AnalyzerHpp4l,
+    'FakeRate': AnalyzerFakeRate,
+}
+
 def run_analyzer(args):
     '''Run the analysis'''
-    analysis, channel, location, outfile, period = args
-    analyzerMap = {
-        'WZ'      : AnalyzerWZ,
-        'Hpp3l'   : AnalyzerHpp3l,
-        'Hpp4l'   : AnalyzerHpp4l,
-        'FakeRate': AnalyzerFakeRate,
-    }
+    analysis, channel, location, outfile, period, analyzeArgs = args
     theAnalyzer = analyzerMap[channel]
-    with theAnalyzer(location,outfile,period) as analyzer:
-        analyzer.analyze()
+    analyzer = theAnalyzer(location,outfile,period)
+    # begin() keeps the output of an interrupted run only when resuming
+    analyzer.resume = analyzeArgs.get('resume',False)
+    with analyzer:
+        analyzer.analyze(**analyzeArgs)
+
+def run_files(args):
+    '''Run the analysis on a chunk of the files of a sample, merged by run_analyzer with mergeShards'''
+    analysis, channel, location, outfile, period, chunk, fileNames, analyzeArgs = args
+    theAnalyzer = analyzerMap[channel]
+    shardDir = '%s_shards' % os.path.splitext(outfile)[0]
+    python_mkdir(shardDir)
+    chunkfile = '%s/chunk%i.root' % (shardDir, chunk)
+    with theAnalyzer(location,chunkfile,period) as analyzer:
+        analyzer.analyze_files(fileNames, output=outfile, **analyzeArgs)
+    os.remove(chunkfile)
 
 def get_sample_names(analysis,period,samples):
     '''Get unix sample names'''
@@ -59,72 +77,116 @@ def get_sample_names(analysis,period,samples):
 
     return root_dir, sample_names
 
-def run_ntuples(analysis, channel, period, samples):
-    '''Run a given analyzer for the H++ analysis'''
+def run_ntuples(analysis, channel, period, samples, **kwargs):
+    '''
+    Run a given analyzer for the H++ analysis
+    kwargs are passed to the analyze method of the analyzer.
+    With numWorkers > 1 the samples are run one after the other, each sharding its files
+    over numWorkers processes (pool workers can not start processes of their own).
+    Otherwise the samples are scheduled over a pool of processes by their estimated cost
+    (see utilities/scheduler.py), largest first. Samples costing more than a worker's share
+    of the total are split into chunks of files merged once all chunks are done. A summary
+    of the task runtimes is written to [ntuple directory]/scheduler.json.
+    Samples whose inputs, analyzer code, period and output options are those recorded in
+    [ntuple directory]/manifest.json are skipped (see utilities/manifest.py).
+    Returns the number of failed tasks.
+    manifest kwargs:
+        force       rebuild all samples (default False)
+        dryRun      only print the samples that would be rebuilt (default False)
+        hashInputs  compare the content rather than the mtime of the input files (default False)
+    scheduler kwargs:
+        workers     number of processes (default the number of CPUs)
+        costMethod  estimate the cost of a file from its size ('bytes', default), the
+                    events in its eventCount tree ('entries') or 1 per file ('files')
+        split       split the samples above a worker's share of the total cost (default True)
+    '''
+    workers = kwargs.pop('workers',None)
+    costMethod = kwargs.pop('costMethod','bytes')
+    split = kwargs.pop('split',True)
+    force = kwargs.pop('force',False)
+    dryRun = kwargs.pop('dryRun',False)
+    hashInputs = kwargs.pop('hashInputs',False)
     ntup_dir = './ntuples%s_%stev_%s' % (analysis, period, channel)
     python_mkdir(ntup_dir)
-    root_dir, sample_names = get_sample_names(analysis,period,samples)
-
-    p = Pool(8)
-
-    p.map(run_analyzer, [(analysis, channel, "%s/%s" % (root_dir, name), "%s/%s.root" % (ntup_dir, name), period) for name in sample_names])
-
-    return 0
+    root_dir, all_sample_names = get_sample_names(analysis,period,samples)
+
+    # skip the samples that are up to date
+    manifest = Manifest('%s/manifest.json' % ntup_dir)
+    codeHash = code_hash(analyzerMap[channel])
+    entries = {}
+    sample_names = []
+    for name in all_sample_names:
+        entries[name] = build_entry(analyzerMap[channel], "%s/%s" % (root_dir, name), period, kwargs, hashInputs=hashInputs, codeHash=codeHash)
+        reasons = ['forced'] if force else manifest.reasons("%s.root" % name, entries[name])
+        if reasons:
+            print "%s: %s (%s)" % (name, 'Would rebuild' if dryRun else 'Rebuilding', ', '.join(reasons))
+            sample_names += [name]
+        else:
+            print "%s: Up to date, skipping" % name
+    if dryRun or not sample_names: return 0
+    # an interrupted run leaves no record
+    for name in sample_names: manifest.remove("%s.root" % name)
+    manifest.save()
+
+    analyzerArgs = [(analysis, channel, "%s/%s" % (root_dir, name), "%s/%s.root" % (ntup_dir, name), period, kwargs) for name in sample_names]
+    if kwargs.get('numWorkers',1) > 1:
+        for name, args in zip(sample_names, analyzerArgs):
+            run_analyzer(args)
+            manifest.record("%s.root" % name, entries[name])
+            manifest.save()
+        return 0
 
-def submitJob(jobName,runArgs):
+    scheduler = Scheduler(numWorkers=workers)
+    sampleFiles = {}
+    for name in sample_names:
+        location = "%s/%s" % (root_dir, name)
+        fileNames = os.listdir(location)
+        sampleFiles[name] = (fileNames, estimate_costs(location, fileNames, costMethod))
+    maxCost = sum(sum(costs) for fileNames, costs in sampleFiles.itervalues())/scheduler.numWorkers
+
+    tasks = []
+    for name, args in zip(sample_names, analyzerArgs):
+        fileNames, costs = sampleFiles[name]
+        if not split or len(fileNames)<2 or sum(costs)<=maxCost:
+            tasks += [Task(name, run_analyzer, args, sum(costs))]
+            continue
+        chunks = []
+        for i, chunk in enumerate(split_files(fileNames, costs, maxCost)):
+            chunkCost = sum(cost for fileName, cost in zip(fileNames, costs) if fileName in chunk)
+            chunkArgs = args[:5] + (i, chunk, kwargs)
+            tasks += [Task('%s:%i' % (name, i), run_files, chunkArgs, chunkCost, kind='chunk')]
+            chunks += ['%s:%i' % (name, i)]
+        mergeArgs = args[:5] + (dict(kwargs, mergeShards=True),)
+        tasks += [Task(name, run_analyzer, mergeArgs, 0., requires=chunks, kind='merge')]
+        print "%s: Split in %i chunks of files" % (name, len(chunks))
+
+    failed = scheduler.run(tasks)
+    scheduler.write_summary('%s/scheduler.json' % ntup_dir)
+    for task in scheduler.tasks:
+        if task.kind == 'chunk': continue
+        if task.status == 'done': manifest.record("%s.root" % task.name, entries[task.name])
+    manifest.save()
+
+    return failed
+
+def submitJob(jobName,runArgs,**kwargs):
     '''
-    Submit a job
+    Prepare the submit directory of a job (see utilities/executors.py)
     jobName: jobname for executable
     runArgs: [analysis, channel, period, sample]
+    kwargs:
+        userDir     directory of the submit directories (default /nfs_scratch/[user])
+    Returns the submit directory, None if it already exists.
     '''
-    userDir = '/nfs_scratch/%s' % pwd.getpwuid(os.getuid())[0]
+    userDir = kwargs.pop('userDir',None) or user_submit_dir()
     submitDir = '%s/%s' % (userDir,jobName)
     if os.path.exists(submitDir):
         print "Submit directory exists, use a different JOBNAME."
-        return 0
-    python_mkdir(submitDir)
-
-    # copy code
-    os.system('tar -zcf %s/userCode.tar.gz analyzers utilities run.py' % submitDir)
-
-    # copy submit script
-    submitInfile = open('utilities/condor.submit')
-    submitOutfile = open('%s/condor.submit' % submitDir, 'w')
+        return None
 
+    # a job runs on a single core
     scriptName = '_'.join(runArgs)
-    submitReplacements = {
-        'EXECUTABLE' : scriptName,
-    }
-
-    for line in submitInfile:
-        for src, target in submitReplacements.iteritems():
-            line = line.replace(src, target)
-        submitOutfile.write(line)
-
-    submitInfile.close()
-    submitOutfile.close()
-
-    # copy executable
-    executable = '%s/%s.sh' % (submitDir,scriptName)
-    infile = open('utilities/doJob.sh')
-    outfile = open(executable, 'w')
-
-    replacements = {
-        'OPTIONS' : ' '.join(runArgs),
-    }
-
-    for line in infile:
-        for src, target in replacements.iteritems():
-            line = line.replace(src, target)
-        outfile.write(line)
-
-    infile.close()
-    outfile.close()
-
-    os.system('chmod +x %s' % executable)
-
-    # submit job
-    os.system('cd %s; condor_submit condor.submit' % submitDir)
+    return prepare_job(submitDir, scriptName, runArgs + ['--workers', '1'])
 
 def parse_command_line(argv):
     parser = argparse.ArgumentParser(description="Run the desired analyzer on "
@@ -136,10 +198,44 @@ def parse_command_line(argv):
     parser.add_argument('sample_names', nargs='+',help='Sample names w/ UNIX wildcards')
     parser.add_argument('-s','--submit',action='store_true',help='Submit jobs to condor')
     parser.add_argument('-jn','--jobName',nargs='?',type=str,const='',help='Job Name for condor submission')
+    parser.add_argument('-ex','--executor',type=str,default='condor',choices=sorted(EXECUTORS),help='Run the submitted jobs on condor or in local processes')
+    parser.add_argument('-sd','--submitDir',type=str,default=None,help='Directory of the submit directories (default /nfs_scratch/[user])')
+    parser.add_argument('-jw','--jobWorkers',type=int,default=None,help='Number of jobs run at the same time by the local executor (default the number of CPUs)')
+    parser.add_argument('-rt','--retries',type=int,default=2,help='Number of retries of failed jobs by the local executor')
+    parser.add_argument('-c','--columnar',action='store_true',help='Evaluate preselection as array masks over chunks of the FSA ntuples')
+    parser.add_argument('-cs','--chunkSize',type=int,default=10000,help='Number of entries per chunk in columnar mode')
+    parser.add_argument('-np','--noPrune',action='store_true',help='Read all branches of the FSA ntuples')
+    parser.add_argument('-cb','--checkBranches',action='store_true',help='Report FSA branches read without being declared in fsa_branches')
+    parser.add_argument('-st','--cutStats',action='store_true',help='Record calls, passes and time per cut (written to [sample]_cutstats.json)')
+    parser.add_argument('-mb','--memoryBudget',type=int,default=None,help='Memory (MB) of the event index above which it is moved to disk')
+    parser.add_argument('-w','--workers',type=int,default=None,help='Number of processes the samples are scheduled over (default the number of CPUs)')
+    parser.add_argument('-ce','--costEstimate',type=str,default='bytes',choices=COST_METHODS,help='Estimate the cost of the samples from the bytes, eventCount entries or number of files')
+    parser.add_argument('-f','--force',action='store_true',help='Rebuild all samples, even those up to date in the manifest')
+    parser.add_argument('-dr','--dryRun',action='store_true',help='Only list the samples that would be rebuilt')
+    parser.add_argument('-hi','--hashInputs',action='store_true',help='Compare the content rather than the mtime of the input files')
+    parser.add_argument('-ns','--noSplit',action='store_true',help='Do not split large samples into chunks of files')
+    parser.add_argument('-fw','--fileWorkers',type=int,default=1,help='Number of processes the files of each sample are sharded over')
+    parser.add_argument('-cp','--checkpoint',action='store_true',help='Save a checkpoint after each input file')
+    parser.add_argument('-r','--resume',action='store_true',help='Continue from the last checkpoint of an interrupted run')
+    parser.add_argument('-sg','--stageDir',type=str,default=None,help='Copy the input files to this local directory (i.e. an SSD) before reading them')
+    parser.add_argument('-sb','--stageBudget',type=float,default=50,help='Size (GB) of the stage directory, the least recently used files are removed')
+    parser.add_argument('-se','--saveEvents',action='store_true',help='Save the event index next to the output ntuples, to merge outputs with utilities/mergeNtuples.py')
+    parser.add_argument('-sc','--sidecar',action='store_true',help='Also write the output ntuples as memory mappable columns ([sample].columns)')
+    parser.add_argument('-co','--compression',type=str,default=None,choices=['zlib','lzma','lz4'],help='Compression algorithm of the output ntuples (lz4 for fast scratch files, lzma for archiving)')
+    parser.add_argument('-cl','--compressionLevel',type=int,default=None,help='Compression level (1-9) of the output ntuples')
+    parser.add_argument('-bs','--basketSize',type=int,default=None,help='Basket size (bytes) of the branches of the output ntuples')
+    parser.add_argument('-af','--autoFlush',type=int,default=None,help='Write the baskets of the output ntuples every N entries (N>0) or -N bytes (N<0)')
     args = parser.parse_args(argv)
 
     return args
 
+def output_options(args):
+    '''The output ntuple options given on the command line.'''
+    options = {}
+    for option in ['compression', 'compressionLevel', 'basketSize', 'autoFlush']:
+        if getattr(args,option) is not None: options[option] = getattr(args,option)
+    return options
+
 def main(argv=None):
     if argv is None:
         argv = sys.argv[1:]
@@ -152,13 +248,25 @@ def main(argv=None):
         print "Running %s:%s %s TeV analyzer" %(args.analysis, args.channel, args.period)
         if args.submit:
             root_dir, sample_names = get_sample_names(args.analysis, args.period, args.sample_names)
+            executor = get_executor(args.executor, numWorkers=args.jobWorkers, retries=args.retries)
+            submitDirs = []
             for sample in sample_names:
                 print sample
                 runArgs = [args.analysis, args.channel, args.period, sample]
                 jobName = '%s/%s' % (args.jobName, sample)
-                submitJob(jobName,runArgs)
+                submitDir = submitJob(jobName,runArgs,userDir=args.submitDir)
+                if submitDir: submitDirs += [submitDir]
+            if executor.submit(submitDirs): return 1
         else:
-            run_ntuples(args.analysis, args.channel, args.period, args.sample_names)
+            status = run_ntuples(args.analysis, args.channel, args.period, args.sample_names, columnar=args.columnar, chunkSize=args.chunkSize,
+                                 pruneBranches=not args.noPrune, checkBranches=args.checkBranches, cutStats=args.cutStats,
+                                 memoryBudget=args.memoryBudget, numWorkers=args.fileWorkers,
+                                 checkpoint=args.checkpoint or args.resume, resume=args.resume,
+                                 sidecar=args.sidecar, saveEvents=args.saveEvents, stageDir=args.stageDir, stageBudget=args.stageBudget,
+                                 workers=args.workers, costMethod=args.costEstimate,
+                                 split=not args.noSplit, force=args.force, dryRun=args.dryRun,
+                                 hashInputs=args.hashInputs, **output_options(args))
+            if status: return 1
 
     return 0
 
@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+'''
+Benchmark the output compression, basket size and auto-flush settings on an
+existing ISA ntuple: the tree is copied with each setting, then the file size,
+write time and the time to read back some expressions are printed.
+
+    ./utilities/benchmarkOutput.py ntuplesWZ_13tev_WZ/sample.root WZ \
+        -s zlib:1 lz4:4 lzma:9 -e z1.mass event.pu_weight
+
+Author: Devin N. Taylor, UW-Madison
+'''
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+import argparse
+
+sys.argv.append('-b')
+import ROOT as rt
+sys.argv.pop()
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'analyzers'))
+from ntuples import configureOutput
+
+
+def parse_setting(setting):
+    '''
+    Parse "algorithm:level" (either part may be empty) into configureOutput kwargs.
+    '''
+    algorithm, _, level = setting.partition(':')
+    options = {}
+    if algorithm: options['compression'] = algorithm
+    if level: options['compressionLevel'] = int(level)
+    return options
+
+def benchmark(inputName, treeName, options, expressions, tmpDir):
+    inFile = rt.TFile(inputName)
+    inTree = inFile.Get(treeName)
+    if not inTree:
+        raise ValueError('%s: no tree %s' % (inputName, treeName))
+    outName = os.path.join(tmpDir, 'benchmark.root')
+
+    start = time.time()
+    outFile = rt.TFile(outName, 'recreate')
+    outTree = inTree.CloneTree(0)
+    configureOutput(outFile, outTree, **options)
+    for i in range(inTree.GetEntries()):
+        inTree.GetEntry(i)
+        outTree.Fill()
+    outFile.Write()
+    outFile.Close()
+    writeTime = time.time() - start
+    inFile.Close()
+    size = os.path.getsize(outName)
+
+    start = time.time()
+    readFile = rt.TFile(outName)
+    readTree = readFile.Get(treeName)
+    for expression in expressions:
+        readTree.Draw(expression, '', 'goff')
+    readFile.Close()
+    readTime = time.time() - start
+    os.remove(outName)
+
+    return size, writeTime, readTime
+
+def parse_command_line(argv):
+    parser = argparse.ArgumentParser(description="Benchmark output compression and basket settings")
+
+    parser.add_argument('input', type=str, help='ISA ntuple to copy')
+    parser.add_argument('tree', type=str, help='Name of the tree (i.e. WZ)')
+    parser.add_argument('-s','--settings', nargs='+', type=str, default=['zlib:1','lz4:4','lzma:9'],
+                        help='Compression settings as algorithm:level (default zlib:1 lz4:4 lzma:9)')
+    parser.add_argument('-bs','--basketSize', nargs='+', type=int, default=[None],
+                        help='Basket sizes in bytes to try with each setting')
+    parser.add_argument('-af','--autoFlush', nargs='+', type=int, default=[None],
+                        help='Auto-flush values to try with each setting')
+    parser.add_argument('-e','--expressions', nargs='+', type=str, default=['event.evt'],
+                        help='Expressions drawn to time the read back')
+    args = parser.parse_args(argv)
+
+    return args
+
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+
+    args = parse_command_line(argv)
+
+    tmpDir = tempfile.mkdtemp(prefix='benchmarkOutput')
+    results = []
+    try:
+        for setting in args.settings:
+            for basketSize in args.basketSize:
+                for autoFlush in args.autoFlush:
+                    options = parse_setting(setting)
+                    options['basketSize'] = basketSize
+                    options['autoFlush'] = autoFlush
+                    size, writeTime, readTime = benchmark(args.input, args.tree, options, args.expressions, tmpDir)
+                    results += [(setting, basketSize, autoFlush, size, writeTime, readTime)]
+    finally:
+        shutil.rmtree(tmpDir)
+
+    print '%-10s %10s %12s %12s %10s %10s' % ('Setting', 'Basket', 'AutoFlush', 'Size [kB]', 'Write [s]', 'Read [s]')
+    for setting, basketSize, autoFlush, size, writeTime, readTime in results:
+        print '%-10s %10s %12s %12.1f %10.2f %10.2f' % (setting, basketSize if basketSize is not None else 'default',
+                                                        autoFlush if autoFlush is not None else 'default',
+                                                        size/1024., writeTime, readTime)
+
+    return 0
+
+
+if __name__ == "__main__":
+    main()
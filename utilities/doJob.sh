@@ -4,7 +4,7 @@
 tar -zxf userCode.tar.gz
 
 # analyze
-./run.py OPTIONS
+./run.py OPTIONS || exit $?
 
-# tar for copying back
-tar -zcf results.tar.gz ntuple*
+# tar for copying back, without the bookkeeping of this job
+tar -zcf results.tar.gz --exclude=manifest.json --exclude=scheduler.json ntuple*
@@ -0,0 +1,269 @@
+'''
+Executors for the jobs submitted by run.py --submit.
+
+Every job lives in its own submit directory with the same layout for all
+executors:
+    userCode.tar.gz         analyzers, utilities and run.py
+    condor.submit           condor description (from utilities/condor.submit)
+    [script].sh             job script (from utilities/doJob.sh)
+    stdout, stderr          output of the job script
+    results.tar.gz          output ntuples of the job
+The condor executor hands the directories to condor_submit. The local
+executor runs the job scripts in a pool of local processes, retrying
+failed jobs, and records the exit codes in job.json:
+
+    executor = get_executor('local', numWorkers=16, retries=2)
+    executor.submit([prepare_job(submitDir, script, options) for ...])
+    executor.status(submitDir)
+
+Author: Devin N. Taylor, UW-Madison
+'''
+
+import os
+import pwd
+import time
+import json
+import shutil
+import socket
+import tarfile
+import tempfile
+import subprocess
+import multiprocessing as mp
+from multiprocessing.pool import ThreadPool
+
+from utilities import python_mkdir
+
+TEMPLATE_DIR = os.path.dirname(os.path.abspath(__file__))
+CODE = ['analyzers', 'utilities', 'run.py']
+JOB_STATUS = 'job.json'
+
+def user_submit_dir():
+    '''
+    The default directory of the submit directories.
+    '''
+    return '/nfs_scratch/%s' % pwd.getpwuid(os.getuid())[0]
+
+def prepare_job(submitDir, scriptName, options, **kwargs):
+    '''
+    Create the submit directory of a job running ./run.py options.
+    Returns the submit directory.
+    kwargs:
+        codeDir     directory with the code to ship (default the directory of run.py)
+    '''
+    codeDir = kwargs.pop('codeDir',os.path.dirname(TEMPLATE_DIR))
+    python_mkdir(submitDir)
+
+    # copy code
+    with tarfile.open('%s/userCode.tar.gz' % submitDir, 'w:gz') as codeTar:
+        for name in CODE:
+            codeTar.add(os.path.join(codeDir, name), arcname=name)
+
+    # copy submit script and executable
+    fillTemplate('%s/condor.submit' % TEMPLATE_DIR, '%s/condor.submit' % submitDir, {'EXECUTABLE': scriptName})
+    executable = '%s/%s.sh' % (submitDir,scriptName)
+    fillTemplate('%s/doJob.sh' % TEMPLATE_DIR, executable, {'OPTIONS': ' '.join(options)})
+    os.chmod(executable, 0755)
+
+    return submitDir
+
+def fillTemplate(template, output, replacements):
+    with open(template) as infile:
+        with open(output, 'w') as outfile:
+            for line in infile:
+                for src, target in replacements.iteritems():
+                    line = line.replace(src, target)
+                outfile.write(line)
+
+def job_script(submitDir):
+    '''
+    The job script named by the executable of condor.submit.
+    '''
+    with open('%s/condor.submit' % submitDir) as submitFile:
+        for line in submitFile:
+            key, _, value = line.partition('=')
+            if key.strip() == 'executable': return value.strip()
+    raise ValueError('%s: no executable in condor.submit' % submitDir)
+
+def tail(fileName, numLines=10):
+    if not os.path.exists(fileName): return []
+    with open(fileName) as logFile:
+        return [line.rstrip('\n') for line in logFile.readlines()[-numLines:]]
+
+class Executor(object):
+    '''
+    Interface of the executors.
+        executor.submit(submitDirs)     run or queue the jobs, returns the number of failed
+                                        submissions (or failed jobs for blocking executors)
+        executor.status(submitDir)      dictionary with the 'status' of a job ('prepared',
+                                        'submitted', 'running', 'done', 'failed' or 'held'), its
+                                        'exitCode' and the file names of its 'logs'
+    '''
+    name = None
+
+    def __init__(self, **kwargs):
+        pass
+
+    def submit(self, submitDirs):
+        raise NotImplementedError
+
+    def status(self, submitDir):
+        raise NotImplementedError
+
+    @staticmethod
+    def logs(submitDir):
+        return [fileName for fileName in ['%s/stdout' % submitDir, '%s/stderr' % submitDir] if os.path.exists(fileName)]
+
+class CondorExecutor(Executor):
+    '''
+    Submit the jobs to condor, the status is read from the condor log of a job.
+    '''
+    name = 'condor'
+
+    def submit(self, submitDirs):
+        failed = 0
+        for submitDir in submitDirs:
+            if subprocess.call(['condor_submit', 'condor.submit'], cwd=submitDir):
+                print "%s: condor_submit failed" % submitDir
+                failed += 1
+        return failed
+
+    def status(self, submitDir):
+        '''
+        Status from the last event of the condor user log (000 submitted, 001 executing,
+        005 terminated, 012 held).
+        '''
+        status = {'status': 'prepared', 'exitCode': None, 'logs': self.logs(submitDir)}
+        logName = '%s/condor_log' % submitDir
+        if not os.path.exists(logName): return status
+        with open(logName) as logFile:
+            for line in logFile:
+                if line.startswith('000 '): status['status'] = 'submitted'
+                elif line.startswith('001 '): status['status'] = 'running'
+                elif line.startswith('012 '): status['status'] = 'held'
+                elif line.startswith('005 '): status['status'] = 'failed'
+                elif 'Normal termination (return value' in line:
+                    status['exitCode'] = int(line.split('return value')[1].strip(' )\n'))
+                    status['status'] = 'done' if status['exitCode']==0 else 'failed'
+        return status
+
+def _run_local(args):
+    try:
+        return LocalExecutor.run_job(*args)
+    except Exception as e:
+        print "%s: Error: %s" % (args[0], e)
+        return 1
+
+class LocalExecutor(Executor):
+    '''
+    Run the jobs in a pool of local processes. Each attempt unpacks the job in a
+    scratch directory as condor does, runs the job script and copies results.tar.gz
+    back to the submit directory. Failed jobs (non zero exit code or no results) are
+    retried. The output of earlier attempts is kept as stdout.N and stderr.N and the
+    exit code, host and runtime of every attempt are written to job.json.
+    kwargs:
+        numWorkers  number of jobs run at the same time (default the number of CPUs)
+        retries     number of times a failed job is retried (default 2)
+        scratchDir  directory of the job scratch directories (default the system tmp)
+    '''
+    name = 'local'
+
+    def __init__(self, **kwargs):
+        self.numWorkers = kwargs.pop('numWorkers',None) or mp.cpu_count()
+        self.retries = kwargs.pop('retries',2)
+        self.scratchDir = kwargs.pop('scratchDir',None)
+
+    def submit(self, submitDirs):
+        '''
+        Run the jobs, returns the number of failed jobs.
+        '''
+        pool = ThreadPool(self.numWorkers)
+        try:
+            results = pool.map(_run_local, [(submitDir, self.retries, self.scratchDir) for submitDir in submitDirs])
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+        failed = [submitDir for submitDir, exitCode in zip(submitDirs, results) if exitCode]
+        print "Local executor: %i/%i jobs done" % (len(submitDirs)-len(failed), len(submitDirs))
+        for submitDir in failed:
+            print "    %s failed, see %s/stderr" % (submitDir, submitDir)
+        return len(failed)
+
+    @staticmethod
+    def run_job(submitDir, retries, scratchDir=None):
+        '''
+        Run a job with up to retries retries, returns the exit code of the last attempt.
+        '''
+        script = job_script(submitDir)
+        state = {'status': 'running', 'exitCode': None, 'attempts': []}
+        for attempt in range(retries+1):
+            if attempt:
+                print "%s: Retrying (%i/%i)" % (submitDir, attempt, retries)
+                for log in ['stdout', 'stderr']:
+                    if os.path.exists('%s/%s' % (submitDir, log)):
+                        os.rename('%s/%s' % (submitDir, log), '%s/%s.%i' % (submitDir, log, attempt))
+            LocalExecutor.write_state(submitDir, state)
+            start = time.time()
+            workDir = tempfile.mkdtemp(prefix='job_', dir=scratchDir)
+            try:
+                shutil.copy('%s/userCode.tar.gz' % submitDir, workDir)
+                shutil.copy('%s/%s' % (submitDir, script), workDir)
+                with open('%s/stdout' % submitDir, 'w') as stdout:
+                    with open('%s/stderr' % submitDir, 'w') as stderr:
+                        exitCode = subprocess.call(['sh', script], cwd=workDir, stdout=stdout, stderr=stderr)
+                if exitCode == 0 and not os.path.exists('%s/results.tar.gz' % workDir):
+                    with open('%s/stderr' % submitDir, 'a') as stderr:
+                        stderr.write('Local executor: no results.tar.gz written\n')
+                    exitCode = 1
+                if exitCode == 0:
+                    shutil.copy('%s/results.tar.gz' % workDir, submitDir)
+            finally:
+                shutil.rmtree(workDir)
+            state['attempts'] += [{'exitCode': exitCode, 'host': socket.gethostname(),
+                                   'start': start, 'runtime': time.time()-start}]
+            state['exitCode'] = exitCode
+            if exitCode == 0: break
+        state['status'] = 'done' if exitCode == 0 else 'failed'
+        LocalExecutor.write_state(submitDir, state)
+        print "%s: %s (exit code %i, %i attempts)" % (submitDir, state['status'], exitCode, len(state['attempts']))
+        return exitCode
+
+    @staticmethod
+    def write_state(submitDir, state):
+        jsonName = '%s/%s' % (submitDir, JOB_STATUS)
+        with open(jsonName+'.tmp', 'w') as stateFile:
+            json.dump(state, stateFile, indent=4)
+        os.rename(jsonName+'.tmp', jsonName)
+
+    def status(self, submitDir):
+        status = {'status': 'prepared', 'exitCode': None, 'logs': self.logs(submitDir)}
+        jsonName = '%s/%s' % (submitDir, JOB_STATUS)
+        if not os.path.exists(jsonName): return status
+        with open(jsonName) as stateFile:
+            state = json.load(stateFile)
+        status['status'] = str(state['status'])
+        status['exitCode'] = state['exitCode']
+        status['attempts'] = len(state['attempts'])
+        return status
+
+EXECUTORS = {
+    'condor': CondorExecutor,
+    'local' : LocalExecutor,
+}
+
+def get_executor(name, **kwargs):
+    '''
+    The executor of the given name, kwargs are passed to its constructor.
+    '''
+    if name not in EXECUTORS:
+        raise ValueError('Unknown executor %s, use one of %s' % (name, ', '.join(sorted(EXECUTORS))))
+    return EXECUTORS[name](**kwargs)
+
+def detect_executor(submitDir):
+    '''
+    The executor that ran a job: local if it wrote job.json, condor otherwise.
+    '''
+    if os.path.exists('%s/%s' % (submitDir, JOB_STATUS)): return LocalExecutor()
+    return CondorExecutor()
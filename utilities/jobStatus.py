@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+
+import os
+import sys
+import glob
+import argparse
+
+from executors import detect_executor, user_submit_dir, tail
+
+
+def parse_command_line(argv):
+    parser = argparse.ArgumentParser(description="Status of the jobs of a submission")
+
+    parser.add_argument('jobName', type=str, nargs='+', help='Job name for submission')
+    parser.add_argument('-sd','--submitDir', type=str, default=None, help='Directory of the submit directories (default /nfs_scratch/[user])')
+    parser.add_argument('-l','--logs', type=int, default=0, help='Print the last N lines of stderr of the failed jobs')
+    args = parser.parse_args(argv)
+
+    return args
+
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+
+    args = parse_command_line(argv)
+
+    userDir = args.submitDir or user_submit_dir()
+    jobDirs = [fname
+               for string in args.jobName
+               for fname in glob.glob("%s/%s" % (userDir, os.path.basename(string)))]
+
+    counts = {}
+    failed = []
+    for jobDir in jobDirs:
+        print jobDir
+        for submitDir in sorted(glob.glob('%s/*' % jobDir)):
+            if not os.path.exists('%s/condor.submit' % submitDir): continue
+            status = detect_executor(submitDir).status(submitDir)
+            counts[status['status']] = counts.get(status['status'],0) + 1
+            exitCode = '' if status['exitCode'] is None else 'exit code %i' % status['exitCode']
+            attempts = '%i attempts' % status['attempts'] if 'attempts' in status else ''
+            print "    %-40s %-10s %-12s %s" % (os.path.basename(submitDir), status['status'], exitCode, attempts)
+            if status['status'] in ['failed', 'held']: failed += [submitDir]
+
+    print "Jobs: %s" % ', '.join('%i %s' % (counts[status], status) for status in sorted(counts))
+    if args.logs:
+        for submitDir in failed:
+            print "%s/stderr:" % submitDir
+            for line in tail('%s/stderr' % submitDir, args.logs):
+                print "    %s" % line
+
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    status = main()
+    sys.exit(status)
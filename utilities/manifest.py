@@ -0,0 +1,131 @@
+'''
+Production manifest of the ntuples made by run.py.
+
+The manifest of an ntuple directory (manifest.json) records for every output
+file the state of its input files (size and mtime, or a content hash), the
+analyzer class, the period, a hash of the analyzer code and the analyze
+options changing the output. A sample whose record matches is up to date:
+
+    manifest = Manifest('ntuplesWZ_13tev_WZ/manifest.json')
+    entry = build_entry(AnalyzerWZ, '/hdfs/.../sample', '13', options)
+    reasons = manifest.reasons('sample.root', entry)   # [] if up to date
+    ...
+    manifest.record('sample.root', entry)
+    manifest.save()
+
+Author: Devin N. Taylor, UW-Madison
+'''
+
+import os
+import json
+import hashlib
+import inspect
+
+# analyze options that change the output files
+OUTPUT_OPTIONS = ['cutStats', 'sidecar', 'saveEvents', 'compression', 'compressionLevel', 'basketSize', 'autoFlush']
+
+def file_hash(fileName, blockSize=1<<20):
+    sha = hashlib.sha1()
+    with open(fileName, 'rb') as hashFile:
+        for block in iter(lambda: hashFile.read(blockSize), ''):
+            sha.update(block)
+    return sha.hexdigest()
+
+def input_state(location, **kwargs):
+    '''
+    State of the files of a sample directory, {file name: {size, mtime}} or
+    {file name: {size, sha1}} with hashInputs.
+    kwargs:
+        hashInputs  record a hash of the content rather than the mtime (default False)
+    '''
+    hashInputs = kwargs.pop('hashInputs',False)
+    state = {}
+    for fileName in os.listdir(location):
+        path = os.path.join(location, fileName)
+        stat = os.stat(path)
+        state[fileName] = {'size': stat.st_size}
+        if hashInputs:
+            state[fileName]['sha1'] = file_hash(path)
+        else:
+            state[fileName]['mtime'] = int(stat.st_mtime)
+    return state
+
+def code_hash(analyzerClass):
+    '''
+    Hash of the code and data of the directory of the analyzer (the analyzer,
+    AnalyzerBase and the modules, scale factors and pileup weights they use).
+    '''
+    codeDir = os.path.dirname(os.path.abspath(inspect.getsourcefile(analyzerClass)))
+    sha = hashlib.sha1()
+    for dirpath, dirnames, fileNames in sorted(os.walk(codeDir)):
+        for fileName in sorted(fileNames):
+            if os.path.splitext(fileName)[1] in ['.pyc', '.pyo', '.md']: continue
+            path = os.path.join(dirpath, fileName)
+            sha.update(os.path.relpath(path, codeDir))
+            sha.update(file_hash(path))
+    return sha.hexdigest()
+
+def build_entry(analyzerClass, location, period, options, **kwargs):
+    '''
+    The manifest record of a sample: its inputs, analyzer, period, code hash and output options.
+    kwargs:
+        hashInputs  see input_state
+        codeHash    hash of the analyzer code if already known (default computed)
+    '''
+    hashInputs = kwargs.pop('hashInputs',False)
+    codeHash = kwargs.pop('codeHash',None) or code_hash(analyzerClass)
+    return {
+        'location': location,
+        'inputs': input_state(location, hashInputs=hashInputs),
+        'analyzer': analyzerClass.__name__,
+        'period': period,
+        'code': codeHash,
+        'options': dict((option, options[option]) for option in OUTPUT_OPTIONS if options.get(option) not in [None, False]),
+    }
+
+class Manifest(object):
+    '''
+    The records of the output files of an ntuple directory, keyed by file name.
+        manifest.reasons(output, entry)     why output must be rebuilt, [] if up to date
+        manifest.record(output, entry)      record a finished output
+        manifest.remove(output)             forget an output (i.e. a failed run)
+        manifest.save()                     write the manifest
+    '''
+    def __init__(self, fileName):
+        self.fileName = fileName
+        self.directory = os.path.dirname(fileName)
+        self.entries = {}
+        if os.path.exists(fileName):
+            with open(fileName) as manifestFile:
+                self.entries = json.load(manifestFile)
+
+    def reasons(self, output, entry):
+        name = os.path.basename(output)
+        if name not in self.entries: return ['new']
+        if not os.path.exists(os.path.join(self.directory, name)): return ['output missing']
+        old = self.entries[name]
+        reasons = []
+        for key in ['analyzer', 'period']:
+            if old.get(key) != entry[key]: reasons += ['%s %s -> %s' % (key, old.get(key), entry[key])]
+        if old.get('code') != entry['code']: reasons += ['code changed']
+        if old.get('options') != entry['options']: reasons += ['options changed']
+        oldInputs = old.get('inputs', {})
+        newInputs = entry['inputs']
+        added = len(set(newInputs) - set(oldInputs))
+        removed = len(set(oldInputs) - set(newInputs))
+        changed = len([f for f in set(newInputs) & set(oldInputs) if newInputs[f] != oldInputs[f]])
+        if added: reasons += ['%i input files added' % added]
+        if removed: reasons += ['%i input files removed' % removed]
+        if changed: reasons += ['%i input files changed' % changed]
+        return reasons
+
+    def record(self, output, entry):
+        self.entries[os.path.basename(output)] = entry
+
+    def remove(self, output):
+        self.entries.pop(os.path.basename(output), None)
+
+    def save(self):
+        with open(self.fileName+'.tmp', 'w') as manifestFile:
+            json.dump(self.entries, manifestFile, indent=1, sort_keys=True)
+        os.rename(self.fileName+'.tmp', self.fileName)
@@ -0,0 +1,335 @@
+#!/usr/bin/env python
+'''
+Merge the ISA ntuples of several jobs (shards) of a sample into one file.
+
+The analyzer trees are concatenated in the order of the shards and the
+cutflow histograms are combined. An event written by more than one shard is
+written once, with the candidate chosen by the rule of the analyzer: the
+smallest minimizing variables (ties to the first shard) for the default
+good_to_store, the first shard otherwise. The rule, the minimizing variables of
+the written candidates
+and the cutflow level of every event are read from the [shard]_events.npz
+written with analyze(saveEvents=True) (./run.py --saveEvents). Without them
+the first shard writing an event is kept and the cutflow histograms are
+summed, which double counts events seen by several shards.
+
+    ./utilities/mergeNtuples.py merged.root job*/sample.root -j 8
+
+The events are hash partitioned, the shards are scanned and the partitions
+resolved in parallel, and the entries are copied shard by shard, so the
+memory used scales with the largest shard and partition.
+
+Author: Devin N. Taylor, UW-Madison
+'''
+
+import os
+import sys
+import glob
+import time
+import shutil
+import tempfile
+import argparse
+import multiprocessing as mp
+import numpy as np
+
+sys.argv.append('-b')
+import ROOT as rt
+sys.argv.pop()
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'analyzers'))
+from eventindex import WRITTEN, MASK32, hash_keys
+from columnar import iterate_chunks
+
+KEY = [('k0','<i8'), ('k1','<i8')]
+
+
+def events_name(fileName):
+    return '%s_events.npz' % os.path.splitext(fileName)[0]
+
+def find_tree(rtFile):
+    '''
+    Name of the analyzer tree, the only TTree of an ISA ntuple.
+    '''
+    names = [key.GetName() for key in rtFile.GetListOfKeys() if key.GetClassName() == 'TTree']
+    if len(names) != 1:
+        raise ValueError('%s: expected one tree, found %s, use --tree' % (rtFile.GetName(), ', '.join(names) or 'none'))
+    return names[0]
+
+def evt_keys(evts):
+    '''
+    The evt part of packed keys as stored in the tree: event.evt is an Int_t leaf, so
+    the 64 bit FSA evt of the event index is truncated to 32 bits (sign extended).
+    '''
+    return evts.astype(np.int64).astype(np.int32).astype(np.int64)
+
+def pack_keys(evts, lumis, runs):
+    '''
+    Packed keys (see eventindex.pack_key) of arrays of evt, lumi and run, with the evt
+    truncated as in the tree (see evt_keys).
+    '''
+    keys = np.zeros(len(evts), dtype=KEY)
+    keys['k0'] = evt_keys(evts)
+    keys['k1'] = ((runs.astype(np.int64) & MASK32) << 32) | (lumis.astype(np.int64) & MASK32)
+    return keys
+
+def tree_keys(tree, chunkSize):
+    '''
+    Generator over the packed keys of the entries of an ISA tree, by chunk.
+    '''
+    for chunk in iterate_chunks(tree, chunkSize):
+        yield pack_keys(chunk['event.evt'], chunk['event.lumi'], chunk['event.run'])
+
+def read_cutflow(rtFile):
+    hist = rtFile.Get('cutflow')
+    if not hist: return [], {}
+    numBins = hist.GetNbinsX()
+    values = [hist.GetBinContent(b) for b in range(1, numBins+1)]
+    labels = dict((b, hist.GetXaxis().GetBinLabel(b)) for b in range(1, numBins+1) if hist.GetXaxis().GetBinLabel(b))
+    return values, labels
+
+def scan_shard(args):
+    '''
+    Split the events of a shard in partitions saved to tmpDir. Returns a summary of the shard.
+    '''
+    i, fileName, treeName, tmpDir, numParts, chunkSize = args
+    rtFile = rt.TFile(fileName, 'READ')
+    tree = rtFile.Get(treeName)
+    if not tree: raise ValueError('%s: no tree %s' % (fileName, treeName))
+    numEntries = int(tree.GetEntries())
+    cutflow, labels = read_cutflow(rtFile)
+    summary = {'fileName': fileName, 'entries': numEntries, 'cutflow': cutflow, 'labels': labels,
+               'rule': None, 'width': 0}
+
+    if os.path.exists(events_name(fileName)):
+        data = np.load(events_name(fileName))
+        used = data['flags'] != 0
+        keys = np.zeros(np.count_nonzero(used), dtype=KEY)
+        keys['k0'] = evt_keys(data['key0'][used])
+        keys['k1'] = data['key1'][used]
+        level = data['level'][used]
+        written = (data['flags'][used] & WRITTEN) != 0
+        # the candidate written, the best one may have come after the event was written
+        vals = data['writtenBest'][used] if 'writtenBest' in data.files else data['best'][used]
+        summary['rule'] = str(data['rule'])
+        summary['width'] = vals.shape[1]
+        if np.count_nonzero(written) != numEntries:
+            print "%s: Error: %i events written in %s, %i entries in the tree, ignoring it" % (fileName, np.count_nonzero(written), events_name(fileName), numEntries)
+            summary['rule'] = None
+    if summary['rule'] is None:
+        keys = np.concatenate([np.zeros(0, dtype=KEY)] + list(tree_keys(tree, chunkSize)))
+        level = np.full(len(keys), -1, dtype=np.int8)
+        written = np.ones(len(keys), dtype=bool)
+        vals = np.zeros((len(keys), 0))
+    rtFile.Close()
+
+    parts = hash_keys(keys['k0'], keys['k1']) % np.uint64(numParts)
+    for p in range(numParts):
+        sel = parts == p
+        np.savez(os.path.join(tmpDir, 'shard%i_part%i.npz' % (i, p)),
+                 keys=keys[sel], level=level[sel], written=written[sel], vals=vals[sel])
+    return summary
+
+def resolve_partition(args):
+    '''
+    Combine the events of a partition over all shards: the highest cutflow level of each
+    event and the shard writing it. Returns the number of events per cutflow level, the
+    number of events written by several shards and saves the winning shard of the written
+    events to tmpDir.
+    '''
+    p, numShards, width, rule, tmpDir = args
+    keys, level, written, shard, vals = [], [], [], [], []
+    for i in range(numShards):
+        data = np.load(os.path.join(tmpDir, 'shard%i_part%i.npz' % (i, p)))
+        keys += [data['keys']]
+        level += [data['level']]
+        written += [data['written']]
+        shard += [np.full(len(data['keys']), i, dtype=np.int32)]
+        # shards without stored candidates have fewer (no) minimizing variables
+        v = np.full((len(data['keys']), width), np.inf)
+        v[:, :data['vals'].shape[1]] = data['vals']
+        vals += [v]
+    keys = np.concatenate(keys)
+    level = np.concatenate(level)
+    written = np.concatenate(written)
+    shard = np.concatenate(shard)
+    vals = np.concatenate(vals)
+
+    # highest level per event
+    unique, inverse = np.unique(keys, return_inverse=True)
+    maxLevel = np.full(len(unique), -1, dtype=np.int64)
+    np.maximum.at(maxLevel, inverse, level.astype(np.int64))
+    counts = np.bincount(maxLevel[maxLevel >= 0]) if np.any(maxLevel >= 0) else np.zeros(0, dtype=np.int64)
+
+    # the candidate kept for each written event, sorted by key, then by the rule
+    w = np.flatnonzero(written)
+    sortKeys = [shard[w]]
+    if rule == 'min':
+        sortKeys += [vals[w, c] for c in reversed(range(width))]
+    sortKeys += [keys['k1'][w], keys['k0'][w]]
+    order = w[np.lexsort(sortKeys)]
+    first = np.ones(len(order), dtype=bool)
+    first[1:] = keys[order][1:] != keys[order][:-1]
+    winners = order[first]
+    numDuplicates = len(order) - len(winners)
+    np.savez(os.path.join(tmpDir, 'winners_part%i.npz' % p), keys=keys[winners], shard=shard[winners])
+    return counts, numDuplicates
+
+def copy_shard(outTree, fileName, treeName, keep, chunkSize):
+    '''
+    Fill outTree with the entries of a shard whose keys are in keep (sorted packed keys).
+    Returns the number of entries copied.
+    '''
+    rtFile = rt.TFile(fileName, 'READ')
+    tree = rtFile.Get(treeName)
+    tree.CopyAddresses(outTree)
+    numCopied = 0
+    entry = 0
+    for keys in tree_keys(tree, chunkSize):
+        found = np.searchsorted(keep, keys)
+        found[found >= len(keep)] = 0
+        selected = keep[found] == keys if len(keep) else np.zeros(len(keys), dtype=bool)
+        for j in np.flatnonzero(selected):
+            tree.GetEntry(entry+int(j))
+            outTree.Fill()
+        numCopied += int(np.count_nonzero(selected))
+        entry += len(keys)
+    tree.CopyAddresses(outTree, True)
+    rtFile.Close()
+    return numCopied
+
+def merge(output, shards, **kwargs):
+    '''
+    Merge the ISA ntuples shards (in order) into output, see the module documentation.
+    kwargs:
+        tree        name of the analyzer tree (default the only tree of the first shard)
+        numWorkers  number of processes scanning shards and partitions (default the number of CPUs)
+        numParts    number of hash partitions of the events (default 4 per worker)
+        chunkSize   number of entries read at once from the trees (default 100000)
+        tmpDir      directory for the partitions (default the system temp directory)
+    Returns the number of entries of the merged tree.
+    '''
+    treeName = kwargs.pop('tree',None)
+    numWorkers = kwargs.pop('numWorkers',None) or mp.cpu_count()
+    numParts = kwargs.pop('numParts',None) or 4*numWorkers
+    chunkSize = kwargs.pop('chunkSize',100000)
+    tmpBase = kwargs.pop('tmpDir',None)
+
+    start = time.time()
+    if treeName is None:
+        rtFile = rt.TFile(shards[0], 'READ')
+        treeName = find_tree(rtFile)
+        rtFile.Close()
+
+    tmpDir = tempfile.mkdtemp(prefix='mergeNtuples_', dir=tmpBase)
+    pool = mp.Pool(numWorkers)
+    try:
+        # scan the shards and partition their events
+        summaries = pool.map(scan_shard, [(i, shard, treeName, tmpDir, numParts, chunkSize) for i, shard in enumerate(shards)])
+        rules = set(summary['rule'] for summary in summaries)
+        if len(rules) == 1 and None not in rules:
+            rule = rules.pop()
+        else:
+            missing = [summary['fileName'] for summary in summaries if summary['rule'] is None]
+            if missing: print "Merge: No event index for %s, keeping the first shard writing an event and summing the cutflows" % ', '.join(missing)
+            else: print "Merge: Shards with different rules %s, keeping the first shard writing an event" % ', '.join(sorted(rules))
+            rule = 'first'
+        width = max(summary['width'] for summary in summaries)
+
+        # resolve each partition
+        results = pool.map(resolve_partition, [(p, len(shards), width, rule, tmpDir) for p in range(numParts)])
+        pool.close()
+    except:
+        pool.terminate()
+        shutil.rmtree(tmpDir)
+        raise
+    finally:
+        pool.join()
+
+    try:
+        numDuplicates = sum(duplicates for counts, duplicates in results)
+        if numDuplicates: print "Merge: %i events written by more than one shard, keeping one candidate (rule %s)" % (numDuplicates, rule)
+
+        # the cutflow, from the levels of the events if all shards have their event index
+        numEvts = sum(summary['cutflow'][0] if summary['cutflow'] else 0 for summary in summaries)
+        if all(summary['rule'] is not None for summary in summaries):
+            counts = np.zeros(max([len(counts) for counts, duplicates in results] + [0]), dtype=np.int64)
+            for partCounts, duplicates in results: counts[:len(partCounts)] += partCounts
+            cutflowVals = [int(x) for x in np.cumsum(counts[::-1])[::-1]]
+            cutflow = [numEvts] + cutflowVals
+        else:
+            cutflow = [0.] * max(len(summary['cutflow']) for summary in summaries)
+            for summary in summaries:
+                for b, val in enumerate(summary['cutflow']): cutflow[b] += val
+        labels = max(summaries, key=lambda summary: len(summary['cutflow']))['labels']
+
+        # copy the entries shard by shard
+        winners = [np.load(os.path.join(tmpDir, 'winners_part%i.npz' % p)) for p in range(numParts)]
+        outFile = rt.TFile(output, 'recreate')
+        firstFile = rt.TFile(shards[0], 'READ')
+        outFile.cd()
+        outTree = firstFile.Get(treeName).CloneTree(0)
+        outTree.SetDirectory(outFile)
+        firstFile.Close()
+        numCopied = 0
+        for i, shard in enumerate(shards):
+            keep = np.sort(np.concatenate([w['keys'][w['shard'] == i] for w in winners]))
+            copied = copy_shard(outTree, shard, treeName, keep, chunkSize)
+            print "Merge: %s: %i/%i entries" % (shard, copied, summaries[i]['entries'])
+            if copied != len(keep):
+                raise ValueError('%s: %i of the %i events kept from this shard found in its tree' % (shard, copied, len(keep)))
+            numCopied += copied
+
+        outFile.cd()
+        cutflowHist = rt.TH1F('cutflow','cutflow',len(cutflow),0,len(cutflow))
+        for b, val in enumerate(cutflow):
+            cutflowHist.SetBinContent(b+1, val)
+        for b, label in labels.iteritems():
+            if b <= len(cutflow): cutflowHist.GetXaxis().SetBinLabel(b, label)
+        outTree.Write()
+        cutflowHist.Write()
+        outFile.Close()
+    finally:
+        shutil.rmtree(tmpDir)
+
+    print "Merge: %i shards, %i entries in %s (%.1f s)" % (len(shards), numCopied, output, time.time()-start)
+    return numCopied
+
+
+def parse_command_line(argv):
+    parser = argparse.ArgumentParser(description="Merge the ISA ntuples of several jobs of a sample")
+
+    parser.add_argument('output', type=str, help='Merged ntuple')
+    parser.add_argument('shards', type=str, nargs='+', help='ISA ntuples to merge, in file order (UNIX wildcards allowed)')
+    parser.add_argument('-t','--tree', type=str, default=None, help='Name of the analyzer tree (default the only tree)')
+    parser.add_argument('-j','--jobs', type=int, default=None, help='Number of processes (default the number of CPUs)')
+    parser.add_argument('-p','--partitions', type=int, default=None, help='Number of hash partitions of the events (default 4 per process)')
+    parser.add_argument('-cs','--chunkSize', type=int, default=100000, help='Number of entries read at once')
+    parser.add_argument('--tmpDir', type=str, default=None, help='Directory for the temporary partitions')
+    args = parser.parse_args(argv)
+
+    return args
+
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+
+    args = parse_command_line(argv)
+
+    shards = [fname for string in args.shards for fname in sorted(glob.glob(string))]
+    if not shards:
+        print "No shards found"
+        return 1
+    if os.path.abspath(args.output) in [os.path.abspath(shard) for shard in shards]:
+        print "The output can not be one of the shards"
+        return 1
+
+    merge(args.output, shards, tree=args.tree, numWorkers=args.jobs, numParts=args.partitions,
+          chunkSize=args.chunkSize, tmpDir=args.tmpDir)
+
+    return 0
+
+
+if __name__ == "__main__":
+    status = main()
+    sys.exit(status)
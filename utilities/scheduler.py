@@ -0,0 +1,283 @@
+'''
+Size-aware scheduling of analyzer tasks over a pool of worker processes.
+
+The cost of a sample is estimated from its FSA files (number of files, bytes
+or entries of the eventCount trees). Tasks are dispatched largest first and
+samples larger than a worker's share of the total cost are split into chunks
+of files, merged by a final task once all chunks are done:
+
+    scheduler = Scheduler(numWorkers=8)
+    scheduler.run(tasks)
+    scheduler.write_summary('summary.json')
+
+Author: Devin N. Taylor, UW-Madison
+'''
+
+import os
+import sys
+import time
+import json
+import errno
+import Queue
+import traceback
+import multiprocessing as mp
+
+COST_METHODS = ['files', 'bytes', 'entries']
+# seconds between the checks of the workers running tasks
+POLL_INTERVAL = 5.
+
+def file_entries(path):
+    '''
+    Number of entries of the first eventCount tree of an FSA file.
+    '''
+    sys.argv.append('-b')
+    import ROOT as rt
+    sys.argv.pop()
+    rtFile = rt.TFile(path, 'READ')
+    entries = 0
+    for key in rtFile.GetListOfKeys():
+        metatree = rtFile.Get('%s/eventCount' % key.GetName())
+        if metatree:
+            entries = metatree.GetEntries()
+            break
+    rtFile.Close()
+    return entries
+
+def estimate_costs(location, fileNames, method='bytes'):
+    '''
+    Estimated cost of each file of a sample: 1 per file, its size in bytes or its
+    number of events.
+    '''
+    if method == 'files':
+        return [1. for fileName in fileNames]
+    elif method == 'bytes':
+        return [float(os.path.getsize(os.path.join(location, fileName))) for fileName in fileNames]
+    elif method == 'entries':
+        return [float(file_entries(os.path.join(location, fileName))) for fileName in fileNames]
+    raise ValueError('Unknown cost method %s, use one of %s' % (method, ', '.join(COST_METHODS)))
+
+def split_files(fileNames, costs, maxCost):
+    '''
+    Split the files of a sample in chunks of consecutive files of at most maxCost
+    (a single file above maxCost makes its own chunk).
+    '''
+    chunks = []
+    chunk = []
+    chunkCost = 0.
+    for fileName, cost in zip(fileNames, costs):
+        if chunk and chunkCost+cost > maxCost:
+            chunks += [chunk]
+            chunk = []
+            chunkCost = 0.
+        chunk += [fileName]
+        chunkCost += cost
+    if chunk: chunks += [chunk]
+    return chunks
+
+def format_time(seconds):
+    if seconds < 60: return '%.1fs' % seconds
+    seconds = int(seconds)
+    if seconds >= 3600: return '%ih%02im' % (seconds/3600, seconds%3600/60)
+    return '%im%02is' % (seconds/60, seconds%60)
+
+class Task(object):
+    '''
+    A call fun(args) with an estimated cost, run once the tasks named in
+    requires are done. fun must be a module level function.
+    '''
+    def __init__(self, name, fun, args, cost, **kwargs):
+        self.name = name
+        self.fun = fun
+        self.args = args
+        self.cost = cost
+        self.requires = set(kwargs.pop('requires',[]))
+        self.kind = kwargs.pop('kind','sample')
+        self.status = 'pending'
+        self.runtime = None
+        self.worker = None
+        self.error = None
+
+def pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno == errno.EPERM
+    return True
+
+_started = None
+
+def _init_worker(started):
+    global _started
+    _started = started
+
+def _run_task(args):
+    '''
+    Run a task in a worker, errors are returned rather than raised since the
+    result callback of the pool is the only one called in python 2.7. The
+    task and the worker pid are put in the started queue first, so that the
+    scheduler notices a worker dying with the task.
+    '''
+    name, fun, funArgs = args
+    if _started is not None: _started.put((name, os.getpid()))
+    start = time.time()
+    try:
+        fun(funArgs)
+        error = None
+    except Exception:
+        traceback.print_exc()
+        error = traceback.format_exc().strip().split('\n')[-1]
+    return name, time.time()-start, os.getpid(), error
+
+class Scheduler(object):
+    '''
+    Run tasks in a pool of worker processes, largest estimated cost first.
+        scheduler.run(tasks)            run the tasks, returns the number of failed tasks
+        scheduler.summary()             per task status, runtime and worker
+        scheduler.write_summary(name)   write the summary to a json file
+    A live ETA is printed each time a task finishes and every interval seconds,
+    from the rate at which the estimated cost was processed so far. Tasks that
+    require a failed task are skipped. A task whose worker dies (i.e. a crash in
+    ROOT or the OOM killer) is marked failed, the pool replaces the worker.
+    kwargs:
+        numWorkers  number of worker processes (default the number of CPUs)
+        interval    seconds between progress lines without finished tasks (default 60)
+    '''
+    def __init__(self, **kwargs):
+        self.numWorkers = kwargs.pop('numWorkers',None) or mp.cpu_count()
+        self.interval = kwargs.pop('interval',60)
+        self.tasks = []
+        self.wallTime = 0.
+
+    def run(self, tasks):
+        self.tasks = list(tasks)
+        tasksByName = dict((task.name, task) for task in self.tasks)
+        for task in self.tasks:
+            unknown = task.requires - set(tasksByName)
+            if unknown: raise ValueError('Task %s requires unknown tasks %s' % (task.name, ', '.join(sorted(unknown))))
+        totalCost = sum(task.cost for task in self.tasks)
+        doneCost = 0.
+        numFinished = 0
+        finished = Queue.Queue()
+        started = mp.Queue()
+        workers = {}
+        results = {}
+        dead = set()
+        numLost = 0
+        start = time.time()
+        lastProgress = start
+        pool = mp.Pool(self.numWorkers, _init_worker, (started,))
+        try:
+            while numFinished < len(self.tasks):
+                # skip the tasks requiring a failed task, then dispatch the tasks whose
+                # requirements are done, largest first
+                changed = True
+                while changed:
+                    changed = False
+                    for task in self.tasks:
+                        if task.status != 'pending': continue
+                        if any(tasksByName[name].status in ['failed', 'skipped'] for name in task.requires):
+                            print "Scheduler: Skipping %s, a required task failed" % task.name
+                            task.status = 'skipped'
+                            numFinished += 1
+                            doneCost += task.cost
+                            changed = True
+                ready = [task for task in self.tasks
+                         if task.status == 'pending' and all(tasksByName[name].status == 'done' for name in task.requires)]
+                for task in sorted(ready, key=lambda task: -task.cost):
+                    task.status = 'running'
+                    results[task.name] = pool.apply_async(_run_task, [(task.name, task.fun, task.args)], callback=finished.put)
+                if numFinished == len(self.tasks): break
+                if not any(task.status == 'running' for task in self.tasks):
+                    raise ValueError('Tasks %s can not run, their requirements are circular'
+                                     % ', '.join(task.name for task in self.tasks if task.status == 'pending'))
+
+                try:
+                    name, runtime, worker, error = finished.get(timeout=min(POLL_INTERVAL, self.interval))
+                except Queue.Empty:
+                    for name, worker in self.lost_tasks(started, workers, results, dead):
+                        task = tasksByName[name]
+                        task.worker = worker
+                        task.error = 'worker %i died' % worker
+                        numLost += 1
+                        task.status = 'failed'
+                        numFinished += 1
+                        doneCost += task.cost
+                        print "Scheduler: %s failed: %s" % (task.name, task.error)
+                    if time.time()-lastProgress >= self.interval:
+                        self.print_progress(start, numFinished, doneCost, totalCost)
+                        lastProgress = time.time()
+                    continue
+                task = tasksByName[name]
+                if task.status != 'running': continue
+                task.runtime = runtime
+                task.worker = worker
+                task.error = error
+                task.status = 'failed' if error else 'done'
+                numFinished += 1
+                doneCost += task.cost
+                if error: print "Scheduler: %s failed: %s" % (task.name, error)
+                self.print_progress(start, numFinished, doneCost, totalCost)
+                lastProgress = time.time()
+            # the pool waits forever for the results of the tasks lost with their worker
+            if numLost: pool.terminate()
+            else: pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+            self.wallTime = time.time() - start
+        return len([task for task in self.tasks if task.status == 'failed'])
+
+    def lost_tasks(self, started, workers, results, dead):
+        '''
+        The (name, worker pid) of the running tasks whose worker died without returning a
+        result. workers maps the started tasks to their worker pid and results to their
+        AsyncResult. A task is only lost if it still has no result at the check after its
+        worker was found dead (added to dead), the result may be on its way.
+        '''
+        while True:
+            try:
+                name, pid = started.get_nowait()
+            except Queue.Empty:
+                break
+            workers[name] = pid
+        lost = []
+        for name, pid in workers.items():
+            if results[name].ready():
+                del workers[name]
+            elif pid_alive(pid):
+                continue
+            elif name in dead:
+                lost += [(name, pid)]
+                del workers[name]
+            else:
+                dead.add(name)
+        return lost
+
+    def print_progress(self, start, numFinished, doneCost, totalCost):
+        elapsed = time.time() - start
+        fraction = doneCost/totalCost if totalCost else float(numFinished)/len(self.tasks)
+        eta = format_time(elapsed*(1.-fraction)/fraction) if fraction else 'unknown'
+        print "Scheduler: %i/%i tasks, %.0f%% of the estimated cost, elapsed %s, ETA %s" % (numFinished, len(self.tasks), 100.*fraction, format_time(elapsed), eta)
+
+    def summary(self):
+        return {
+            'numWorkers': self.numWorkers,
+            'wallTime': self.wallTime,
+            'tasks': [{'name': task.name, 'kind': task.kind, 'cost': task.cost, 'status': task.status,
+                       'runtime': task.runtime, 'worker': task.worker, 'error': task.error}
+                      for task in self.tasks],
+        }
+
+    def write_summary(self, fileName):
+        '''
+        Write the summary to a json file and print the slowest tasks.
+        '''
+        with open(fileName, 'w') as summaryFile:
+            json.dump(self.summary(), summaryFile, indent=4, sort_keys=True)
+        busy = sum(task.runtime for task in self.tasks if task.runtime)
+        print "Scheduler: %i tasks in %s on %i workers (%.0f%% busy), summary in %s" % (len(self.tasks), format_time(self.wallTime), self.numWorkers,
+                                                                                       100.*busy/(self.wallTime*self.numWorkers) if self.wallTime else 0., fileName)
+        for task in sorted(self.tasks, key=lambda task: -(task.runtime or 0.))[:10]:
+            print "    %-50s %-8s %8s %s" % (task.name, task.kind, format_time(task.runtime or 0.), task.status)
@@ -1,16 +1,158 @@
 #!/usr/bin/env python
+'''
+Extract the results.tar.gz of the jobs of a submission.
+
+The archives of the submit directories (/nfs_scratch/[user]/[jobName] or
+[jobName]/[sample]) are extracted by a pool of processes with the tarfile
+module. An archive whose files are all present with the same size and an
+mtime at least as recent as in the archive is skipped. The bookkeeping of
+run.py (manifest.json, scheduler.json) describes a single job and is not
+extracted, it would be overwritten by every archive. The files of an
+archive are extracted to temporary names and the ROOT files checked to open
+and contain the analyzer tree (the channel of their ntuples directory)
+before any file is renamed into place, so a corrupt archive never replaces
+good ntuples. A summary with the throughput is printed at the end:
+
+    ./utilities/untarNtuples.py testSubmit -j 8
+
+Author: Devin N. Taylor, UW-Madison
+'''
 
 import os
 import sys
-import pwd
 import glob
+import time
+import shutil
+import tarfile
+import tempfile
 import argparse
+import multiprocessing as mp
+
+from executors import user_submit_dir
+
+ARCHIVE = 'results.tar.gz'
+# bookkeeping of a single job, shared names in all archives
+JOB_FILES = ['manifest.json', 'scheduler.json']
+
+
+def find_archives(submitDir):
+    '''
+    The results.tar.gz of a submit directory and of its sample directories.
+    '''
+    if os.path.exists('%s/%s' % (submitDir, ARCHIVE)): return ['%s/%s' % (submitDir, ARCHIVE)]
+    return sorted(glob.glob('%s/*/%s' % (submitDir, ARCHIVE)))
+
+def archive_files(tar):
+    '''
+    The regular file members of an archive except the job bookkeeping, rejecting paths
+    outside the output directory.
+    '''
+    members = []
+    for member in tar.getmembers():
+        if not member.isfile() or os.path.basename(member.name) in JOB_FILES: continue
+        path = os.path.normpath(member.name)
+        if os.path.isabs(path) or path.startswith('..'):
+            raise ValueError('unsafe path %s' % member.name)
+        members += [member]
+    return members
+
+def up_to_date(member, outDir):
+    fileName = os.path.join(outDir, member.name)
+    if not os.path.exists(fileName): return False
+    stat = os.stat(fileName)
+    return stat.st_size == member.size and int(stat.st_mtime) >= member.mtime
+
+def tree_name(fileName):
+    '''
+    Analyzer tree of an ntuple, the channel of ntuples[analysis]_[period]tev_[channel].
+    '''
+    directory = os.path.basename(os.path.dirname(os.path.abspath(fileName)))
+    if directory.startswith('ntuples') and '_' in directory: return directory.split('_')[-1]
+    return None
+
+def verify_root(fileName, tree=None):
+    '''
+    Check a ROOT file opens and contains the analyzer tree, returns an error or None.
+    '''
+    import ROOT as rt
+    tree = tree or tree_name(fileName)
+    rtFile = rt.TFile(fileName)
+    try:
+        if rtFile.IsZombie(): return 'cannot open'
+        trees = [key.GetName() for key in rtFile.GetListOfKeys() if key.GetClassName() == 'TTree']
+        if tree and tree not in trees: return 'no tree %s' % tree
+        if not tree and not trees: return 'no tree'
+    finally:
+        rtFile.Close()
+    return None
+
+def extract_archive(archive, outDir, **kwargs):
+    '''
+    Extract an archive into outDir. Returns a dictionary with the archive, its
+    'status' ('extracted', 'skipped' or 'failed'), the number of 'files' and
+    'bytes' extracted and the 'error' of a failed archive.
+    kwargs:
+        force   extract even if the files are up to date (default False)
+        verify  check the ROOT files before moving them into place (default True)
+        tree    name of the analyzer tree (default the channel of the ntuples directory)
+    '''
+    force = kwargs.pop('force',False)
+    verify = kwargs.pop('verify',True)
+    tree = kwargs.pop('tree',None)
+    result = {'archive': archive, 'status': 'skipped', 'files': 0, 'bytes': 0, 'error': None}
+    written = []
+    try:
+        with tarfile.open(archive, 'r:gz') as tar:
+            members = archive_files(tar)
+            if not force and all(up_to_date(member, outDir) for member in members): return result
+            for member in members:
+                fileName = os.path.join(outDir, member.name)
+                if not os.path.isdir(os.path.dirname(fileName)):
+                    try:
+                        os.makedirs(os.path.dirname(fileName))
+                    except OSError:
+                        # created by another worker
+                        if not os.path.isdir(os.path.dirname(fileName)): raise
+                fd, tmpName = tempfile.mkstemp(prefix='.%s.' % os.path.basename(fileName), suffix='.part', dir=os.path.dirname(fileName))
+                written += [(tmpName, fileName)]
+                source = tar.extractfile(member)
+                with os.fdopen(fd, 'wb') as target:
+                    shutil.copyfileobj(source, target, 1<<20)
+                os.chmod(tmpName, member.mode & 0777)
+                os.utime(tmpName, (member.mtime, member.mtime))
+                result['files'] += 1
+                result['bytes'] += member.size
+        if verify:
+            for tmpName, fileName in written:
+                if not fileName.endswith('.root'): continue
+                error = verify_root(tmpName, tree)
+                if error: raise ValueError('%s: %s' % (os.path.relpath(fileName, outDir), error))
+        for tmpName, fileName in written:
+            os.rename(tmpName, fileName)
+        result['status'] = 'extracted'
+    except Exception as e:
+        result['status'] = 'failed'
+        result['error'] = str(e)
+        result['files'] = result['bytes'] = 0
+        for tmpName, fileName in written:
+            if os.path.exists(tmpName): os.remove(tmpName)
+    return result
+
+def _extract(args):
+    archive, outDir, options = args
+    return extract_archive(archive, outDir, **options)
 
 
 def parse_command_line(argv):
     parser = argparse.ArgumentParser(description="Untar ntuples from submit directory")
 
     parser.add_argument('jobName', type=str, nargs='+', help='Job name for submission')
+    parser.add_argument('-sd','--submitDir', type=str, default=None, help='Directory of the submit directories (default /nfs_scratch/[user])')
+    parser.add_argument('-o','--outputDir', type=str, default='.', help='Directory to extract to (default .)')
+    parser.add_argument('-j','--jobs', type=int, default=None, help='Number of extracting processes (default the number of CPUs)')
+    parser.add_argument('-t','--tree', type=str, default=None, help='Analyzer tree to check (default the channel of the ntuples directory)')
+    parser.add_argument('-f','--force', action='store_true', help='Extract archives already extracted')
+    parser.add_argument('-nv','--noVerify', action='store_true', help='Do not check the extracted ROOT files')
     args = parser.parse_args(argv)
 
     return args
@@ -22,33 +164,50 @@ def main(argv=None):
 
     args = parse_command_line(argv)
 
-    userDir = '/nfs_scratch/%s' % pwd.getpwuid(os.getuid())[0]
-    baseDirs = [os.path.basename(fname)
-                for string in args.jobName
-                for fname in glob.glob("%s/%s" % (userDir, os.path.basename(string)))]
+    userDir = args.submitDir or user_submit_dir()
+    submitDirs = [fname
+                  for string in args.jobName
+                  for fname in glob.glob("%s/%s" % (userDir, os.path.basename(string)))]
+    if not submitDirs:
+        print "%s: no submit directories matching %s" % (userDir, ' '.join(args.jobName))
+        return 1
 
-    submitDirs = ['%s/%s' % (userDir,jobName) for jobName in baseDirs]
+    archives = []
     for submitDir in submitDirs:
-        if not os.path.exists(submitDir):
-            print "%s: Submit directory does not exist" %submitDir
-            continue
-
-        if os.path.exists('%s/results.tar.gz' % submitDir):
-            print "Extracting %s"
-            os.system('tar -zxf %s/results.tar.gz' % submitDir)
-        else:
-            sample_names = [os.path.basename(dir)
-                            for dir in glob.glob("%s/*" % submitDir)]
-            for sample in sample_names:
-                if os.path.exists('%s/%s/results.tar.gz' % (submitDir,sample)):
-                    print "Extracting %s" % sample
-                    os.system('tar -zxf %s/%s/results.tar.gz' % (submitDir,sample))
-                else:
-                    print '%s: no results.tar.gz found' % sample
-
-    return 0
+        found = find_archives(submitDir)
+        if not found:
+            print '%s: no %s found' % (submitDir, ARCHIVE)
+        archives += found
 
+    options = {'force': args.force, 'verify': not args.noVerify, 'tree': args.tree}
+    start = time.time()
+    counts = {'extracted': 0, 'skipped': 0, 'failed': 0}
+    numFiles = 0
+    numBytes = 0
+    pool = mp.Pool(args.jobs or mp.cpu_count())
+    try:
+        for result in pool.imap_unordered(_extract, [(archive, args.outputDir, options) for archive in archives]):
+            counts[result['status']] += 1
+            numFiles += result['files']
+            numBytes += result['bytes']
+            if result['status'] == 'failed':
+                print "%s: Error: %s" % (result['archive'], result['error'])
+            elif result['status'] == 'extracted':
+                print "Extracted %s (%i files, %.1f MB)" % (result['archive'], result['files'], result['bytes']/1.e6)
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+    elapsed = time.time() - start
 
-if __name__ == "__main__":
-    main()
+    print "Archives: %i extracted, %i up to date, %i failed" % (counts['extracted'], counts['skipped'], counts['failed'])
+    print "Wrote %i files, %.1f MB in %.1f s (%.1f MB/s)" % (numFiles, numBytes/1.e6, elapsed, numBytes/1.e6/max(elapsed, 1e-6))
+
+    return 1 if counts['failed'] else 0
 
+
+if __name__ == "__main__":
+    status = main()
+    sys.exit(status)